@@ -0,0 +1,281 @@
+"""
+Ad-hoc aggregate queries of researchers over the published release
+
+A query is declarative: equality filters and a group-by on the QI columns and sum, avg or
+count aggregates of the SA columns, for example
+```
+{
+    "filter": {"citizenship": "Singaporean Citizen"},
+    "group_by": ["gender"],
+    "aggregates": [{"function": "avg", "column": "first_sum"}, {"function": "count"}],
+    "exclude_zero": true
+}
+```
+It is compiled to a single SQL aggregate over the rows of a release. The rows of a release
+never change, so the results are cached under the release id and a hash of the query.
+The filter values must be labels of the release. The utility compares the result with the
+same query over the source data, labelled by the leaves of the release (age bands, postal
+sectors, renamed categories) so that no raw value can be filtered on or grouped by. It is
+only computed when asked for and is cached too.
+"""
+
+import hashlib
+import json
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Avg, Count, Q, Sum
+
+from anonymisation.anonymise.overall import NUM_YEARS1, TRANSACTION_TYPE1, WithdrawalRetriever
+from anonymisation.anonymise.utils.database import ANON_FIELDS
+from anonymisation.anonymise.utils.first_query import calculate_utility
+from anonymisation.anonymise.utils.format import AnonymisedDataFormatterBase
+from anonymisation.anonymise.utils.hierarchy import qi_hierarchies
+from anonymisation.anonymise.utils.read_data import IS_CAT
+from anonymisation.models import Anonymisation
+
+QI_COLUMNS = ANON_FIELDS[:4]
+SA_COLUMNS = ANON_FIELDS[4:]
+AGGREGATE_FUNCTIONS = {"sum": Sum, "avg": Avg, "count": Count}
+MAX_FILTER_VALUES = 100
+
+# Separator of the ends of a published range, see AnonymisedDataFormatterBase.format_attributes
+RANGE_SEPARATOR = " - "
+
+
+class AdhocQuery(object):
+
+    """
+    self.filters: {QI column: accepted values}
+    self.group_by: QI columns
+    self.aggregates: [(function, SA column or None for a count of rows)]
+    self.exclude_zero: aggregate only the non-zero values of the SA columns, like the
+    queries of first_query.py
+    Raises ValueError for a column or function that is not known.
+    """
+
+    def __init__(self, filters=None, group_by=None, aggregates=None, exclude_zero=False):
+        self.filters = {}
+        for column, values in (filters or {}).items():
+            values = [values] if isinstance(values, (str, int)) else values
+            self.filters[column] = sorted(set(map(str, values)))
+        self.group_by = list(group_by or [])
+        self.aggregates = [(function, column) for function, column in (aggregates or [("count", None)])]
+        self.exclude_zero = bool(exclude_zero)
+        for column in list(self.filters) + self.group_by:
+            if column not in QI_COLUMNS:
+                raise ValueError("%s is not a QI column." % column)
+        if len(set(self.group_by)) != len(self.group_by):
+            raise ValueError("A column is grouped by twice.")
+        for column, values in self.filters.items():
+            if not values or len(values) > MAX_FILTER_VALUES:
+                raise ValueError("The filter of %s must have 1 to %d values." % (column, MAX_FILTER_VALUES))
+        for function, column in self.aggregates:
+            if function not in AGGREGATE_FUNCTIONS:
+                raise ValueError("%s is not an aggregate function." % function)
+            if column is None and function != "count" or column is not None and column not in SA_COLUMNS:
+                raise ValueError("%s is not an SA column." % column)
+        if len(set(self.aliases())) != len(self.aliases()):
+            raise ValueError("An aggregate is given twice.")
+
+    @classmethod
+    def from_json(cls, json_dict):
+        aggregates = [(aggregate["function"], aggregate.get("column")) for aggregate in json_dict.get("aggregates", [])]
+        return cls(json_dict.get("filter"), json_dict.get("group_by"), aggregates or None,
+                   json_dict.get("exclude_zero", False))
+
+    def to_json(self):
+        return {
+            "filter": self.filters,
+            "group_by": self.group_by,
+            "aggregates": [{"function": function, "column": column} for function, column in self.aggregates],
+            "exclude_zero": self.exclude_zero,
+        }
+
+    def digest(self):
+        return hashlib.sha256(json.dumps(self.to_json(), sort_keys=True).encode()).hexdigest()
+
+    def aliases(self):
+        return [function if column is None else "%s_%s" % (function, column) for function, column in self.aggregates]
+
+    def anonymised(self, release):
+        """
+        Runs the query over the rows of release, returns one dict per group with the
+        group columns and the aggregates, in the order of the groups
+        """
+        rows = Anonymisation.objects.filter(release=release)
+        for column, values in self.filters.items():
+            rows = rows.filter(**{column + "__in": values})
+        aggregates = {}
+        for alias, (function, column) in zip(self.aliases(), self.aggregates):
+            nonzero = ~Q(**{column: 0}) if self.exclude_zero and column is not None else None
+            aggregates[alias] = AGGREGATE_FUNCTIONS[function](column or "id", filter=nonzero)
+        if self.group_by:
+            result = rows.values(*self.group_by).annotate(**aggregates).order_by(*self.group_by)
+        else:
+            result = [rows.aggregate(**aggregates)]
+        return [self.clean(row) for row in result]
+
+    def check_filters(self, release):
+        """
+        Raises ValueError for a filter value that is not a label of release: the source data
+        is only ever filtered on the published generalisations, never on raw values
+        """
+        rows = Anonymisation.objects.filter(release=release)
+        for column, values in self.filters.items():
+            labels = set(rows.filter(**{column + "__in": values}).values_list(column, flat=True).distinct())
+            for value in values:
+                if value not in labels:
+                    raise ValueError("%s is not a published value of %s." % (value, column))
+
+    def raw(self):
+        """
+        Runs the query over the source data (the records of WithdrawalRetriever), every record
+        labelled like the release would label it alone, see source_labels. A filter value keeps
+        the records of the leaves it covers. Without a group-by there is always one row, like
+        the aggregate of anonymised.
+        """
+        records = WithdrawalRetriever(TRANSACTION_TYPE1, NUM_YEARS1).retrieve_records()
+        labels = source_labels(records)
+        selected = np.ones(len(records), dtype=bool)
+        for column, values in self.filters.items():
+            leaf_labels, leaves = labels[column]
+            covered = set()
+            for value in values:
+                covered.update(leaf_labels.covered(value))
+            selected &= np.isin(leaves, list(covered))
+        rows = np.flatnonzero(selected).tolist()
+        sa_values = np.asarray([records[row][len(QI_COLUMNS):] for row in rows],
+                               dtype=np.float64).reshape(len(rows), len(SA_COLUMNS))
+        groups = {(): list(range(len(rows)))} if not self.group_by else {}
+        for position, row in enumerate(rows if self.group_by else []):
+            group = tuple(labels[column][0].label(labels[column][1][row]) for column in self.group_by)
+            groups.setdefault(group, []).append(position)
+        results = []
+        for group in sorted(groups):
+            members = sa_values[groups[group]]
+            row = dict(zip(self.group_by, group))
+            for alias, (function, column) in zip(self.aliases(), self.aggregates):
+                if column is None:
+                    row[alias] = len(members)
+                    continue
+                values = members[:, SA_COLUMNS.index(column)]
+                if self.exclude_zero:
+                    values = values[values != 0]
+                if function == "count":
+                    row[alias] = len(values)
+                elif function == "sum":
+                    row[alias] = values.sum()
+                else:
+                    row[alias] = values.mean() if len(values) else 0
+            results.append(self.clean(row))
+        return results
+
+    def clean(self, row):
+        for alias in self.aliases():
+            row[alias] = float(row[alias] or 0)
+        return row
+
+    def utility(self, anonymised, raw):
+        """
+        Utility of the anonymised result against the raw one, see calculate_utility. The groups
+        of both results are compared, a group that one of them does not have (e.g. it was
+        generalised away) counts with aggregates of 0. Two empty results have a utility of 100,
+        an empty raw result is never told apart from a matching one.
+        """
+        aliases = self.aliases()
+        missing = dict.fromkeys(aliases, 0)
+        anon_groups = {tuple(row[column] for column in self.group_by): row for row in anonymised}
+        raw_groups = {tuple(row[column] for column in self.group_by): row for row in raw}
+        groups = sorted(set(anon_groups) | set(raw_groups))
+        if not groups:
+            return 100.0
+        anon_values = [[anon_groups.get(group, missing)[alias] for alias in aliases] for group in groups]
+        raw_values = [[raw_groups.get(group, missing)[alias] for alias in aliases] for group in groups]
+        return calculate_utility(np.ravel(anon_values), np.ravel(raw_values))
+
+
+class LeafLabels(object):
+
+    """
+    Published labels of the leaves of one QI of the source data, in the order Mondrian
+    generalises them
+    self.bounds: (label of the lower end, label of the upper end) of every leaf, a range of
+    leaves is published as "lower - upper", see format_anon_data
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.first = {}
+        self.last = {}
+        for leaf, (low, high) in enumerate(bounds):
+            self.first.setdefault(low, leaf)
+            self.last[high] = leaf
+
+    def label(self, leaf):
+        low, high = self.bounds[leaf]
+        return low if low == high else low + RANGE_SEPARATOR + high
+
+    def covered(self, label):
+        """
+        Leaves covered by a published label, none when it is not one
+        """
+        parts = label.split(RANGE_SEPARATOR)
+        if len(parts) > 2 or parts[0] not in self.first or parts[-1] not in self.last:
+            return range(0)
+        return range(self.first[parts[0]], self.last[parts[-1]] + 1)
+
+
+def source_labels(records):
+    """
+    Returns {QI column: (LeafLabels, leaf of every record)} of typed records. The leaves are
+    those of the hierarchy of the QI when it has one (the records are already coded by
+    hierarchy.encode_records), else its distinct values, in the order of read_data.
+    """
+    formatter = AnonymisedDataFormatterBase()
+    hierarchies = qi_hierarchies()
+    labels = {}
+    for index, column in enumerate(QI_COLUMNS):
+        values = [record[index] for record in records]
+        if index in hierarchies:
+            labels[column] = (LeafLabels(hierarchies[index].labels), np.asarray(values, dtype=np.int64))
+            continue
+        if IS_CAT[index]:
+            # categories are coded in order of appearance without spaces, see read_data
+            values = [str(value).replace(' ', '') for value in values]
+            order = list(dict.fromkeys(values))
+            publish = formatter.format_citizenship
+        else:
+            order = sorted(set(values))
+            publish = formatter.anonymise_postal_code if column == "postal_code" else str
+        leaf = {value: position for position, value in enumerate(order)}
+        bounds = [(publish(str(value)),) * 2 for value in order]
+        labels[column] = (LeafLabels(bounds), np.asarray([leaf[value] for value in values], dtype=np.int64))
+    return labels
+
+
+def cache_key(release, query):
+    return "anonymisation:query:%d:%s" % (release.pk, query.digest())
+
+
+def run_query(release, query, with_utility=False):
+    """
+    Returns {"results": rows of query.anonymised} and with_utility, {"utility": ...} too,
+    from the cache when the query was already run over release.
+    Raises ValueError for a utility of filters that are not labels of release, see check_filters
+    """
+    key = cache_key(release, query)
+    results = cache.get(key)
+    if results is None:
+        results = query.anonymised(release)
+        cache.set(key, results, settings.ANONYMISATION_QUERY_CACHE_TIMEOUT)
+    response = {"results": results}
+    if with_utility:
+        cached = cache.get(key + ":utility")
+        if cached is None:
+            query.check_filters(release)
+            cached = {"utility": query.utility(results, query.raw())}
+            cache.set(key + ":utility", cached, settings.ANONYMISATION_QUERY_CACHE_TIMEOUT)
+        response.update(cached)
+    return response
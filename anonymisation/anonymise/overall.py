@@ -1,18 +1,27 @@
+import hashlib
 from enum import Enum
+from functools import partial
+from itertools import islice
 
-from django.db.models import F, Q, Sum, Count
-from customer.models import Transactions, Accounts
-from django.db.models.functions import ExtractMonth, ExtractYear
+from django.db.models import (BigIntegerField, Case, Count, DecimalField, Exists, F, IntegerField, Max, OuterRef, Q,
+                              Subquery, Sum, When)
+from customer.models import Customer, Transactions, Accounts
+from django.db.models.functions import Cast, Coalesce, ExtractDay, ExtractMonth, ExtractYear
 
-from datetime import datetime
+from datetime import date, datetime
+from decimal import Decimal
 
 from django.http import JsonResponse
 
-from anonymisation.anonymise.utils.anonymiser import anonymise
+from anonymisation.anonymise.utils.anonymiser import (anonymise, anonymise_incremental, anonymise_parallel,
+                                                     anonymise_sweep)
+from anonymisation.anonymise.utils.hierarchy import domain_key, encode_records
+from anonymisation.anonymise.utils.read_data import read_columns
 from anonymisation.anonymise.utils.requirements import age_convert
 from anonymisation.anonymise.utils.first_query import calculate_utility
 
 from anonymisation.anonymise.utils.format import AnonymisedDataFormatterBase
+from anonymisation.models import Anonymisation
 from anonymisation.anonymise.utils.first_query import AnonymisedFirstQuery, UnanonymisedFirstQuery, AnonymisedSecondQuery, UnanonymisedSecondQuery
 
 # FIXED
@@ -25,6 +34,52 @@ TYPE_OF_CITIZEN1 = 'Singaporean Citizen'
 # Second Query Parameters
 TYPE_OF_CITIZEN2 = 'Singaporean Citizen'
 
+# Sensitive attributes averaged by each query
+FIRST_QUERY_COLUMNS = ['first_sum', 'second_sum', 'third_sum', 'fourth_sum', 'fifth_sum']
+SECOND_QUERY_COLUMNS = ['first_balance', 'second_balance', 'third_balance']
+
+ACCOUNT_TYPES = [1, 2, 3]
+# Rows fetched per round trip by the streaming extraction
+STREAM_CHUNK_SIZE = 10000
+
+
+def subquery_sum(queryset, group, field):
+    """
+    Correlated SUM(field) of queryset grouped by group, 0 when queryset has no rows
+    """
+    total = queryset.order_by().values(group).annotate(total=Sum(field)).values('total')
+    return Coalesce(Subquery(total, output_field=DecimalField(max_digits=12, decimal_places=2)), Decimal(0))
+
+
+def source_watermark():
+    """
+    Cheap fingerprint of the data that is anonymised, computed with aggregates in the database:
+    any insert, delete or update of a transaction, an account balance or a customer QI changes
+    one of them, the balances and QIs are weighted by their customer so a swap changes them too.
+    Today's date is part of it since the ages and the 5-year window depend on it, and
+    so are the QI domains, see hierarchy.py.
+    """
+    customer = Cast('user_id', BigIntegerField())
+    birth_date = ExtractYear('birth_date') * 372 + ExtractMonth('birth_date') * 31 + ExtractDay('birth_date')
+    state = (
+        Transactions.objects.aggregate(count=Count('pk'), latest=Max('date')),
+        Accounts.objects.aggregate(
+            count=Count('pk'),
+            customer_balance=Sum(customer * F('balance')),
+            type_balance=Sum(F('type_id') * F('balance')),
+            customer_type=Sum(customer * F('type_id'))),
+        Customer.objects.aggregate(
+            count=Count('pk'),
+            birth_dates=Sum(customer * birth_date),
+            postal_codes=Sum(customer * Cast('postal_code', BigIntegerField())),
+            **{'gender_%d' % index: Sum(customer, filter=Q(gender=gender))
+               for index, gender in enumerate(Customer.Gender.values)},
+            **{'citizenship_%d' % index: Sum(customer, filter=Q(citizenship=citizenship))
+               for index, citizenship in enumerate(Customer.Citizenship.values)}),
+    )
+    return hashlib.sha256(repr((date.today(), domain_key()) + state).encode()).hexdigest()
+
+
 class QueryOptions(Enum):
     FIRST = "1"
     SECOND = "2"
@@ -80,41 +135,91 @@ class TransactionRetrieverBase:
         pass
 
 class WithdrawalRetriever(TransactionRetrieverBase):   
-    def format(self, transaction_data=None, account_data=None):
+    def records_queryset(self):
+        """
+        The single aggregate query of retrieve_records, one row per customer with an account in
+        the column order of ATT_NAME. The age is computed in the database, the withdrawal sums of
+        every year and the balances of every account type are correlated subqueries, so that
+        neither multiplies the other. The balances of several accounts of one type are summed.
         """
-        Formats the data into a list, which will be anonymised
+        today = date.today()
+        years = range(today.year - self.num_years+1, today.year+1)
+        withdrawals = Transactions.objects.filter(sender__user=OuterRef('pk'), transaction_type=self.type)
+        accounts = Accounts.objects.filter(user=OuterRef('pk'))
+        birthday_ahead = (Q(birth_date__month__gt=today.month)
+                          | Q(birth_date__month=today.month, birth_date__day__gt=today.day))
+        columns = {
+            'age': Cast(today.year - ExtractYear('birth_date') - Case(When(birthday_ahead, then=1), default=0),
+                        IntegerField()),
+            'postal': Cast('postal_code', IntegerField()),
+        }
+        for index, year in enumerate(years):
+            columns['sum_%d' % index] = subquery_sum(withdrawals.filter(date__year=year), 'sender__user', 'amount')
+        for index, account_type in enumerate(ACCOUNT_TYPES):
+            columns['balance_%d' % index] = subquery_sum(accounts.filter(type=account_type), 'user', 'balance')
+        return (Customer.objects.filter(Exists(accounts)).annotate(**columns).order_by('pk')
+                .values_list('age', 'gender', 'postal', 'citizenship', *list(columns)[2:]))
+
+    def retrieve_records(self):
+        """
+        Retrieves the typed records of records() with a single aggregate query, see records_queryset
+        """
+        return encode_records(list(self.records_queryset()))
 
+    def stream_records(self, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Streams the rows of records_queryset in chunks of chunk_size, with QuerySet.iterator(chunk_size)
+        """
+        rows = self.records_queryset().iterator(chunk_size)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield encode_records(chunk)
+
+    def retrieve_columns(self, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Streams the records into column buffers preallocated for every customer with an account,
+        so no row of the whole customer base is ever held as a Python object
+        """
+        capacity = Accounts.objects.values('user').distinct().count()
+        return read_columns(self.stream_records(chunk_size), capacity)
+
+    def records(self, transaction_data=None, account_data=None):
+        """
+        Combines the data into one typed tuple per customer, which will be anonymised:
+        (age, gender, postal_code, citizenship, withdrawal sum of each year, balance of each account type)
+        The age and postal code are coded by their hierarchies, see hierarchy.encode_records
         """
 
         combined_records = self.include_withdrawals(transaction_data)
 
         combined_with_account = self.include_accounts(combined_records, account_data)
 
-        formatted_data = [record for record in combined_with_account.values()]
-
-        formatted_strings = [] 
-        for record in formatted_data:
-            record_str = [
-                # str(record['sender_id']),
-                str(record.get('sender_age', '')),
-                str(record.get('gender', '')),
-                str(record.get('postal_code', '')),
-                str(record.get('citizenship', '')),
-            ]
+        years = range(datetime.now().year - self.num_years+1, datetime.now().year+1)
+        zero = Decimal(0)
 
-            years = range(datetime.now().year - self.num_years+1, datetime.now().year+1)
-            total_amount = [str(record['total_amount'].get(year, 0)) for year in years]
-            
+        records = []
+        for record in combined_with_account.values():
+            total_amount = record['total_amount']
             balances = record.get('balances', {})
-            
-            account_balances = [balances.get(str(account_type), 0) for account_type in range(1, 4)]
+            records.append((
+                record['sender_age'],
+                record['gender'],
+                int(record['postal_code']),
+                record['citizenship'],
+                *[total_amount.get(year, zero) for year in years],
+                *[balances.get(account_type, zero) for account_type in ACCOUNT_TYPES],
+            ))
 
-            record_str.extend(total_amount)
-            record_str.extend(account_balances)
+        return encode_records(records)
 
-            formatted_strings.append(','.join(map(str, record_str)))
-
-        return formatted_strings
+    def format(self, transaction_data=None, account_data=None):
+        """
+        Formats the data into a list of comma separated strings, kept for compatibility,
+        see records and read_data
+        """
+        return [','.join(map(str, record)) for record in self.records(transaction_data, account_data)]
     
     def include_withdrawals(self, transaction_data):
         """
@@ -123,28 +228,28 @@ class WithdrawalRetriever(TransactionRetrieverBase):
         combined_records = {}
        
         for t in transaction_data:
-            sender_id = str(t['sender__user__user'])
+            sender_id = t['sender__user__user']
             year = t['year']
-            total_amount = str(t['total_amount'])
+            total_amount = t['total_amount']
             gender = t['sender__user__gender']
             postal_code = t['sender__user__postal_code']
             citizenship = t['sender__user__citizenship']
-            sender_age = str(age_convert(t['sender__user__birth_date']))
+            sender_age = age_convert(t['sender__user__birth_date'])
             
             key = (sender_id, sender_age, gender, postal_code, citizenship)
             
             if key not in combined_records:
                 combined_records[key] = {
-                    'sender_id': str(sender_id),
-                    'sender_age': str(sender_age),
-                    'gender': str(gender),
-                    'postal_code': str(postal_code),
-                    'citizenship': str(citizenship), 
-                    'total_amount': {year: str(total_amount)},
+                    'sender_id': sender_id,
+                    'sender_age': sender_age,
+                    'gender': gender,
+                    'postal_code': postal_code,
+                    'citizenship': citizenship, 
+                    'total_amount': {year: total_amount},
                 }
                 
             else:
-                combined_records[key].setdefault('total_amount', {})[year] = str(total_amount)
+                combined_records[key].setdefault('total_amount', {})[year] = total_amount
                 combined_records[key].setdefault('balances', {})
 
         return combined_records
@@ -154,94 +259,160 @@ class WithdrawalRetriever(TransactionRetrieverBase):
         Formats the balance of each account type and returns it into a dictionary, combined with sum of withdrawals 
         """
         for a in account_data:
-            user_id = str(a['user'])
-            gender = str(a['user__gender'])
-            postal_code = str(a['user__postal_code'])
-            citizenship = str(a['user__citizenship'])
-            account_type = str(a['type'])
-            balance = str(a['balance'])
-            age = str(age_convert(a['user__birth_date']))
+            user_id = a['user']
+            gender = a['user__gender']
+            postal_code = a['user__postal_code']
+            citizenship = a['user__citizenship']
+            account_type = a['type']
+            balance = a['balance']
+            age = age_convert(a['user__birth_date'])
 
             key = (user_id, age, gender, postal_code, citizenship)
 
             if key not in transaction_dict:
                 transaction_dict[key] = {
-                    'sender_id': str(user_id),
-                    'sender_age': str(age),
-                    'gender': str(gender),
-                    'postal_code': str(postal_code),
-                    'citizenship': str(citizenship),
-                    'balances': {account_type: str(balance)},
+                    'sender_id': user_id,
+                    'sender_age': age,
+                    'gender': gender,
+                    'postal_code': postal_code,
+                    'citizenship': citizenship,
+                    'balances': {account_type: balance},
                     'total_amount': {}
                 }
             else:
-                transaction_dict[key].setdefault('balances', {})[account_type] = str(balance)
+                transaction_dict[key].setdefault('balances', {})[account_type] = balance
 
         return transaction_dict
 
 
-def first_query_wrapper(anon_data, raw_data):
-    anon_first_query = AnonymisedFirstQuery(TYPE_OF_CITIZEN1, NUM_YEARS1, TRANSACTION_TYPE1)
-    anon_first_json, anon_list = anon_first_query.first_query(anon_data)
+def ground_truth():
+    """
+    Returns the true averages of both queries, (first_list, second_list), computed with
+    aggregates in the database. They do not depend on k, a sweep computes them once.
+    """
+    _, first_list = UnanonymisedFirstQuery(TYPE_OF_CITIZEN1, NUM_YEARS1, TRANSACTION_TYPE1).first_query()
+    _, second_list = UnanonymisedSecondQuery(TYPE_OF_CITIZEN2).second_query()
+    return first_list, second_list
 
-    unanon_first_query = UnanonymisedFirstQuery(TYPE_OF_CITIZEN1, NUM_YEARS1, TRANSACTION_TYPE1)
-    _, unanon_list = unanon_first_query.first_query(raw_data)
 
+def first_query_wrapper(anon_rows, unanon_list):
+    anon_first_query = AnonymisedFirstQuery(TYPE_OF_CITIZEN1, NUM_YEARS1, TRANSACTION_TYPE1)
+    anon_first_json, anon_list = anon_first_query.first_query(anon_rows)
 
     utility = calculate_utility(anon_list, unanon_list)
     return anon_list, utility, anon_first_json
 
 
-def second_query_wrapper(anon_data, raw_data):
+def second_query_wrapper(anon_rows, unanon_list):
     anon_second_query = AnonymisedSecondQuery(TYPE_OF_CITIZEN2)
-    anon_second_json, anon_list = anon_second_query.second_query(anon_data)
-    
-    unanon_second_query = UnanonymisedSecondQuery(TYPE_OF_CITIZEN2)
-    _, unanon_list = unanon_second_query.second_query(raw_data)
+    anon_second_json, anon_list = anon_second_query.second_query(anon_rows)
 
     utility = calculate_utility(anon_list, unanon_list)
     return anon_list, utility, anon_second_json
 
 
-def perform_query(query_option, anon_data):
-    
-    # For unanonymised, have to do initial retrieval and then do the processing
-    retriever = WithdrawalRetriever('Withdrawal', NUM_YEARS1)
-    
-    if anon_data is None:
+def perform_query(query_option, release, truth=None):
+    """
+    Runs a query over the rows of release, returns (anon_list, utility, result_json).
+    truth is the result of ground_truth, it is computed when not given.
+    """
+    if release is None:
         return None, 0, None
-    if query_option == "1":
-        raw_data = retriever.retrieve_transactions()
-        anon_list, utility, result_json = first_query_wrapper(anon_data, raw_data)
-    elif query_option == "2":
-        raw_data = retriever.retrieve_accounts()
-        anon_list, utility, result_json = second_query_wrapper(anon_data, raw_data)
-    else:
+    if query_option not in ("1", "2"):
         return None, 0, None
-    return anon_list, utility, result_json
+    first_truth, second_truth = truth or ground_truth()
+    anon_rows = Anonymisation.objects.filter(release=release)
+    if query_option == "1":
+        return first_query_wrapper(anon_rows, first_truth)
+    return second_query_wrapper(anon_rows, second_truth)
 
     
 # Main Function  
 def anonymise_wrapper(k_value):
+    """
+    Returns (info_loss, anon_data, loss_detail), see anonymiser.loss_detail
+    """
     retriever = WithdrawalRetriever('Withdrawal', NUM_YEARS1)
     
-    transaction_info = retriever.retrieve_transactions()
-    account_info = retriever.retrieve_accounts()
-    
-    formatted_str_withdrawals = retriever.format(transaction_info, account_info)
+    withdrawal_records = retriever.retrieve_records()
 
-    if not formatted_str_withdrawals:
-        return None, 0, None
+    if not withdrawal_records:
+        return 0, None, {}
     
-    if len(formatted_str_withdrawals) < k_value:
+    if len(withdrawal_records) < k_value:
         raise TooShortException("Not enough data for anonymisation.")
     
-    anon_data, eval_result = anonymise(formatted_str_withdrawals, k_value, retriever.type)
+    anon_data, eval_result = anonymise(withdrawal_records, k_value, retriever.type)
     anonymised_formatter = AnonymisedDataFormatterBase()
     
     new_anon_data = anonymised_formatter.format_anon_data(anon_data)
     
     info_loss = round(eval_result[0], 2)
 
-    return info_loss, new_anon_data
+    return info_loss, new_anon_data, eval_result[2]
+
+
+def anonymise_incremental_wrapper(k_value, tree=None):
+    """
+    anonymise_wrapper that updates the split tree of an earlier run of k_value instead of
+    partitioning from scratch, see incremental.py
+    Returns (info_loss, anon_data, loss_detail, tree)
+    """
+    retriever = WithdrawalRetriever('Withdrawal', NUM_YEARS1)
+
+    withdrawal_records = retriever.retrieve_records()
+
+    if not withdrawal_records:
+        return 0, None, {}, tree
+
+    if len(withdrawal_records) < k_value:
+        raise TooShortException("Not enough data for anonymisation.")
+
+    anon_data, eval_result, tree = anonymise_incremental(withdrawal_records, k_value, tree)
+    new_anon_data = AnonymisedDataFormatterBase().format_anon_data(anon_data)
+    info_loss = round(eval_result[0], 2)
+
+    return info_loss, new_anon_data, eval_result[2], tree
+
+
+def _sweep(k_values, engine):
+    """
+    Extracts the data once (streamed into column buffers) and runs engine over it for all
+    valid k values, engine is anonymise_sweep or anonymise_parallel.
+    Yields (k_value, info_loss, anon_data, loss_detail) in increasing order of k.
+    """
+    retriever = WithdrawalRetriever('Withdrawal', NUM_YEARS1)
+
+    withdrawal_columns = retriever.retrieve_columns()
+
+    if not withdrawal_columns:
+        return
+
+    k_values = sorted(k_values)
+    valid_k_values = [k_value for k_value in k_values if k_value <= len(withdrawal_columns)]
+    anonymised_formatter = AnonymisedDataFormatterBase()
+
+    if valid_k_values:
+        for k_value, eval_result, anon_data in engine(withdrawal_columns, valid_k_values):
+            new_anon_data = anonymised_formatter.format_anon_data(list(anon_data))
+            info_loss = round(eval_result[0], 2)
+            yield k_value, info_loss, new_anon_data, eval_result[2]
+
+    if len(valid_k_values) < len(k_values):
+        raise TooShortException("Not enough data for anonymisation.")
+
+
+def anonymise_sweep_wrapper(k_values):
+    """
+    Sweep mode of anonymise_wrapper, the strict Mondrian split tree is built once and
+    pruned for every k value, see anonymise_sweep.
+    """
+    return _sweep(k_values, anonymise_sweep)
+
 
+def anonymise_parallel_wrapper(k_values, max_workers=None):
+    """
+    anonymise_sweep_wrapper with an exact anonymisation of every k value, fanned out over a
+    process pool. The data is encoded once and shared with every worker.
+    """
+    return _sweep(k_values, partial(anonymise_parallel, max_workers=max_workers))
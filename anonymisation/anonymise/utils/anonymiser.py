@@ -1,13 +1,27 @@
-from anonymisation.anonymise.utils.mondrian import mondrian
-from anonymisation.anonymise.utils.read_data import read_data
+from anonymisation.anonymise.utils import mondrian, parallel, vector_mondrian
+from anonymisation.anonymise.utils.hierarchy import domain_key
+from anonymisation.anonymise.utils.incremental import IncrementalMondrian
+from anonymisation.anonymise.utils.read_data import SA_INDEX, read_records
+from anonymisation.anonymise.utils.utility import merge_qi_value
 
 import json
+import time
+
+import numpy as np
 
 # Read my test record
 DATA_SELECT = 'a'
 RELAX = False
 k = 3
 
+# Both engines share the (data, k, qi_num) constructor and the anonymize(relax) contract
+# and return the same partitions
+MONDRIAN_ENGINES = {
+    'classic': mondrian.MondrianEngine,
+    'vector': vector_mondrian.VectorMondrian,
+}
+ENGINE = 'vector'
+
 WITHDRAWAL_COLUMNS = ['sender_age', 'sender_gender', 'sender_postal_code', 'sender_citizenship',
                     'transaction_amount', 'month', 'year']
 
@@ -96,11 +110,34 @@ def prepare_output(result):
     return data_dict
 
 
+def loss_detail(attribute_loss, partition_loss):
+    """
+    Breakdown of the information loss of a run, stored with its statistics: the NCP of
+    every QI and the distribution of the NCP of the partitions, in percentage
+    """
+    partition_loss = np.asarray(partition_loss, dtype=np.float64)
+    summary = {"count": len(partition_loss), "mean": 0.0, "median": 0.0, "p90": 0.0, "max": 0.0}
+    if len(partition_loss):
+        summary.update({
+            "mean": round(float(partition_loss.mean()), 2),
+            "median": round(float(np.median(partition_loss)), 2),
+            "p90": round(float(np.percentile(partition_loss, 90)), 2),
+            "max": round(float(partition_loss.max()), 2),
+        })
+    return {
+        "attributes": dict(zip(ANON_COLUMNS, np.round(attribute_loss, 2).tolist())),
+        "partitions": summary,
+    }
+
+
 def get_result_one(data, intuitive_order, qi_num, sa_num, k=10):
     """
     Run Mondrian Algorithm one time, with k=10 as default. Returns anonymised data
+    and (ncp, rtime, loss_detail)
     """
-    result, eval_result = mondrian(data, k, RELAX, qi_num)
+    engine = MONDRIAN_ENGINES[ENGINE](data, k, qi_num)
+    result, (ncp, rtime) = engine.anonymize(RELAX)
+    eval_result = (ncp, rtime, loss_detail(*engine.information_loss()[1:]))
 
     # Convert numerical values back to categorical values if necessary
     if DATA_SELECT == 'a':
@@ -117,16 +154,91 @@ def get_result_one(data, intuitive_order, qi_num, sa_num, k=10):
 def anonymise(transaction_data, k_value, _):
     """
     Main function for calling anonymising based on the different transaction types of data.
-    Reads input value of k from user and anonymises transaction data that is parsed in.
-    Returns data as dict.
+    Reads input value of k from user and anonymises the typed records of transaction data,
+    see read_records. Returns data as dict and (ncp, rtime, loss_detail).
     """
     # Read in Transaction History data
     # if transaction_type == 'Withdrawal' or transaction_type == 'Deposit':
     #     DATA, intuitive_order, qi_num, sa_num = read_withdrawal_deposit(transaction_data)
     # else:
     #     DATA, intuitive_order, qi_num, sa_num = read_transfer(transaction_data)
-    DATA, intuitive_order, qi_num, sa_num = read_data(transaction_data)
+    DATA, intuitive_order, qi_num, sa_num = read_records(transaction_data)
     
     result, eval_result = get_result_one(DATA, intuitive_order, qi_num, sa_num, k_value)
     output = prepare_output(result)
-    return output, eval_result
\ No newline at end of file
+    return output, eval_result
+
+
+def anonymise_incremental(records, k_value, tree=None):
+    """
+    anonymise that updates the split tree of an earlier run, see incremental.py.
+    A new tree is built when there is none for k_value or its QI domains are not the
+    configured ones, see hierarchy.domain_key.
+    Returns (output, eval_result, tree)
+    """
+    if tree is None or tree.k != k_value or getattr(tree, "domains", None) != domain_key():
+        tree = IncrementalMondrian(k_value)
+        tree.domains = domain_key()
+    start_time = time.time()
+    tree.update(records)
+    rtime = float(time.time() - start_time)
+    generalization = tree.generalization()
+    output = [dict(zip(ANON_COLUMNS, generalization[tree.encode(record)] + [record[i] for i in SA_INDEX]))
+              for record in records]
+    ncp, attribute_loss, partition_loss = tree.information_loss()
+    return output, (ncp, rtime, loss_detail(attribute_loss, partition_loss)), tree
+
+
+def generalize_columns(engine, partitions, columns):
+    """
+    Output of the partitions of an engine built over RecordColumns, the records are
+    generalised partition by partition straight into the dictionaries of prepare_output
+    """
+    intuitive_order = columns.intuitive_order
+    perm = engine.perm
+    for start, size, low, high in zip(partitions.start.tolist(), partitions.size.tolist(),
+                                      partitions.low.tolist(), partitions.high.tolist()):
+        generalized = [merge_qi_value(engine.qi_order[i][low[i]], engine.qi_order[i][high[i]])
+                       for i in range(engine.qi_len)]
+        qi_values = [convert_intuitive_order(intuitive_order, generalized, i) if intuitive_order[i] else generalized[i]
+                     for i in range(engine.qi_len)]
+        for row in perm[start:start + size].tolist():
+            yield dict(zip(ANON_COLUMNS, qi_values + columns.sa_decimals(row)))
+
+
+def anonymise_sweep(columns, k_values):
+    """
+    Sweep mode of anonymise for several k values, over the RecordColumns of the data.
+    The engine is built over the column buffers directly and the strict Mondrian split
+    tree is built once, for the smallest k. The partitions of every other k are derived
+    by pruning that tree.
+    Yields (k_value, eval_result, output) in increasing order of k, output is a generator.
+    """
+    qi_rank, qi_order = vector_mondrian.encode_qi(columns.qi_codes(), columns.qi_num)
+    k_values = sorted(k_values)
+
+    engine = vector_mondrian.VectorMondrian.from_encoded(qi_rank, qi_order, k_values[0])
+    start_time = time.time()
+    engine.run(relax=False)
+    rtime = float(time.time() - start_time)
+
+    for k_value in k_values:
+        partitions = engine.prune(k_value)
+        ncp, attribute_loss, partition_loss = engine.information_loss(partitions)
+        yield (k_value, (ncp, rtime, loss_detail(attribute_loss, partition_loss)),
+               generalize_columns(engine, partitions, columns))
+
+
+def anonymise_parallel(columns, k_values, max_workers=None):
+    """
+    anonymise_sweep with an exact strict Mondrian run for every k value, over a process pool,
+    see parallel.py.
+    Yields (k_value, eval_result, output) in increasing order of k, output is a generator.
+    """
+    qi_rank, qi_order = vector_mondrian.encode_qi(columns.qi_codes(), columns.qi_num)
+    for k_value, rtime, (ncp, attribute_loss, partition_loss), perm, partitions in parallel.parallel_sweep(
+            qi_rank, qi_order, sorted(k_values), max_workers):
+        engine = vector_mondrian.VectorMondrian.from_encoded(qi_rank, qi_order, k_value)
+        engine.perm = perm
+        yield (k_value, (ncp, rtime, loss_detail(attribute_loss, partition_loss)),
+               generalize_columns(engine, partitions, columns))
@@ -1,12 +1,22 @@
+import csv
+import io
 from decimal import Decimal
+from itertools import islice
 
-from django.db import connections
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
 from django.utils import timezone
 
-from anonymisation.models import Anonymisation, Statistics
+from anonymisation.models import Anonymisation, AnonymisationRelease, Statistics
 
 MAX_VALUE = Decimal('9999999999999999999999999.99')
 
+ANON_FIELDS = ['age', 'gender', 'postal_code', 'citizenship',
+               'first_sum', 'second_sum', 'third_sum', 'fourth_sum', 'fifth_sum',
+               'first_balance', 'second_balance', 'third_balance']
+SUM_FIELDS = ['first_sum', 'second_sum', 'third_sum', 'fourth_sum', 'fifth_sum']
+
 def clean_sum(check_sum):
     check_sum = Decimal(check_sum)
     if check_sum > MAX_VALUE:
@@ -14,36 +24,85 @@ def clean_sum(check_sum):
     else:
         return check_sum
 
-def store_anon_database(anon_data):
-    Anonymisation.objects.all().delete()
+def clean_sums(check_sums):
+    """
+    clean_sum of every value of a column
+    """
+    return [clean_sum(check_sum) for check_sum in check_sums]
+
+def anon_rows(anon_data, release):
+    """
+    Returns the rows of a batch of anonymised records of release in the order of ANON_FIELDS
+    """
+    columns = []
+    for field in ANON_FIELDS:
+        column = [data[field] for data in anon_data]
+        columns.append(clean_sums(column) if field in SUM_FIELDS else column)
+    columns.append([release.pk] * len(anon_data))
+    return zip(*columns)
+
+def copy_anon_rows(cursor, rows):
+    """
+    Loads rows with a single PostgreSQL COPY
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    table = cursor.db.ops.quote_name(Anonymisation._meta.db_table)
+    columns = ', '.join(ANON_FIELDS + ['release_id'])
+    cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (table, columns), buffer)
+
+def store_anon_database(anon_data, batch_size=None, method=None, k_value=None, watermark="", publish=True):
+    """
+    Stores the anonymised data as a new release of k_value computed at watermark,
+    batch_size records at a time with COPY or bulk_create, see ANONYMISATION_BULK_BATCH_SIZE
+    and ANONYMISATION_BULK_METHOD. The rows are written next to the active release,
+    which readers keep seeing until the new release is published.
+    The release is only committed with all its rows, a failed load leaves no truncated
+    release behind for AnonymisationRelease.cached to return.
+    Returns the release, None if there is no data.
+    """
+    batch_size = batch_size or settings.ANONYMISATION_BULK_BATCH_SIZE
+    method = method or settings.ANONYMISATION_BULK_METHOD
     if anon_data is None:
-        return
-    count = 0
-    for data in anon_data:
-        count += 1
-        anon_instance = Anonymisation(
-            id=count,
-            age=data['age'],
-            gender=data['gender'],
-            postal_code=data['postal_code'],
-            citizenship=data['citizenship'],
-            first_sum=clean_sum(data['first_sum']),
-            second_sum=clean_sum(data['second_sum']),
-            third_sum=clean_sum(data['third_sum']),
-            fourth_sum=clean_sum(data['fourth_sum']),
-            fifth_sum=clean_sum(data['fifth_sum']),
-            first_balance=data['first_balance'],
-            second_balance=data['second_balance'],
-            third_balance=data['third_balance']
-        )
-        anon_instance.save()
-
-def store_stats_database(k_value, info_loss, first_list, second_list, first_utility, second_utility):
+        AnonymisationRelease.objects.all().delete()
+        return None
+    with transaction.atomic(using=Anonymisation.objects.db):
+        release = AnonymisationRelease.objects.create(k_value=k_value, watermark=watermark)
+        anon_data = iter(anon_data)
+        with connections[Anonymisation.objects.db].cursor() as cursor:
+            while True:
+                batch = list(islice(anon_data, batch_size))
+                if not batch:
+                    break
+                rows = anon_rows(batch, release)
+                if method == 'copy':
+                    copy_anon_rows(cursor, rows)
+                else:
+                    fields = ANON_FIELDS + ['release_id']
+                    Anonymisation.objects.bulk_create([Anonymisation(**dict(zip(fields, row))) for row in rows])
+        if publish:
+            release.publish()
+        drop_stale_releases(release)
+    return release
+
+def drop_stale_releases(release):
+    """
+    Drops the inactive releases that can no longer be published: the ones of another
+    watermark and the older ones of the same k value, release is kept
+    """
+    stale = ~Q(watermark=release.watermark) | Q(k_value=release.k_value) | Q(k_value=None)
+    AnonymisationRelease.objects.filter(stale, active=False).exclude(pk=release.pk).delete()
+    Anonymisation.objects.filter(release=None).delete()
+
+def store_stats_database(k_value, info_loss, first_list, second_list, first_utility, second_utility,
+                         info_loss_detail=None, watermark=""):
     anon_instance = Statistics(
         k_value=k_value,
         utility_query1=first_utility,
         utility_query2=second_utility,
         info_loss=info_loss,
+        info_loss_detail=info_loss_detail or {},
         first_average=first_list[0],
         second_average=first_list[1],
         third_average=first_list[2],
@@ -52,6 +111,7 @@ def store_stats_database(k_value, info_loss, first_list, second_list, first_util
         first_balance_average=second_list[0],
         second_balance_average=second_list[1],
         third_balance_average=second_list[2],
-        last_updated=timezone.now()
+        last_updated=timezone.now(),
+        watermark=watermark
     )
-    anon_instance.save()
\ No newline at end of file
+    anon_instance.save()
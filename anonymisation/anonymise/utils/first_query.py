@@ -1,256 +1,137 @@
 import json
-from datetime import datetime, date
-import statistics
+from datetime import datetime
 
-from anonymisation.models import Anonymisation
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.db.models import Avg, Q
 
-from anonymisation.anonymise.utils.requirements import DecimalEncoder
-
-
-def calculate_utility(anon_list, unanon_list):
-    weighted_absolute_differences = list()
-    for anon_avg, actual_avg in zip(anon_list, unanon_list):
-        weighted_absolute_difference = 0
-        if actual_avg != 0:
-            weighted_absolute_difference = abs(anon_avg - actual_avg) / actual_avg
-        weighted_absolute_differences.append(weighted_absolute_difference)
+from customer.models import Accounts, Customer, Transactions
 
-    mean_weighted_absolute_error = sum(weighted_absolute_differences) / len(weighted_absolute_differences)
-    utility = 1 - mean_weighted_absolute_error
-    return max(round(utility * 100, 2), 0)
+from anonymisation.anonymise.utils.requirements import DecimalEncoder
 
+# Average per year of the withdrawal sum of every customer of a citizenship
+WITHDRAWAL_AVERAGES_SQL = """
+SELECT year, AVG(total_amount)
+FROM (
+    SELECT s.user_id, EXTRACT(YEAR FROM t.date AT TIME ZONE %(time_zone)s)::integer AS year,
+           SUM(t.amount) AS total_amount
+    FROM {transactions} t
+    JOIN {accounts} s ON s.account = t.sender_id
+    JOIN {customer} c ON c.user_id = s.user_id
+    WHERE t.transaction_type = %(type)s
+      AND c.citizenship = %(citizenship)s
+      AND EXTRACT(YEAR FROM t.date AT TIME ZONE %(time_zone)s) BETWEEN %(start_year)s AND %(end_year)s
+    GROUP BY s.user_id, year
+) per_customer
+GROUP BY year
+"""
 
-def retrieve_data(citizenship):
-    
-    citizenship_status = citizenship.replace(" ","")
-    query = Anonymisation.objects.filter(citizenship=citizenship_status)
 
-    filtered_data = []
-    for q in query:
-        record = {
-            'age': q.age,
-            'gender': q.gender,
-            'postal_code': q.postal_code,
-            'citizenship': q.citizenship,
-            'first_sum': float(q.first_sum),
-            'second_sum': float(q.second_sum),
-            'third_sum': float(q.third_sum),
-            'fourth_sum': float(q.fourth_sum),
-            'fifth_sum': float(q.fifth_sum),
-            'first_balance': float(q.first_balance),
-            'second_balance': float(q.second_balance),
-            'third_balance': float(q.third_balance)
-        }
-        filtered_data.append(record)
+def calculate_utility(anon_list, unanon_list):
+    """
+    100 minus the mean relative error of the anonymised averages, in percent, a true average
+    of 0 counts as no error. Also works on arrays of several lists of averages, the utility
+    is then computed along the last axis.
+    """
+    anon = np.asarray(anon_list, dtype=np.float64)
+    actual = np.asarray(unanon_list, dtype=np.float64)
+    errors = np.divide(np.abs(anon - actual), actual, out=np.zeros(np.broadcast(anon, actual).shape),
+                       where=actual != 0)
+    utility = 1 - errors.mean(axis=-1)
+    return np.maximum(np.round(utility * 100, 2), 0).tolist()
+
+
+def anonymised_averages(anon_rows, columns, type_of_citizen):
+    """
+    Average of the non-zero values of every column over the anonymised rows of a citizenship,
+    a single AVG aggregate per column. 0 when there is no such value.
+    """
+    averages = anon_rows.filter(citizenship=type_of_citizen).aggregate(
+        **{column: Avg(column, filter=~Q(**{column: 0})) for column in columns})
+    return [float(averages[column] or 0) for column in columns]
 
-    return filtered_data
 
 class FirstQueryBase():
+    columns = ['first_sum', 'second_sum', 'third_sum', 'fourth_sum', 'fifth_sum']
+
     def __init__(self, type_of_citizen, num_years, transaction_type):
         self.type_of_citizen = type_of_citizen
         self.num_years = num_years
         self.transaction_type = transaction_type
 
-
-class AnonymisedFirstQuery(FirstQueryBase):
-    def first_query(self, data):
-        
-        filtered_data = [
-            d for d in data if(
-                d['citizenship'] == self.type_of_citizen
-            )
-        ]
-        
-        sum_data, count_data = self.sum_of_transactions(filtered_data)
-        all_averages = self.average_amount(sum_data, count_data)
-        
-        formatted_data = []
-        results_list = list()
-        
-        current_year = date.today().year
-
-        for i in range(self.num_years):
-            year = current_year - (self.num_years - i) + 1
-            record = {
-                'average_amount': all_averages[i],
-                'year': year
-            }
-            formatted_data.append(record)
-            results_list.append(all_averages[i])
-        json_data = json.dumps(formatted_data, indent=4, cls=DecimalEncoder)
-        return json_data, results_list
-    
-    def sum_of_transactions(self, data):
-        
-        sum_withdrawals = [0,0,0,0,0]
-        count = [0,0,0,0,0]
-        withdrawal_key = ['first_sum', 'second_sum', 'third_sum', 'fourth_sum', 'fifth_sum']
-
-        # Sum of all transactions and total number of transactions
-        for t in data:
-            for i in range(5):
-                key = withdrawal_key[i]
-                if key in t and float(t[key]) != 0:
-                    sum_withdrawals[i] += float(t[key])
-                    count[i] += 1
-        
-        return sum_withdrawals, count
-    
-    def average_amount(self, year_total, num_customers):
-        average_list = list()    
-        # Calculate the average amount of transactions
-        for i in range(5):
-            if year_total[i] != 0:
-                average = year_total[i] / num_customers[i]
-                average_list.append(average)
-            else:
-                average_list.append(0)
-        return average_list
-    
-class UnanonymisedFirstQuery(FirstQueryBase):
-    def first_query(self, raw_data):
-        query = raw_data.filter(
-            sender__user__citizenship=self.type_of_citizen
-        ).order_by('year')
-
-        
+    def years(self):
         current_year = datetime.now().year
+        return [current_year - (self.num_years - i) + 1 for i in range(self.num_years)]
 
-        sum_of_all = [0,0,0,0,0]
-        num_people = [0,0,0,0,0]
-
-        for q in query:
-            year = int(q['year'])
-            index = year - current_year + 4
-            amount = float(q['total_amount'])
-            sum_of_all[index] += amount
-            num_people[index] += 1
+    def format(self, all_averages):
+        formatted_data = [
+            {'average_amount': average, 'year': year} for average, year in zip(all_averages, self.years())
+        ]
+        return json.dumps(formatted_data, indent=4, cls=DecimalEncoder), list(all_averages)
 
-        all_averages = self.average_amount(sum_of_all, num_people)
 
-        formatted_data = []
-        results_list = list()
+class AnonymisedFirstQuery(FirstQueryBase):
+    def first_query(self, anon_rows):
+        """
+        Averages the withdrawal sums of every year over anon_rows, a queryset of Anonymisation
+        """
+        return self.format(anonymised_averages(anon_rows, self.columns, self.type_of_citizen))
 
-        for i in range(self.num_years):
-            year = current_year - (self.num_years - i) + 1
-            record = {
-            'average_amount': all_averages[i],
-            'year': year
-            }
-            formatted_data.append(record)
-            results_list.append(all_averages[i])
-        json_data = json.dumps(formatted_data, indent=4, cls=DecimalEncoder)
-        return json_data, results_list
-    
-    def average_amount(self, total, num_people):    
 
-        averages = list()
+class UnanonymisedFirstQuery(FirstQueryBase):
+    def first_query(self):
+        """
+        Averages the withdrawal sums of every year over the source data, see WITHDRAWAL_AVERAGES_SQL
+        """
+        years = self.years()
+        sql = WITHDRAWAL_AVERAGES_SQL.format(
+            customer=connection.ops.quote_name(Customer._meta.db_table),
+            accounts=connection.ops.quote_name(Accounts._meta.db_table),
+            transactions=connection.ops.quote_name(Transactions._meta.db_table),
+        )
+        params = {
+            'time_zone': settings.TIME_ZONE,
+            'type': self.transaction_type,
+            'citizenship': self.type_of_citizen,
+            'start_year': years[0],
+            'end_year': years[-1],
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            averages = dict(cursor.fetchall())
+        return self.format([float(averages.get(year) or 0) for year in years])
 
-        for i in range(5):
-            if total[i] != 0:
-                avg = total[i] / num_people[i]
-                averages.append(avg)
-            else:
-                averages.append(0)
-        return averages
 
 class SecondQueryBase():
+    columns = ['first_balance', 'second_balance', 'third_balance']
+    account_types = [1, 2, 3]
+
     def __init__(self, type_of_citizen):
         self.type_of_citizen = type_of_citizen
 
-class AnonymisedSecondQuery(SecondQueryBase):
-    def second_query(self, data):
-        
-        filtered_data = [
-            d for d in data if(
-                d['citizenship'] == self.type_of_citizen
-            )
+    def format(self, all_averages):
+        formatted_data = [
+            {'average_amount': average, 'account_type': account_type}
+            for average, account_type in zip(all_averages, self.account_types)
         ]
+        return json.dumps(formatted_data, indent=4, cls=DecimalEncoder), list(all_averages)
 
-        sum_data, count_data = self.sum_of_transactions(filtered_data)
-        all_averages = self.average_amount(sum_data, count_data)
-
-        formatted_data = []
-        results_list = list()
-        
-        for i in range(3):
-            account_type = i + 1
-            record = {
-                'average_amount': all_averages[i],
-                'account_type': account_type
-            }
-            formatted_data.append(record)
-            results_list.append(all_averages[i])
-        json_data = json.dumps(formatted_data, indent=4, cls=DecimalEncoder)
-        
-        return json_data, results_list
 
-    def sum_of_transactions(self, data):
-    
-        sum_balance = [0,0,0]
-        count = [0,0,0]
-        withdrawal_key = ['first_balance', 'second_balance', 'third_balance']
+class AnonymisedSecondQuery(SecondQueryBase):
+    def second_query(self, anon_rows):
+        """
+        Averages the balances of every account type over anon_rows, a queryset of Anonymisation
+        """
+        return self.format(anonymised_averages(anon_rows, self.columns, self.type_of_citizen))
 
-        # Sum of all transactions and total number of transactions
-        for t in data:
-            for i in range(3):
-                key = withdrawal_key[i]
-                if key in t and float(t[key]) != 0:
-                    sum_balance[i] += float(t[key])
-                    count[i] += 1
-        
-        return sum_balance, count
-    
-    def average_amount(self, year_total, num_customers):
-        average_list = list()    
-        # Calculate the average amount of transactions
-        for i in range(3):
-            if year_total[i] != 0:
-                average = year_total[i] / num_customers[i]
-                average_list.append(average)
-            else:
-                average_list.append(0)
-        return average_list
 
 class UnanonymisedSecondQuery(SecondQueryBase):
-    def second_query(self, raw_data):
-        query = raw_data.filter(
-            user__citizenship=self.type_of_citizen
-        ).order_by('type')
-
-        sum_of_all = [0,0,0]
-        num_people = [0,0,0]
-
-        for q in query:
-            index = int(q['type'])
-            amount = float(q['balance'])
-            sum_of_all[index-1] += amount
-            num_people[index-1] += 1
-        
-        all_averages = self.average_amount(sum_of_all, num_people)
-
-        formatted_data = []
-        results_list = list()
-
-        for i in range(3):
-            record = {
-            'average_amount': all_averages[i],
-            'account_type': i+1
-            }
-            formatted_data.append(record)
-            results_list.append(all_averages[i])
-        
-        json_data = json.dumps(formatted_data, indent=4, cls=DecimalEncoder)
-        return json_data, results_list
-    
-    def average_amount(self, total, num_people):    
-
-        averages = list()
-
-        for i in range(3):
-            if total[i] != 0:
-                avg = total[i] / num_people[i]
-                averages.append(avg)
-            else:
-                averages.append(0)
-        return averages
+    def second_query(self):
+        """
+        Averages the balance of the accounts of every type over the source data, GROUP BY type
+        """
+        query = Accounts.objects.filter(user__citizenship=self.type_of_citizen).values('type').order_by('type').annotate(
+            average=Avg('balance'))
+        averages = {row['type']: row['average'] for row in query}
+        return self.format([float(averages.get(account_type) or 0) for account_type in self.account_types])
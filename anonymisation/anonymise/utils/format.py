@@ -2,6 +2,7 @@ import json
 
 from datetime import datetime
 
+from anonymisation.anonymise.utils.hierarchy import AGE_INDEX, POSTAL_CODE_INDEX, qi_hierarchies
 from anonymisation.anonymise.utils.requirements import DecimalEncoder
     
 class AnonymisedDataFormatterBase:
@@ -27,12 +28,24 @@ class AnonymisedDataFormatterBase:
         return formatted_string
     
     def format_anon_data(self, anon_data):
+        """
+        The age and postal code are leaves of their hierarchies when they have one, they are
+        published with the labels of the leaves, see hierarchy.py
+        """
+        hierarchies = qi_hierarchies()
+        age_hierarchy = hierarchies.get(AGE_INDEX)
+        postal_code_hierarchy = hierarchies.get(POSTAL_CODE_INDEX)
 
         for d in anon_data:
+            if age_hierarchy is not None:
+                d['age'] = age_hierarchy.publish(d['age'])
             age_range = self.format_attributes(d['age'])
             gender_range = self.format_attributes(d['gender'])
-            postal_code_range = self.format_attributes(d['postal_code'])
-            anon_postal_code = self.anonymise_postal_code(postal_code_range)
+            if postal_code_hierarchy is not None:
+                anon_postal_code = self.format_attributes(postal_code_hierarchy.publish(d['postal_code']))
+            else:
+                postal_code_range = self.format_attributes(d['postal_code'])
+                anon_postal_code = self.anonymise_postal_code(postal_code_range)
             citizenship = self.format_attributes(d['citizenship'])
             spaced_citizenship = self.format_citizenship(citizenship)
 
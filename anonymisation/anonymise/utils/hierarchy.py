@@ -0,0 +1,124 @@
+"""
+Precomputed generalisation hierarchies of the numeric QIs
+
+Instead of the raw age and 6-digit postal code, Mondrian partitions the leaves of a
+hierarchy: age bands of ANONYMISATION_AGE_BAND_WIDTH years and postal sectors (the first
+two digits) or districts, see ANONYMISATION_POSTAL_HIERARCHY. The leaves are numbered in
+order and their lookup tables are built once, so encoding a record is an array lookup.
+The domains are a few dozen values instead of up to a million, which makes the splits and
+the NCP cheaper, and a generalised range of leaves is published with the labels of its
+ends, which is what we release anyway.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+
+from anonymisation.anonymise.utils.read_data import ATT_NAME
+
+AGE_INDEX = ATT_NAME.index('sender_age')
+POSTAL_CODE_INDEX = ATT_NAME.index('sender_postal_code')
+MAX_AGE = 120
+POSTAL_CODE_SECTOR = 10000
+# Sectors of every postal district of Singapore, in the order of the districts
+POSTAL_DISTRICTS = [
+    [1, 2, 3, 4, 5, 6], [7, 8], [14, 15, 16], [9, 10], [11, 12, 13], [17], [18, 19], [20, 21], [22, 23],
+    [24, 25, 26, 27], [28, 29, 30], [31, 32, 33], [34, 35, 36, 37], [38, 39, 40, 41], [42, 43, 44, 45],
+    [46, 47, 48], [49, 50, 81], [51, 52], [53, 54, 55, 82], [56, 57], [58, 59], [60, 61, 62, 63, 64],
+    [65, 66, 67, 68], [69, 70, 71], [72, 73], [77, 78], [75, 76], [79, 80],
+]
+
+
+class Hierarchy(object):
+
+    """
+    Generalisation of a numeric QI into ordered leaves
+    self.codes: leaf of every value // self.scale, values out of the table take the nearest end
+    self.labels: (label of the lower end, label of the upper end) of every leaf
+    """
+
+    def __init__(self, codes, labels, scale=1):
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.labels = labels
+        self.scale = scale
+
+    def encode(self, value):
+        return int(self.codes[min(max(int(value) // self.scale, 0), len(self.codes) - 1)])
+
+    def encode_array(self, values):
+        return self.codes[np.clip(np.asarray(values, dtype=np.int64) // self.scale, 0, len(self.codes) - 1)]
+
+    def publish(self, generalized, connect_str='~'):
+        """
+        Labels of a generalised range of leaves, "low~high" or a single leaf
+        """
+        codes = [int(code) for code in str(generalized).split(connect_str)]
+        low, high = self.labels[codes[0]][0], self.labels[codes[-1]][1]
+        return low if low == high else low + connect_str + high
+
+
+@lru_cache(maxsize=None)
+def age_bands(width):
+    codes = [age // width for age in range(MAX_AGE + 1)]
+    labels = [(str(band * width), str(min(band * width + width - 1, MAX_AGE))) for band in range(codes[-1] + 1)]
+    return Hierarchy(codes, labels)
+
+
+@lru_cache(maxsize=None)
+def postal_sectors():
+    labels = [("%02d****" % sector,) * 2 for sector in range(100)]
+    return Hierarchy(range(100), labels, POSTAL_CODE_SECTOR)
+
+
+@lru_cache(maxsize=None)
+def postal_districts():
+    """
+    Sectors that are in no district form a last leaf of their own
+    """
+    codes = [len(POSTAL_DISTRICTS)] * 100
+    for district, sectors in enumerate(POSTAL_DISTRICTS):
+        for sector in sectors:
+            codes[sector] = district
+    labels = [("D%02d" % (district + 1),) * 2 for district in range(len(POSTAL_DISTRICTS))] + [("D??",) * 2]
+    return Hierarchy(codes, labels, POSTAL_CODE_SECTOR)
+
+
+POSTAL_HIERARCHIES = {
+    "sector": postal_sectors,
+    "district": postal_districts,
+}
+
+
+def qi_hierarchies():
+    """
+    Returns {index in ATT_NAME: Hierarchy} of the configured hierarchies, QIs without one
+    are partitioned on their raw values
+    """
+    hierarchies = {}
+    if settings.ANONYMISATION_AGE_BAND_WIDTH:
+        hierarchies[AGE_INDEX] = age_bands(settings.ANONYMISATION_AGE_BAND_WIDTH)
+    if settings.ANONYMISATION_POSTAL_HIERARCHY in POSTAL_HIERARCHIES:
+        hierarchies[POSTAL_CODE_INDEX] = POSTAL_HIERARCHIES[settings.ANONYMISATION_POSTAL_HIERARCHY]()
+    return hierarchies
+
+
+def domain_key():
+    """
+    Identifies the configured domains, anonymised data of other domains cannot be reused
+    """
+    return (settings.ANONYMISATION_AGE_BAND_WIDTH, settings.ANONYMISATION_POSTAL_HIERARCHY)
+
+
+def encode_records(records):
+    """
+    Typed records (see WithdrawalRetriever.records) with the QIs that have a hierarchy
+    replaced by their leaf
+    """
+    hierarchies = qi_hierarchies()
+    if not hierarchies or not records:
+        return records
+    columns = list(zip(*records))
+    for index, hierarchy in hierarchies.items():
+        columns[index] = hierarchy.encode_array(columns[index]).tolist()
+    return list(zip(*columns))
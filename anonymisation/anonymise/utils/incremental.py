@@ -0,0 +1,386 @@
+"""
+Incremental maintenance of a strict Mondrian partitioning
+
+The split tree of the last run is kept with the QI tuples of every leaf. New, changed and
+removed customers are routed to their leaf and only the leaves that changed too much are
+partitioned again:
+- a leaf that reaches 2k records is split again with strict Mondrian
+- a leaf that falls below k records is merged with its sibling subtree, going up the
+  tree until the merged partition has k records, and that partition is split again
+Every leaf keeps at least k records, so the partitioning stays k-anonymous, and the work
+is proportional to the changed records and the leaves they fall in.
+Like the sweep engines, a node has the Mondrian box of its splits rather than the bounding
+box of its records, and widths are normalised over the domain of the current records, so a
+tree built from scratch has the partitions, generalisations and NCP of a strict run.
+The tree only depends on the QIs: a change of the sums or balances of a customer does not
+touch it.
+"""
+
+from bisect import bisect_left
+from collections import Counter
+from itertools import accumulate
+
+import numpy as np
+
+from anonymisation.anonymise.utils.read_data import IS_CAT, QI_INDEX
+from anonymisation.anonymise.utils.utility import information_loss, merge_qi_value, normalized_width, rank_values
+
+
+class Node(object):
+
+    """
+    Node of the split tree
+    self.dim, self.split: records whose code on dim is <= split are under self.lhs,
+    the others under self.rhs. dim is None for a leaf
+    self.count: number of records of every QI tuple, only for a leaf
+    self.size: number of records under the node
+    self.low, self.high: Mondrian box of the node, the box of its parent narrowed by the split
+    and by the QIs the node tried to split on, it always holds the QI tuples of a leaf
+    self.removed: set once the node was merged into an ancestor
+    """
+
+    def __init__(self, parent=None, count=None):
+        self.parent = parent
+        self.dim = None
+        self.split = None
+        self.lhs = None
+        self.rhs = None
+        self.count = Counter() if count is None else count
+        self.size = sum(self.count.values())
+        self.low = None
+        self.high = None
+        self.removed = False
+
+    def is_leaf(self):
+        return self.dim is None
+
+    def widen_box(self):
+        """
+        Widens the box to hold the QI tuples of the node, e.g. new records of a leaf
+        """
+        if not self.count:
+            return
+        columns = list(zip(*self.count))
+        if self.low is None:
+            self.low = [min(column) for column in columns]
+            self.high = [max(column) for column in columns]
+            return
+        self.low = [min([low] + list(column)) for low, column in zip(self.low, columns)]
+        self.high = [max([high] + list(column)) for high, column in zip(self.high, columns)]
+
+
+class IncrementalMondrian(object):
+
+    """
+    Strict Mondrian partitioning of the QIs of the typed records (see
+    WithdrawalRetriever.records), kept up to date by update
+    self.count: number of records of every QI tuple
+    self.categories: categorical values of every QI in order of first appearance, their
+    codes stay the same across updates
+    self.domain: sorted codes of every QI among the current records, set by update
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.qi_len = len(QI_INDEX)
+        self.root = Node()
+        self.count = Counter()
+        self.categories = [[] for _ in range(self.qi_len)]
+        self.category_code = [dict() for _ in range(self.qi_len)]
+        self.domain = [[] for _ in range(self.qi_len)]
+        self.dirty = set()
+
+    def encode(self, record):
+        """
+        QI tuple of a typed record, categories are coded without spaces like read_records
+        """
+        codes = []
+        for i in range(self.qi_len):
+            qi_value = record[QI_INDEX[i]]
+            if IS_CAT[i]:
+                category = str(qi_value).replace(' ', '')
+                try:
+                    codes.append(self.category_code[i][category])
+                except KeyError:
+                    self.category_code[i][category] = len(self.categories[i])
+                    codes.append(len(self.categories[i]))
+                    self.categories[i].append(category)
+            else:
+                codes.append(int(qi_value))
+        return tuple(codes)
+
+    def update(self, records):
+        """
+        Brings the tree to the current records and rebalances it.
+        Returns the leaves that were created or changed.
+        """
+        current = Counter(map(self.encode, records))
+        for qi, number in (self.count - current).items():
+            self.remove(qi, number)
+        for qi, number in (current - self.count).items():
+            self.insert(qi, number)
+        self.domain = [sorted({qi[i] for qi in self.count}) for i in range(self.qi_len)]
+        return self.rebalance()
+
+    def find_leaf(self, qi, number=0):
+        """
+        Returns the leaf of qi, adding number to the size of every node on the way
+        """
+        node = self.root
+        node.size += number
+        while not node.is_leaf():
+            node = node.lhs if qi[node.dim] <= node.split else node.rhs
+            node.size += number
+        return node
+
+    def insert(self, qi, number=1):
+        leaf = self.find_leaf(qi, number)
+        leaf.count[qi] += number
+        self.count[qi] += number
+        self.dirty.add(leaf)
+
+    def remove(self, qi, number=1):
+        leaf = self.find_leaf(qi, -number)
+        leaf.count[qi] -= number
+        if leaf.count[qi] <= 0:
+            del leaf.count[qi]
+        self.count[qi] -= number
+        if self.count[qi] <= 0:
+            del self.count[qi]
+        self.dirty.add(leaf)
+
+    def rebalance(self):
+        """
+        Splits the dirty leaves of 2k records or more and merges the ones under k records
+        """
+        changed = []
+        for leaf in list(self.dirty):
+            if leaf.removed or not leaf.is_leaf():
+                continue
+            if leaf.size < self.k:
+                node = leaf
+                while node.size < self.k and node.parent is not None:
+                    node = node.parent
+                self.collapse(node)
+                changed.extend(self.split(node))
+            elif leaf.size >= 2 * self.k:
+                changed.extend(self.split(leaf))
+            else:
+                leaf.widen_box()
+                changed.append(leaf)
+        self.dirty.clear()
+        return [leaf for leaf in changed if leaf.is_leaf() and not leaf.removed]
+
+    def collapse(self, node):
+        """
+        Turns the subtree of node back into a single leaf
+        """
+        count = Counter()
+        stack = [node]
+        while stack:
+            descendant = stack.pop()
+            if descendant.is_leaf():
+                count.update(descendant.count)
+            else:
+                stack.extend((descendant.lhs, descendant.rhs))
+            if descendant is not node:
+                descendant.removed = True
+        node.dim = node.split = node.lhs = node.rhs = None
+        node.count = count
+
+    def normalized_width(self, node, dim):
+        """
+        Normalized width of the box of node on dim over the domain, like utility.normalized_width
+        """
+        domain = self.domain[dim]
+        extent = domain[-1] - domain[0]
+        width = min(node.high[dim], domain[-1]) - max(node.low[dim], domain[0])
+        if width == extent:
+            return 1.0
+        return width * 1.0 / extent
+
+    def find_median(self, node, dim):
+        """
+        Returns (split, next) codes of dim that split the records of node in two halves, the
+        box of node is narrowed to its records on dim. None when the node cannot be split on
+        dim, like MondrianEngine.find_median
+        """
+        frequency = Counter()
+        for qi, number in node.count.items():
+            frequency[qi[dim]] += number
+        present = sorted(frequency)
+        prefix = list(accumulate(map(frequency.__getitem__, present)))
+        middle = prefix[-1] // 2
+        if middle < self.k or len(present) <= 1:
+            return None
+        split_index = bisect_left(prefix, middle)
+        if split_index == len(present) - 1:
+            return None
+        node.low[dim], node.high[dim] = present[0], present[-1]
+        return present[split_index], present[split_index + 1]
+
+    def split(self, node):
+        """
+        Strict Mondrian on the records of a leaf, returns the resulting leaves
+        """
+        leaves = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node.widen_box()
+            if node.size < 2 * self.k:
+                leaves.append(node)
+                continue
+            allow = [True] * self.qi_len
+            while any(allow):
+                dim = max((i for i in range(self.qi_len) if allow[i]),
+                          key=lambda i: (self.normalized_width(node, i), -i))
+                median = self.find_median(node, dim)
+                if median is None:
+                    allow[dim] = False
+                    continue
+                split, next_code = median
+                lhs = Node(node, Counter({qi: number for qi, number in node.count.items() if qi[dim] <= split}))
+                rhs = Node(node, Counter({qi: number for qi, number in node.count.items() if qi[dim] > split}))
+                if lhs.size < self.k or rhs.size < self.k:
+                    allow[dim] = False
+                    continue
+                lhs.low, lhs.high = list(node.low), list(node.high)
+                rhs.low, rhs.high = list(node.low), list(node.high)
+                lhs.high[dim] = split
+                rhs.low[dim] = next_code
+                node.dim, node.split, node.lhs, node.rhs = dim, split, lhs, rhs
+                node.count = Counter()
+                stack.append(rhs)
+                stack.append(lhs)
+                break
+            else:
+                leaves.append(node)
+        return leaves
+
+    def to_json(self):
+        """
+        The tree as plain data, the nodes in depth-first order: [dim, split, low, high] for a
+        split node, [None, None, low, high, [[*QI tuple, number], ...]] for a leaf
+        """
+        nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.is_leaf():
+                nodes.append([None, None, node.low, node.high, [list(qi) + [number] for qi, number in node.count.items()]])
+            else:
+                nodes.append([node.dim, node.split, node.low, node.high])
+                stack.extend((node.rhs, node.lhs))
+        return {
+            "k": self.k,
+            "domains": list(getattr(self, "domains", None) or []),
+            "categories": self.categories,
+            "nodes": nodes,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Rebuilds a tree of to_json
+        """
+        tree = cls(data["k"])
+        tree.domains = tuple(data["domains"])
+        tree.categories = [list(categories) for categories in data["categories"]]
+        tree.category_code = [{category: code for code, category in enumerate(categories)}
+                              for categories in tree.categories]
+        # (parent, whether the node is its lhs) of the nodes still to read
+        pending = [(None, False)]
+        for entry in data["nodes"]:
+            parent, is_lhs = pending.pop()
+            dim, split, low, high = entry[:4]
+            if dim is None:
+                node = Node(parent, Counter({tuple(qi[:-1]): qi[-1] for qi in entry[4]}))
+                tree.count.update(node.count)
+            else:
+                node = Node(parent)
+                node.dim, node.split = dim, split
+                pending.extend(((node, False), (node, True)))
+            node.low = None if low is None else list(low)
+            node.high = None if high is None else list(high)
+            if parent is None:
+                tree.root = node
+            elif is_lhs:
+                parent.lhs = node
+            else:
+                parent.rhs = node
+        for node in reversed(list(tree.nodes())):
+            if not node.is_leaf():
+                node.size = node.lhs.size + node.rhs.size
+        tree.domain = [sorted({qi[i] for qi in tree.count}) for i in range(tree.qi_len)]
+        return tree
+
+    def nodes(self):
+        """
+        Every node in depth-first order, parents first
+        """
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            if not node.is_leaf():
+                stack.extend((node.rhs, node.lhs))
+
+    def leaves(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.is_leaf():
+                yield node
+            else:
+                stack.extend((node.rhs, node.lhs))
+
+    def generalize(self, leaf):
+        """
+        Generalised QI values of a leaf, categories are written out like covert_to_raw
+        """
+        generalized = []
+        for i in range(self.qi_len):
+            if IS_CAT[i]:
+                generalized.append('~'.join(self.categories[i][leaf.low[i]:leaf.high[i] + 1]))
+            else:
+                generalized.append(merge_qi_value(leaf.low[i], leaf.high[i]))
+        return generalized
+
+    def generalization(self):
+        """
+        Returns the generalised QI values of every QI tuple
+        """
+        result = {}
+        for leaf in self.leaves():
+            generalized = self.generalize(leaf)
+            for qi in leaf.count:
+                result[qi] = generalized
+        return result
+
+    def information_loss(self):
+        """
+        (NCP, NCP of every QI, NCP of every leaf), in percentage, like MondrianEngine.information_loss.
+        The boxes are ranked in the domain of the current records, like the sweep engines rank
+        the partitions, a box reaching out of the domain is cut at its ends.
+        """
+        leaves = list(self.leaves())
+        if not self.root.size:
+            return information_loss(np.zeros((0, self.qi_len)), [])
+        low = np.array([leaf.low for leaf in leaves], dtype=np.int64)
+        high = np.array([leaf.high for leaf in leaves], dtype=np.int64)
+        low_rank = np.empty_like(low)
+        high_rank = np.empty_like(high)
+        for i, domain in enumerate(self.domain):
+            low_rank[:, i] = np.clip(np.searchsorted(domain, low[:, i], side='left'), 0, len(domain) - 1)
+            high_rank[:, i] = np.clip(np.searchsorted(domain, high[:, i], side='right') - 1, 0, len(domain) - 1)
+        rank_value = rank_values(self.domain)
+        qi_range = np.array([domain[-1] - domain[0] for domain in self.domain], dtype=np.float64)
+        norm_width = normalized_width(rank_value, qi_range, low_rank, high_rank)
+        return information_loss(norm_width, [leaf.size for leaf in leaves])
+
+    def ncp(self):
+        """
+        Normalized certainty penalty of the leaves, in percent
+        """
+        return self.information_loss()[0]
@@ -24,35 +24,39 @@ main module of mondrian
 
 import pdb
 import time
-from anonymisation.anonymise.utils.utility import cmp_value, value, merge_qi_value
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
 from functools import cmp_to_key
+from itertools import accumulate
 
-# warning all these variables should be re-inited, if
-# you want to run mondrian with different parameters
-__DEBUG = False
-QI_LEN = 10
-GL_K = 0
-RESULT = []
-QI_RANGE = []
-QI_DICT = []
-QI_ORDER = []
+import numpy as np
+
+from anonymisation.anonymise.utils.utility import (cmp_value, information_loss, merge_qi_value, normalized_width,
+                                                   rank_values, value)
+
+_DEBUG = False
 
 
 class Partition(object):
 
     """
     Class for Group (or EC), which is used to keep records
-    self.member: records in group
+    self.member: indices of the records in group (array of C ints), see MondrianEngine.qi_rank
     self.low: lower point, use index to avoid negative values
     self.high: higher point, use index to avoid negative values
     self.allow: show if partition can be split on this QI
+    Slotted, a partition only holds these four small arrays
     """
 
+    __slots__ = ('low', 'high', 'member', 'allow')
+
     def __init__(self, data, low, high):
-        self.low = list(low)
-        self.high = list(high)
-        self.member = data[:]
-        self.allow = [1] * QI_LEN
+        self.low = array('i', low)
+        self.high = array('i', high)
+        # an array of indices is taken over as it is, splits always build new ones
+        self.member = data if isinstance(data, array) else array('i', data)
+        self.allow = array('b', [1]) * len(self.low)
 
     def add_record(self, record, _):
         """
@@ -64,8 +68,7 @@ class Partition(object):
         """
         add multiple records (list) to partition
         """
-        for record in records:
-            self.add_record(record, dim)
+        self.member.extend(records)
 
     def __len__(self):
         """
@@ -74,237 +77,314 @@ class Partition(object):
         return len(self.member)
 
 
-def get_normalized_width(partition, index):
+def rank_prefix(ranks, member, low, high):
     """
-    return Normalized width of partition
-    similar to NCP
+    Count the ranks of member, return (counted ranks, prefix sums of their counts)
+    Counts go in a list over [low, high] when that range is not wider than the
+    partition, otherwise only the ranks present are counted and sorted.
     """
-    d_order = QI_ORDER[index]
-    width = value(d_order[partition.high[index]]) - value(d_order[partition.low[index]])
-    if width == QI_RANGE[index]:
-        return 1
-    return width * 1.0 / QI_RANGE[index]
+    if high - low < len(member):
+        counts = [0] * (high - low + 1)
+        for rank in map(ranks.__getitem__, member):
+            counts[rank - low] += 1
+        return range(low, high + 1), list(accumulate(counts))
+    frequency = Counter(map(ranks.__getitem__, member))
+    present = sorted(frequency)
+    return present, list(accumulate(map(frequency.__getitem__, present)))
 
 
-def choose_dimension(partition):
-    """
-    choose dim with largest norm_width from all attributes.
-    This function can be upgraded with other distance function.
-    """
-    max_width = -1
-    max_dim = -1
-    for dim in range(QI_LEN):
-        if partition.allow[dim] == 0:
-            continue
-        norm_width = get_normalized_width(partition, dim)
-        if norm_width > max_width:
-            max_width = norm_width
-            max_dim = dim
-    if max_width > 1:
-        pdb.set_trace()
-    return max_dim
-
-
-def frequency_set(partition, dim):
+class MondrianEngine(object):
+
     """
-    get the frequency_set of partition on dim
+    State of one mondrian run, kept per instance so that several runs
+    (different k, concurrent requests, pool workers) never share it
+    self.k: k parameter for k-anonymity
+    self.result: partitions found by the last run
+    self.qi_len: number of QI columns
+    self.qi_dict: value -> index in the sorted domain, for every QI
+    self.qi_order: sorted domain of every QI
+    self.qi_range: numeric range of every QI
+    self.qi_value: numeric value of every index of qi_order
+    self.qi_rank: index in qi_order of every record, for every QI
     """
-    frequency = {}
-    for record in partition.member:
-        try:
-            frequency[record[dim]] += 1
-        except KeyError:
-            frequency[record[dim]] = 1
-    return frequency
 
+    def __init__(self, data, k, qi_num=-1):
+        if qi_num <= 0:
+            self.qi_len = len(data[0]) - 1
+        else:
+            self.qi_len = qi_num
+        self.data = data
+        self.k = k
+        self.result = []
+        # static values
+        self.qi_dict = []
+        self.qi_order = []
+        self.qi_range = []
+        self.qi_value = []
+        # numeric values of qi_order as a matrix, built by information_loss
+        self.rank_value = None
+        att_values = []
+        for i in range(self.qi_len):
+            att_values.append(set())
+            self.qi_dict.append(dict())
+        for record in data:
+            for i in range(self.qi_len):
+                att_values[i].add(record[i])
+        for i in range(self.qi_len):
+            value_list = list(att_values[i])
+            value_list.sort(key=cmp_to_key(cmp_value))
+            self.qi_range.append(value(value_list[-1]) - value(value_list[0]))
+            self.qi_order.append(list(value_list))
+            self.qi_value.append([value(qi_value) for qi_value in value_list])
+            for index, qi_value in enumerate(value_list):
+                self.qi_dict[i][qi_value] = index
+        # the engine only works on these ranks, the QI values are only read again
+        # to generalise the records in anonymize
+        self.qi_rank = [[self.qi_dict[i][record[i]] for record in data] for i in range(self.qi_len)]
 
-def find_median(partition, dim):
-    """
-    find the middle of the partition, return split_val
-    """
-    # use frequency set to get median
-    frequency = frequency_set(partition, dim)
-    split_val = ''
-    next_val = ''
-    value_list = list(frequency.keys())
-    value_list.sort(key=cmp_to_key(cmp_value))
-    total = sum(frequency.values())
-    middle = total // 2
-    if middle < GL_K or len(value_list) <= 1:
-        try:
-            return '', '', value_list[0], value_list[-1]
-        except IndexError:
-            return '', '', '', ''
-    index = 0
-    split_index = 0
-    for i, qi_value in enumerate(value_list):
-        index += frequency[qi_value]
-        if index >= middle:
-            split_val = qi_value
-            split_index = i
-            break
-    else:
-        print("Error: cannot find split_val")
-    try:
-        next_val = value_list[split_index + 1]
-    except IndexError:
+    def get_normalized_width(self, partition, index):
+        """
+        return Normalized width of partition
+        similar to NCP
+        """
+        d_value = self.qi_value[index]
+        width = d_value[partition.high[index]] - d_value[partition.low[index]]
+        if width == self.qi_range[index]:
+            return 1
+        return width * 1.0 / self.qi_range[index]
+
+    def choose_dimension(self, partition):
+        """
+        choose dim with largest norm_width from all attributes.
+        This function can be upgraded with other distance function.
+        """
+        max_width = -1
+        max_dim = -1
+        for dim in range(self.qi_len):
+            if partition.allow[dim] == 0:
+                continue
+            norm_width = self.get_normalized_width(partition, dim)
+            if norm_width > max_width:
+                max_width = norm_width
+                max_dim = dim
+        if max_width > 1:
+            pdb.set_trace()
+        return max_dim
+
+    def find_median(self, partition, dim):
+        """
+        find the middle of the partition on the ranks of dim,
+        return (split_rank, next_rank, low_rank, high_rank), None when not found
+        """
+        if not partition.member:
+            return None, None, None, None
+        # use a prefix sum of the rank counts to get median
+        ranks = self.qi_rank[dim]
+        present, prefix = rank_prefix(ranks, partition.member, partition.low[dim], partition.high[dim])
+        total = prefix[-1]
+        # ranks in [low, high] may be absent from the partition
+        first = bisect_right(prefix, 0)
+        last = bisect_left(prefix, total)
+        middle = total // 2
+        if middle < self.k or first == last:
+            return None, None, present[first], present[last]
+        split_index = bisect_left(prefix, middle)
+        # next rank present in the partition, split rank itself if there is none
         # there is a frequency value in partition
         # which can be handle by mid_set
         # e.g.[1, 2, 3, 4, 4, 4, 4]
-        next_val = split_val
-    return (split_val, next_val, value_list[0], value_list[-1])
-
-def split_partition(partition, dim):
-    (split_val, next_val, low, high) = find_median(partition, dim)
-        # Update parent low and high
-    if split_val == '' or split_val == next_val:
-        # cannot split
-        partition.allow[dim] = 0
-        return None
-    
-    if low != '':
-        partition.low[dim] = QI_DICT[dim][low]
-        partition.high[dim] = QI_DICT[dim][high]
-    
-    # split the group from median
-    mean = QI_DICT[dim][split_val]
-    lhs_high = partition.high[:]
-    rhs_low = partition.low[:]
-    lhs_high[dim] = mean
-    rhs_low[dim] = QI_DICT[dim][next_val]
-    lhs = Partition([], partition.low, lhs_high)
-    rhs = Partition([], rhs_low, partition.high)
-    for record in partition.member:
-        pos = QI_DICT[dim][record[dim]]
-        if pos <= mean:
-            lhs.add_record(record, dim)
-        else:
-            rhs.add_record(record, dim)
-    return lhs, rhs
+        next_index = min(bisect_right(prefix, prefix[split_index]), last)
+        return present[split_index], present[next_index], present[first], present[last]
 
-def anonymize_strict(partition):
-    """
-    recursively partition groups until not allowable
-    """
-    allow_count = sum(partition.allow)
-    # only run allow_count times
-    if allow_count == 0:
-        RESULT.append(partition)
-        return
-    for _ in range(allow_count):
-        # choose attrubite from domain
-        dim = choose_dimension(partition)
-        if dim == -1:
-            print("Error: dim=-1")
-            pdb.set_trace()
-        split_result = split_partition(partition, dim)
-        if split_result is None:
+    def split_partition(self, partition, dim):
+        (mean, next_rank, low, high) = self.find_median(partition, dim)
+            # Update parent low and high
+        if mean is None or mean == next_rank:
+            # cannot split
             partition.allow[dim] = 0
-            continue
-        lhs, rhs = split_result
-        # check is lhs and rhs satisfy k-anonymity
-        if len(lhs) < GL_K or len(rhs) < GL_K:
+            return None
+
+        partition.low[dim] = low
+        partition.high[dim] = high
+
+        # split the group from median
+        lhs_high = partition.high[:]
+        rhs_low = partition.low[:]
+        lhs_high[dim] = mean
+        rhs_low[dim] = next_rank
+        lhs = Partition(array('i'), partition.low, lhs_high)
+        rhs = Partition(array('i'), rhs_low, partition.high)
+        ranks = self.qi_rank[dim]
+        lhs_append = lhs.member.append
+        rhs_append = rhs.member.append
+        for record in partition.member:
+            if ranks[record] <= mean:
+                lhs_append(record)
+            else:
+                rhs_append(record)
+        return lhs, rhs
+
+    def anonymize_strict(self, partition):
+        """
+        partition groups until not allowable
+        A stack of pending partitions replaces the recursion, lhs is pushed last so
+        partitions are visited (and appended to result) in the same depth-first order
+        """
+        stack = [partition]
+        while stack:
+            partition = stack.pop()
+            allow_count = sum(partition.allow)
+            # only run allow_count times
+            for _ in range(allow_count):
+                # choose attrubite from domain
+                dim = self.choose_dimension(partition)
+                if dim == -1:
+                    print("Error: dim=-1")
+                    pdb.set_trace()
+                split_result = self.split_partition(partition, dim)
+                if split_result is None:
+                    partition.allow[dim] = 0
+                    continue
+                lhs, rhs = split_result
+                # check is lhs and rhs satisfy k-anonymity
+                if len(lhs) < self.k or len(rhs) < self.k:
+                    partition.allow[dim] = 0
+                    continue
+                # anonymize sub-partition
+                stack.append(rhs)
+                stack.append(lhs)
+                break
+            else:
+                self.result.append(partition)
+
+    def split_partition_relaxed(self, partition, dim):
+        (mean, next_rank, low, high) = self.find_median(partition, dim)
+        # Update parent low and high
+        if low is not None:
+            partition.low[dim] = low
+            partition.high[dim] = high
+        if mean is None:
+            # cannot split
             partition.allow[dim] = 0
-            continue
-        # anonymize sub-partition
-        anonymize_strict(lhs)
-        anonymize_strict(rhs)
-        return
-    RESULT.append(partition)
+            return None
+        # split the group from median
+        lhs_high = partition.high[:]
+        rhs_low = partition.low[:]
+        lhs_high[dim] = mean
+        rhs_low[dim] = next_rank
+        lhs = Partition(array('i'), partition.low, lhs_high)
+        rhs = Partition(array('i'), rhs_low, partition.high)
+        mid_set = array('i')
+        ranks = self.qi_rank[dim]
+        lhs_append = lhs.member.append
+        rhs_append = rhs.member.append
+        mid_append = mid_set.append
+        for record in partition.member:
+            pos = ranks[record]
+            if pos < mean:
+                # lhs = [low, mean)
+                lhs_append(record)
+            elif pos > mean:
+                # rhs = (mean, high]
+                rhs_append(record)
+            else:
+                # mid_set keep the means
+                mid_append(record)
+        # handle records in the middle
+        # these records will be divided evenly
+        # between lhs and rhs, such that
+        # |lhs| = |rhs| (+1 if total size is odd)
+        half_size = len(partition) // 2
+        moved = half_size - len(lhs)
+        if moved > 0:
+            # taken from the end of mid_set, last one first
+            lhs.add_multiple_record(reversed(mid_set[len(mid_set) - moved:]), dim)
+            del mid_set[len(mid_set) - moved:]
+        if len(mid_set) > 0:
+            rhs.low[dim] = mean
+            rhs.add_multiple_record(mid_set, dim)
+        # It's not necessary now.
+        # if len(lhs) < self.k or len(rhs) < self.k:
+        #     print "Error: split failure"
+        return lhs, rhs
 
+    def anonymize_relaxed(self, partition):
+        """
+        partition groups until not allowable
+        A stack of pending partitions replaces the recursion, see anonymize_strict
+        """
+        stack = [partition]
+        while stack:
+            partition = stack.pop()
+            if sum(partition.allow) == 0:
+                # can not split
+                self.result.append(partition)
+                continue
+            # choose attribute from domain
+            dim = self.choose_dimension(partition)
+            if dim == -1:
+                print("Error: dim=-1")
+                pdb.set_trace()
+            split_result = self.split_partition_relaxed(partition, dim)
+            if split_result is None:
+                # try again on the remaining dimensions
+                stack.append(partition)
+                continue
+            lhs, rhs = split_result
+            # anonymize sub-partition
+            stack.append(rhs)
+            stack.append(lhs)
 
-def anonymize_relaxed(partition):
-    """
-    recursively partition groups until not allowable
-    """
-    if sum(partition.allow) == 0:
-        # can not split
-        RESULT.append(partition)
-        return
-    # choose attribute from domain
-    dim = choose_dimension(partition)
-    if dim == -1:
-        print("Error: dim=-1")
-        pdb.set_trace()
-    # use frequency set to get median
-    (split_val, next_val, low, high) = find_median(partition, dim)
-    # Update parent low and high
-    if low != '':
-        partition.low[dim] = QI_DICT[dim][low]
-        partition.high[dim] = QI_DICT[dim][high]
-    if split_val == '':
-        # cannot split
-        partition.allow[dim] = 0
-        anonymize_relaxed(partition)
-        return
-    # split the group from median
-    mean = QI_DICT[dim][split_val]
-    lhs_high = partition.high[:]
-    rhs_low = partition.low[:]
-    lhs_high[dim] = mean
-    rhs_low[dim] = QI_DICT[dim][next_val]
-    lhs = Partition([], partition.low, lhs_high)
-    rhs = Partition([], rhs_low, partition.high)
-    mid_set = []
-    for record in partition.member:
-        pos = QI_DICT[dim][record[dim]]
-        if pos < mean:
-            # lhs = [low, mean)
-            lhs.add_record(record, dim)
-        elif pos > mean:
-            # rhs = (mean, high]
-            rhs.add_record(record, dim)
+    def information_loss(self, result=None):
+        """
+        return (NCP, NCP of every QI, NCP of every partition), in percentage, of result,
+        the partitions of the last run by default, computed over their low and high arrays
+        """
+        if result is None:
+            result = self.result
+        low = np.array([partition.low for partition in result], dtype=np.int64).reshape(-1, self.qi_len)
+        high = np.array([partition.high for partition in result], dtype=np.int64).reshape(-1, self.qi_len)
+        size = np.array([len(partition) for partition in result], dtype=np.float64)
+        if self.rank_value is None:
+            self.rank_value = rank_values(self.qi_order)
+        norm_width = normalized_width(self.rank_value, np.array(self.qi_range, dtype=np.float64), low, high)
+        return information_loss(norm_width, size)
+
+    def anonymize(self, relax=False):
+        """
+        Run mondrian on the data of this engine, return result in tuple (result, (ncp, rtime)).
+        """
+        result = []
+        self.result = []
+        data_size = len(self.data)
+        low = [0] * self.qi_len
+        high = [(len(t) - 1) for t in self.qi_order]
+        whole_partition = Partition(array('i', range(data_size)), low, high)
+        # begin mondrian
+        start_time = time.time()
+        if relax:
+            # relax model
+            self.anonymize_relaxed(whole_partition)
         else:
-            # mid_set keep the means
-            mid_set.append(record)
-    # handle records in the middle
-    # these records will be divided evenly
-    # between lhs and rhs, such that
-    # |lhs| = |rhs| (+1 if total size is odd)
-    half_size = len(partition) // 2
-    for _ in range(half_size - len(lhs)):
-        record = mid_set.pop()
-        lhs.add_record(record, dim)
-    if len(mid_set) > 0:
-        rhs.low[dim] = mean
-        rhs.add_multiple_record(mid_set, dim)
-    # It's not necessary now.
-    # if len(lhs) < GL_K or len(rhs) < GL_K:
-    #     print "Error: split failure"
-    # anonymize sub-partition
-    anonymize_relaxed(lhs)
-    anonymize_relaxed(rhs)
-
-
-def init(data, k, qi_num=-1):
-    """
-    reset global variables
-    """
-    global GL_K, RESULT, QI_LEN, QI_DICT, QI_RANGE, QI_ORDER
-    if qi_num <= 0:
-        QI_LEN = len(data[0]) - 1
-    else:
-        QI_LEN = qi_num
-    GL_K = k
-    RESULT = []
-    # static values
-    QI_DICT = []
-    QI_ORDER = []
-    QI_RANGE = []
-    att_values = []
-    for i in range(QI_LEN):
-        att_values.append(set())
-        QI_DICT.append(dict())
-    for record in data:
-        for i in range(QI_LEN):
-            att_values[i].add(record[i])
-    for i in range(QI_LEN):
-        value_list = list(att_values[i])
-        value_list.sort(key=cmp_to_key(cmp_value))
-        QI_RANGE.append(value(value_list[-1]) - value(value_list[0]))
-        QI_ORDER.append(list(value_list))
-        for index, qi_value in enumerate(value_list):
-            QI_DICT[i][qi_value] = index
+            # strict model
+            self.anonymize_strict(whole_partition)
+        rtime = float(time.time() - start_time)
+        # generalization result, the generalised values are built once per partition
+        for partition in self.result:
+            generalized = [merge_qi_value(self.qi_order[index][partition.low[index]],
+                                          self.qi_order[index][partition.high[index]])
+                           for index in range(self.qi_len)]
+            for record_index in partition.member:
+                record = self.data[record_index]
+                record[:self.qi_len] = generalized
+                result.append(record)
+        # evaluation information loss, in percentage
+        ncp = self.information_loss()[0]
+        if _DEBUG:
+            print("size of partitions=%d" % len(self.result))
+            print("K=%d" % self.k)
+            print("NCP = %.2f %%" % ncp)
+        return (result, (ncp, rtime))
 
 
 def mondrian(data, k, relax=False, qi_num=-1):
@@ -318,45 +398,6 @@ def mondrian(data, k, relax=False, qi_num=-1):
     Both mondrians split partition with binary split.
     In strict mondrian, lhs and rhs have not intersection.
     But in relaxed mondrian, lhs may be have intersection with rhs.
+    Thin wrapper over MondrianEngine, which holds the state of the run.
     """
-    init(data, k, qi_num)
-    result = []
-    data_size = len(data)
-    low = [0] * QI_LEN
-    high = [(len(t) - 1) for t in QI_ORDER]
-    whole_partition = Partition(data, low, high)
-    # begin mondrian
-    start_time = time.time()
-    if relax:
-        # relax model
-        anonymize_relaxed(whole_partition)
-    else:
-        # strict model
-        anonymize_strict(whole_partition)
-    rtime = float(time.time() - start_time)
-    # generalization result and
-    # evaluation information loss
-    dp = 0.0
-    ncp = dp
-    for partition in RESULT:
-        rncp = 0.0
-        for index in range(QI_LEN):
-            rncp += get_normalized_width(partition, index)
-        rncp *= len(partition)
-        ncp += rncp
-        dp += len(partition) ** 2
-        for record in partition.member[:]:
-            for index in range(QI_LEN):
-                record[index] = merge_qi_value(QI_ORDER[index][partition.low[index]],
-                                QI_ORDER[index][partition.high[index]])
-            result.append(record)
-    # If you want to get NCP values instead of percentage
-    # please remove next three lines
-    ncp /= QI_LEN
-    ncp /= data_size
-    ncp *= 100
-    if __DEBUG:
-        print("size of partitions=%d" % len(RESULT))
-        print("K=%d" % k)
-        print("NCP = %.2f %%" % ncp)
-    return (result, (ncp, rtime))
+    return MondrianEngine(data, k, qi_num).anonymize(relax)
@@ -0,0 +1,113 @@
+"""
+Parallel k-sweep over a process pool
+
+The encoded QI rank matrix is copied once into shared memory. Every worker
+process attaches to it once, in its initializer, so a task only carries its k
+value. A worker writes the permutation of its k value into its row of a shared
+output block and only sends back the partition boundaries and the information
+loss, the records are generalised and stored by the main process, see
+anonymiser.anonymise_parallel.
+This module must not import Django, workers are started with the spawn method.
+"""
+
+import multiprocessing
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from anonymisation.anonymise.utils.vector_mondrian import VectorMondrian
+
+# Attached in every worker by attach_dataset
+_WORKER_DATASET = {}
+
+
+class SharedArray(object):
+
+    """
+    A NumPy array in a named shared memory block
+    self.array stays mapped as long as it or a view of it is alive, after release too
+    """
+
+    def __init__(self, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        size = int(np.prod(self.shape)) * np.dtype(dtype).itemsize
+        self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+        weakref.finalize(self.array, self.memory.close)
+
+    @classmethod
+    def copy_of(cls, array):
+        array = np.ascontiguousarray(array)
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    def describe(self):
+        return self.memory.name, self.shape, self.dtype
+
+    def release(self):
+        self.array = None
+        self.memory.unlink()
+
+
+def attach_array(description, writeable=False):
+    name, shape, dtype = description
+    memory = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    array.flags.writeable = writeable
+    return memory, array
+
+
+def attach_dataset(qi_description, qi_order, perm_description):
+    """
+    Worker initializer, attaches the shared dataset and output once per process
+    """
+    qi_memory, qi_rank = attach_array(qi_description)
+    perm_memory, perm = attach_array(perm_description, writeable=True)
+    _WORKER_DATASET.update({
+        'memory': (qi_memory, perm_memory),
+        'qi_rank': qi_rank,
+        'qi_order': qi_order,
+        'perm': perm,
+    })
+
+
+def anonymise_k(row, k_value):
+    """
+    Worker task: strict Mondrian for one k over the shared dataset
+    The permutation is written into row of the shared output, the records of a partition
+    are perm[row][start:start + size], see VectorMondrian.
+    Returns (k_value, rtime, (ncp, attribute_loss, partition_loss), partitions)
+    """
+    engine = VectorMondrian.from_encoded(_WORKER_DATASET['qi_rank'], _WORKER_DATASET['qi_order'], k_value)
+    start_time = time.time()
+    engine.run(relax=False)
+    rtime = float(time.time() - start_time)
+    _WORKER_DATASET['perm'][row] = engine.perm
+    return k_value, rtime, engine.information_loss(), engine.result
+
+
+def parallel_sweep(qi_rank, qi_order, k_values, max_workers=None):
+    """
+    Runs anonymise_k for every k value over a process pool sharing one copy of the dataset.
+    Yields (k_value, rtime, (ncp, attribute_loss, partition_loss), perm, partitions) for every
+    k value in the order of k_values, as soon as it is done. perm is a view of the shared output.
+    """
+    qi_shared = SharedArray.copy_of(qi_rank)
+    perm_shared = SharedArray((len(k_values), len(qi_rank)), np.intp)
+    perm = perm_shared.array
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=attach_dataset,
+                                 initargs=(qi_shared.describe(), qi_order, perm_shared.describe())) as executor:
+            for row, (k_value, rtime, loss, partitions) in enumerate(
+                    executor.map(anonymise_k, range(len(k_values)), k_values)):
+                yield k_value, rtime, loss, perm[row], partitions
+    finally:
+        qi_shared.release()
+        perm_shared.release()
@@ -5,7 +5,9 @@ Read transaction history data set
 # !/usr/bin/env python
 # coding=utf-8
 
+from decimal import Decimal
 
+import numpy as np
 
 ATT_NAME = ['sender_age', 'sender_gender', 'sender_postal_code', 'sender_citizenship', 
             'first_sum', 'second_sum', 'third_sum', 'fourth_sum', 'fifth_sum', 'first_balance',
@@ -15,39 +17,45 @@ IS_CAT = [False, True, False, True]
 SA_INDEX = [4, 5, 6, 7, 8, 9, 10, 11]
 __DEBUG = False
 
-def convert_to_categorical(qi_num, intuitive_dict, intuitive_number, intuitive_order, line):
-    line = line.replace(' ', '')
-    temp = line.split(',')
+def encode_record(qi_num, intuitive_dict, intuitive_number, intuitive_order, record):
+    """
+    Codes the QIs of one record, categorical values in their order of appearance,
+    and returns them followed by the SAs, which are kept as they are
+    """
     ltemp = []
     for i in range(qi_num):
         index = QI_INDEX[i]
         if IS_CAT[i]:
+            # categories are stored without spaces, e.g. SingaporeanCitizen
+            category = str(record[index]).replace(' ', '')
             try:
-                ltemp.append(intuitive_dict[i][temp[index]])
+                ltemp.append(intuitive_dict[i][category])
             except KeyError:
-                intuitive_dict[i][temp[index]] = intuitive_number[i]
+                intuitive_dict[i][category] = intuitive_number[i]
                 ltemp.append(intuitive_number[i])
                 intuitive_number[i] += 1
-                intuitive_order[i].append(temp[index])
+                intuitive_order[i].append(category)
         else:
-            ltemp.append(int(temp[index]))
-    return ltemp, temp
+            ltemp.append(int(record[index]))
+    for index in SA_INDEX:
+        ltemp.append(record[index])
+    return ltemp
 
 
-def read_data(transaction_data):
+def read_records(records):
     """
 
-    Reads data and processes categorical data into integer values for anonymisation
-   
+    Processes typed records and codes categorical data into integer values for anonymisation
+
     Parameters
     ----------
-    transaction_data : str
-        The unanonymised data set which contains transaction history of all customers
-    
+    records : iterable of tuple
+        One tuple per customer, in the order of ATT_NAME, see WithdrawalRetriever.records
+
     Returns
     -------
     list
-        list of all the processed data 
+        list of all the processed data, the SAs keep their type
     intuitive_order
         list of all categorical data headers
     qi_num
@@ -58,7 +66,6 @@ def read_data(transaction_data):
     """
     qi_num = len(QI_INDEX)
     sa_num = len(SA_INDEX)
-    data = []
     # order categorical attributes in intuitive order
     # here, we use the appear number
     intuitive_dict = []
@@ -68,21 +75,122 @@ def read_data(transaction_data):
         intuitive_dict.append(dict())
         intuitive_number.append(0)
         intuitive_order.append(list())
-    
+
+    data = [encode_record(qi_num, intuitive_dict, intuitive_number, intuitive_order, record)
+            for record in records]
+    return data, intuitive_order, qi_num, sa_num
+
+
+def split_lines(transaction_data):
+    """
+    Splits comma separated lines into fields, skipping empty and incomplete lines
+    """
     for line in transaction_data:
         line = line.strip()
         # remove empty and incomplete lines
-        # only 30162 records will be kept
-
         if len(line) == 0 or '?' in line:
             continue
-        
         # remove double spaces
-        ltemp, temp = convert_to_categorical(qi_num, intuitive_dict, intuitive_number, intuitive_order, line)
-       
-        # Append SA after processing of QI
-        for l in range(sa_num):
-            left = SA_INDEX[l]
-            ltemp.append(temp[left])
-        data.append(ltemp)
-    return data, intuitive_order, qi_num, sa_num
+        yield line.replace(' ', '').split(',')
+
+
+def read_data(transaction_data):
+    """
+
+    Compatibility adapter of read_records for comma separated lines, see WithdrawalRetriever.format
+   
+    Parameters
+    ----------
+    transaction_data : list of str
+        The unanonymised data set which contains transaction history of all customers
+    
+    Returns
+    -------
+    Same as read_records, the SAs are strings
+
+    """
+    return read_records(split_lines(transaction_data))
+
+
+class RecordColumns(object):
+
+    """
+    Compact column buffers filled chunk by chunk with typed records, see read_records
+    self.qi: QI codes, one row per record, categorical QIs coded in order of appearance
+    self.sa: SAs in cents, one row per record
+    self.size: number of records filled
+    The buffers are preallocated for the expected number of records and only
+    grow if more records arrive.
+    """
+
+    def __init__(self, capacity):
+        self.qi_num = len(QI_INDEX)
+        self.sa_num = len(SA_INDEX)
+        self.qi = np.empty((max(capacity, 1), self.qi_num), dtype=np.int32)
+        self.sa = np.empty((max(capacity, 1), self.sa_num), dtype=np.int64)
+        self.size = 0
+        self.intuitive_dict = [dict() for _ in range(self.qi_num)]
+        self.intuitive_order = [list() for _ in range(self.qi_num)]
+
+    def reserve(self, capacity):
+        if capacity <= len(self.qi):
+            return
+        capacity = max(capacity, 2 * len(self.qi))
+        for name in ('qi', 'sa'):
+            old = getattr(self, name)
+            new = np.empty((capacity, old.shape[1]), dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def category_code(self, i, category):
+        category = str(category).replace(' ', '')
+        try:
+            return self.intuitive_dict[i][category]
+        except KeyError:
+            code = self.intuitive_dict[i][category] = len(self.intuitive_order[i])
+            self.intuitive_order[i].append(category)
+            return code
+
+    def append(self, records):
+        """
+        Encodes a chunk of typed records into the buffers
+        """
+        if not records:
+            return
+        start, end = self.size, self.size + len(records)
+        self.reserve(end)
+        for i in range(self.qi_num):
+            index = QI_INDEX[i]
+            if IS_CAT[i]:
+                self.qi[start:end, i] = [self.category_code(i, record[index]) for record in records]
+            else:
+                self.qi[start:end, i] = [record[index] for record in records]
+        amounts = np.array([[record[index] for index in SA_INDEX] for record in records], dtype=np.float64)
+        self.sa[start:end] = np.rint(amounts * 100)
+        self.size = end
+
+    def qi_codes(self):
+        return self.qi[:self.size]
+
+    def sa_values(self):
+        """
+        SAs as floats, for averages
+        """
+        return self.sa[:self.size] / 100
+
+    def sa_decimals(self, row):
+        return [Decimal(int(cents)).scaleb(-2) for cents in self.sa[row]]
+
+    def __len__(self):
+        return self.size
+
+
+def read_columns(chunks, capacity):
+    """
+    Streaming version of read_records: encodes chunks of typed records into
+    RecordColumns preallocated for capacity records
+    """
+    columns = RecordColumns(capacity)
+    for records in chunks:
+        columns.append(records)
+    return columns
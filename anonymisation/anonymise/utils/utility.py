@@ -7,6 +7,8 @@ public functions
 from datetime import datetime
 import time
 
+import numpy as np
+
 def cmp(x, y):
     if x > y:
         return 1
@@ -68,3 +70,40 @@ def merge_qi_value(x_left, x_right, connect_str='~'):
     return result
 
 
+def rank_values(qi_order):
+    """
+    Numeric value of every rank of every QI, padded into one matrix (QI x rank)
+    so that the values of every QI can be gathered at once
+    """
+    max_len = max(len(order) for order in qi_order)
+    rank_value = np.zeros((len(qi_order), max_len), dtype=np.float64)
+    for i, order in enumerate(qi_order):
+        rank_value[i, :len(order)] = [value(qi_value) for qi_value in order]
+    return rank_value
+
+
+def normalized_width(rank_value, qi_range, low, high):
+    """
+    Normalized width of every QI of every partition, low and high are rank matrices
+    (partition x QI), a width equal to the range of its QI is 1
+    """
+    dims = np.arange(rank_value.shape[0])
+    width = rank_value[dims, high] - rank_value[dims, low]
+    ratio = np.divide(width, qi_range, out=np.ones_like(width), where=qi_range != 0)
+    return np.where(width == qi_range, 1.0, ratio)
+
+
+def information_loss(norm_width, size):
+    """
+    NCP of partitions from their normalized widths (partition x QI) and sizes, in percentage.
+    Returns (overall NCP, NCP of every QI, NCP of every partition), the overall NCP is the
+    mean of the NCP of the QIs
+    """
+    norm_width = np.asarray(norm_width, dtype=np.float64)
+    size = np.asarray(size, dtype=np.float64)
+    total = size.sum()
+    if total == 0:
+        return 0.0, np.zeros(norm_width.shape[1]), np.zeros(len(size))
+    attribute_loss = (norm_width * size[:, None]).sum(axis=0) / total * 100
+    partition_loss = norm_width.mean(axis=1) * 100
+    return float(attribute_loss.mean()), attribute_loss, partition_loss
@@ -0,0 +1,325 @@
+# coding:utf-8
+"""
+NumPy-backed mondrian, drop-in replacement for mondrian.mondrian
+
+Quasi-identifiers are encoded once into integer rank columns and partitions are
+contiguous segments of one permutation of row indices.
+Instead of recursing partition by partition, every open partition of the current
+frontier attempts one split per round, so medians, splits and NCP are computed
+with vectorised NumPy operations over the whole frontier at once.
+A split replaces its parent segment with [lhs | rhs] in place, hence the final
+segments are already in the depth-first order that mondrian.py produces, and the
+split decisions mirror mondrian.py exactly.
+Every accepted strict split is also kept as a node of a split tree, so the
+partitions for any larger k can be derived by pruning the tree (see prune).
+"""
+
+import time
+from functools import cmp_to_key
+
+import numpy as np
+
+from anonymisation.anonymise.utils.utility import (cmp_value, information_loss, merge_qi_value, normalized_width,
+                                                   rank_values, value)
+
+
+def encode_qi(data, qi_len):
+    """
+    Encodes the first qi_len columns of data into integer ranks.
+    data is a list of records or an integer matrix, e.g. read_data.RecordColumns.qi_codes()
+    Returns the rank matrix and, for each QI, the sorted list of distinct values
+    (rank -> original value), sorted the same way as mondrian.MondrianEngine
+    """
+    qi_rank = np.empty((len(data), qi_len), dtype=np.int64)
+    qi_order = []
+    for i in range(qi_len):
+        if isinstance(data, np.ndarray):
+            column = as_array = data[:, i]
+        else:
+            column = [record[i] for record in data]
+            as_array = np.asarray(column)
+        if as_array.dtype.kind in 'iu':
+            value_list, inverse = np.unique(as_array, return_inverse=True)
+            qi_rank[:, i] = inverse
+            qi_order.append(value_list.tolist())
+        else:
+            value_list = sorted(set(column), key=cmp_to_key(cmp_value))
+            qi_dict = {qi_value: index for index, qi_value in enumerate(value_list)}
+            qi_rank[:, i] = [qi_dict[qi_value] for qi_value in column]
+            qi_order.append(value_list)
+    return qi_rank, qi_order
+
+
+def segment_positions(start, size):
+    """
+    return the positions covered by the segments [start, start + size),
+    concatenated in segment order, and the segment number of each position
+    """
+    segment = np.repeat(np.arange(len(size)), size)
+    offset = np.cumsum(size) - size
+    position = np.arange(int(size.sum())) - offset[segment] + start[segment]
+    return position, segment, offset
+
+
+class Frontier(object):
+
+    """
+    Open partitions of one round, stored as parallel arrays
+    self.start, self.size: segment of the permutation holding the records
+    self.low, self.high: rank bounds, one row per partition
+    self.allow: show if partition can be split on this QI
+    self.reach: smallest child size of the splits above the partition,
+                i.e. the largest k for which the partition is still created
+    """
+
+    def __init__(self, start, size, low, high, allow, reach):
+        self.start = start
+        self.size = size
+        self.low = low
+        self.high = high
+        self.allow = allow
+        self.reach = reach
+
+    def __len__(self):
+        return len(self.start)
+
+    def take(self, mask):
+        return Frontier(self.start[mask], self.size[mask], self.low[mask],
+                        self.high[mask], self.allow[mask], self.reach[mask])
+
+    @staticmethod
+    def concatenate(frontiers):
+        return Frontier(np.concatenate([f.start for f in frontiers]),
+                        np.concatenate([f.size for f in frontiers]),
+                        np.concatenate([f.low for f in frontiers]),
+                        np.concatenate([f.high for f in frontiers]),
+                        np.concatenate([f.allow for f in frontiers]),
+                        np.concatenate([f.reach for f in frontiers]))
+
+
+class VectorMondrian(object):
+
+    """
+    Holds the encoded dataset and the state of one mondrian run
+    """
+
+    def __init__(self, data, k, qi_num=-1):
+        if qi_num <= 0:
+            qi_len = len(data[0]) - 1
+        else:
+            qi_len = qi_num
+        qi_rank, qi_order = encode_qi(data, qi_len)
+        self.setup(qi_rank, qi_order, k)
+        self.data = data
+
+    @classmethod
+    def from_encoded(cls, qi_rank, qi_order, k):
+        """
+        build an engine over an already encoded rank matrix, e.g. one in shared memory,
+        generalize() is not available since the original records are not known
+        """
+        engine = cls.__new__(cls)
+        engine.setup(qi_rank, qi_order, k)
+        engine.data = None
+        return engine
+
+    def setup(self, qi_rank, qi_order, k):
+        self.qi_len = len(qi_order)
+        self.k = k
+        self.qi_rank = qi_rank
+        self.qi_order = qi_order
+        # rank -> numeric value, padded so every QI can be gathered at once
+        self.rank_value = rank_values(self.qi_order)
+        self.qi_range = np.array([value(order[-1]) - value(order[0]) for order in self.qi_order],
+                                 dtype=np.float64)
+        self.perm = np.arange(len(qi_rank))
+        self.result = None
+        self.tree = None
+        self.tree_min_child = None
+        self.splits = []
+
+    def normalized_width(self, low, high):
+        """
+        return normalized width of every QI, one row per partition
+        """
+        return normalized_width(self.rank_value, self.qi_range, low, high)
+
+    def choose_dimension(self, frontier):
+        """
+        choose dim with largest norm_width from allowed attributes of each partition
+        """
+        norm_width = np.where(frontier.allow, self.normalized_width(frontier.low, frontier.high), -1.0)
+        return np.argmax(norm_width, axis=1)
+
+    def find_median(self, ranks, segment, offset, size):
+        """
+        find the middle of every segment of ranks
+        return (split_rank, next_rank, low_rank, high_rank, splittable) per segment
+        """
+        low = np.minimum.reduceat(ranks, offset)
+        high = np.maximum.reduceat(ranks, offset)
+        span = int(ranks.max()) + 1
+        sorted_ranks = np.sort(segment * span + ranks) - segment * span
+        middle = size // 2
+        splittable = (middle >= self.k) & (low != high)
+        # the smallest value whose cumulative frequency reaches middle
+        split_rank = sorted_ranks[offset + np.maximum(middle - 1, 0)]
+        count_le = np.add.reduceat(ranks <= split_rank[segment], offset)
+        has_next = count_le < size
+        next_rank = np.where(has_next, sorted_ranks[np.minimum(offset + count_le, len(ranks) - 1)], split_rank)
+        return split_rank, next_rank, low, high, splittable, count_le
+
+    def split_round(self, frontier, relax):
+        """
+        let every partition of the frontier attempt one split
+        return (partitions still open, children)
+        """
+        rows = np.arange(len(frontier))
+        dim = self.choose_dimension(frontier)
+        position, segment, offset = segment_positions(frontier.start, frontier.size)
+        records = self.perm[position]
+        ranks = self.qi_rank[records, dim[segment]]
+        (split_rank, next_rank, low, high, splittable, count_le) = self.find_median(
+            ranks, segment, offset, frontier.size)
+        if relax:
+            frontier.low[rows, dim] = low
+            frontier.high[rows, dim] = high
+            split = splittable
+            count_lt = np.add.reduceat(ranks < split_rank[segment], offset)
+            move = np.maximum(frontier.size // 2 - count_lt, 0)
+            keep = count_le - count_lt - move
+            lhs_size = count_lt + move
+            rhs_next = np.where(keep > 0, split_rank, next_rank)
+        else:
+            attempt = splittable & (next_rank != split_rank)
+            frontier.low[rows[attempt], dim[attempt]] = low[attempt]
+            frontier.high[rows[attempt], dim[attempt]] = high[attempt]
+            lhs_size = count_le
+            # check is lhs and rhs satisfy k-anonymity
+            split = attempt & (lhs_size >= self.k) & (frontier.size - lhs_size >= self.k)
+            rhs_next = next_rank
+        frontier.allow[rows[~split], dim[~split]] = False
+
+        # stable reorder of the records of split segments into [lhs | rhs]
+        row_split = split[segment]
+        split_at = split_rank[segment]
+        if relax:
+            is_mid = ranks == split_at
+            mid_count = np.cumsum(is_mid)
+            mid_offset = np.concatenate(([0], mid_count))[offset]
+            mid_index = mid_count - 1 - mid_offset[segment]
+            # records equal to the median fill lhs from the back, like mondrian.anonymize_relaxed
+            moved = row_split & is_mid & (mid_index >= keep[segment])
+            group = np.where(ranks < split_at, 0, np.where(moved, 1, np.where(ranks > split_at, 2, 3)))
+            secondary = np.where(moved, -position, position)
+        else:
+            group = (ranks > split_at).astype(np.int64)
+            secondary = position
+        group = np.where(row_split, group, 0) + segment * 4
+        order = np.lexsort((secondary, group))
+        self.perm[position] = records[order]
+
+        parent = frontier.take(split)
+        split_dim = dim[split]
+        lhs_high = parent.high.copy()
+        lhs_high[np.arange(len(parent)), split_dim] = split_rank[split]
+        rhs_low = parent.low.copy()
+        rhs_low[np.arange(len(parent)), split_dim] = rhs_next[split]
+        rhs_size = parent.size - lhs_size[split]
+        min_child = np.minimum(lhs_size[split], rhs_size)
+        self.splits.append((parent, min_child))
+        reach = np.minimum(parent.reach, min_child)
+        allow = np.ones_like(parent.allow)
+        lhs = Frontier(parent.start, lhs_size[split], parent.low, lhs_high, allow, reach)
+        rhs = Frontier(parent.start + lhs_size[split], rhs_size, rhs_low, parent.high,
+                       allow.copy(), reach.copy())
+        return frontier.take(~split), Frontier.concatenate((lhs, rhs))
+
+    def run(self, relax=False):
+        """
+        partition until no partition is allowable, the result keeps the
+        partitions in the depth-first order of mondrian.py
+        """
+        n = len(self.perm)
+        frontier = Frontier(np.zeros(1, dtype=np.int64), np.array([n], dtype=np.int64),
+                            np.zeros((1, self.qi_len), dtype=np.int64),
+                            np.array([[len(order) - 1 for order in self.qi_order]], dtype=np.int64),
+                            np.ones((1, self.qi_len), dtype=bool),
+                            np.array([np.iinfo(np.int64).max], dtype=np.int64))
+        self.splits = []
+        finished = []
+        while len(frontier) > 0:
+            done = ~frontier.allow.any(axis=1)
+            finished.append(frontier.take(done))
+            frontier = frontier.take(~done)
+            if len(frontier) == 0:
+                break
+            frontier, children = self.split_round(frontier, relax)
+            frontier = Frontier.concatenate((frontier, children))
+        result = Frontier.concatenate(finished)
+        self.result = result.take(np.argsort(result.start, kind='stable'))
+        self.tree = Frontier.concatenate([parent for parent, _ in self.splits] + [self.result])
+        self.tree_min_child = np.concatenate([min_child for _, min_child in self.splits]
+                                             + [np.zeros(len(self.result), dtype=np.int64)])
+
+    def prune(self, k):
+        """
+        return the partitions of a strict run for a k at least the k of this engine,
+        without partitioning again: a split node becomes a partition as soon as one
+        of its children holds fewer than k records
+        """
+        selected = (self.tree.reach >= k) & (self.tree_min_child < k)
+        result = self.tree.take(selected)
+        return result.take(np.argsort(result.start, kind='stable'))
+
+    def information_loss(self, result=None):
+        """
+        return (NCP, NCP of every QI, NCP of every partition), in percentage, of result,
+        the current result by default
+        """
+        if result is None:
+            result = self.result
+        return information_loss(self.normalized_width(result.low, result.high), result.size)
+
+    def ncp(self, result=None):
+        """
+        return NCP (in percentage) of result, the current result by default
+        """
+        return self.information_loss(result)[0]
+
+    def anonymize(self, relax=False):
+        """
+        Run mondrian, return result in tuple (result, (ncp, rtime)) like MondrianEngine.anonymize
+        """
+        start_time = time.time()
+        self.run(relax)
+        rtime = float(time.time() - start_time)
+        return (self.generalize(), (self.ncp(), rtime))
+
+    def generalize(self, result=None):
+        """
+        return records with QI replaced by the generalised range of their partition
+        """
+        if result is None:
+            result = self.result
+        records = []
+        perm = self.perm.tolist()
+        for start, size, low, high in zip(result.start.tolist(), result.size.tolist(),
+                                          result.low.tolist(), result.high.tolist()):
+            generalized = [merge_qi_value(self.qi_order[i][low[i]], self.qi_order[i][high[i]])
+                           for i in range(self.qi_len)]
+            for row in perm[start:start + size]:
+                records.append(generalized + self.data[row][self.qi_len:])
+        return records
+
+
+def mondrian(data, k, relax=False, qi_num=-1):
+    """
+    Same contract as mondrian.mondrian, return result in tuple (result, (ncp, rtime)).
+    data: dataset in 2-dimensional array.
+    k: k parameter for k-anonymity
+    qi_num: Default -1, which exclude the last column. Othewise, [0, 1,..., qi_num - 1]
+            will be anonymized, [qi_num,...] will be excluded.
+    relax: determine use strict or relaxed mondrian
+    """
+    return VectorMondrian(data, k, qi_num).anonymize(relax)
@@ -0,0 +1,101 @@
+"""
+Benchmark of store_anon_database: one save() per record against batched bulk_create and COPY
+
+Usage (against the database configured in main.settings):
+```
+DJANGO_SETTINGS_MODULE=main.settings python -m anonymisation.benchmarks.anon_loader --rows 100000
+```
+Every case runs in a transaction that is rolled back, the anon table is left untouched.
+"""
+
+import argparse
+import sys
+import time
+from decimal import Decimal
+
+import django
+import numpy as np
+from django.db import transaction
+
+
+class Rollback(Exception):
+    pass
+
+
+def sample_anon_data(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    amounts = np.round(rng.gamma(2.0, 800.0, (rows, 8)), 2).astype(str).tolist()
+    ages = rng.integers(18, 80, rows).tolist()
+    anon_data = []
+    for age, amount in zip(ages, amounts):
+        record = {'age': '%d - %d' % (age, age + 9), 'gender': 'Female - Male', 'postal_code': '12**** - 56****',
+                  'citizenship': 'Singaporean Citizen'}
+        record.update(zip(['first_sum', 'second_sum', 'third_sum', 'fourth_sum', 'fifth_sum',
+                           'first_balance', 'second_balance', 'third_balance'], map(Decimal, amount)))
+        anon_data.append(record)
+    return anon_data
+
+
+def store_one_by_one(anon_data):
+    """
+    store_anon_database as it was before the bulk loader
+    """
+    from anonymisation.anonymise.utils.database import clean_sum
+    from anonymisation.models import Anonymisation
+    Anonymisation.objects.all().delete()
+    for count, data in enumerate(anon_data, 1):
+        Anonymisation(
+            id=count,
+            age=data['age'],
+            gender=data['gender'],
+            postal_code=data['postal_code'],
+            citizenship=data['citizenship'],
+            first_sum=clean_sum(data['first_sum']),
+            second_sum=clean_sum(data['second_sum']),
+            third_sum=clean_sum(data['third_sum']),
+            fourth_sum=clean_sum(data['fourth_sum']),
+            fifth_sum=clean_sum(data['fifth_sum']),
+            first_balance=data['first_balance'],
+            second_balance=data['second_balance'],
+            third_balance=data['third_balance']
+        ).save()
+
+
+def timed(store, anon_data):
+    start = time.perf_counter()
+    try:
+        with transaction.atomic():
+            store(anon_data)
+            raise Rollback()
+    except Rollback:
+        pass
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--loop-rows", type=int, default=10000,
+                        help="rows of the one-by-one case, which is much slower")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    args = parser.parse_args(argv)
+
+    django.setup()
+    from anonymisation.anonymise.utils.database import store_anon_database
+
+    cases = [("save() loop", None, args.loop_rows, store_one_by_one)]
+    for method in ("bulk_create", "copy"):
+        for batch_size in args.batch_sizes:
+            cases.append((method, batch_size, args.rows,
+                          lambda data, method=method, batch_size=batch_size:
+                          store_anon_database(data, batch_size, method)))
+
+    print("%-12s %10s %10s %10s %12s" % ("method", "batch", "rows", "seconds", "rows/s"))
+    for name, batch_size, rows, store in cases:
+        seconds = timed(store, sample_anon_data(rows))
+        print("%-12s %10s %10d %10.2f %12.0f" % (name, batch_size or "-", rows, seconds, rows / seconds))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark of the incremental maintenance of the strict Mondrian split tree against
+partitioning the changed data from scratch
+
+Usage:
+```
+python -m anonymisation.benchmarks.incremental_update --rows 200000 --k 10 --changes 0.001 0.01 0.05
+```
+A fraction of the records is changed: half of it are new customers, a quarter customers
+whose QIs changed and a quarter removed customers. The rebuilt tree codes the categories
+like the maintained one, the NCP of strict Mondrian depends a lot on their order.
+"""
+
+import argparse
+import copy
+import random
+import time
+
+from anonymisation.anonymise.utils.incremental import IncrementalMondrian
+from anonymisation.benchmarks.synthetic import synthetic_records
+
+
+def changed_records(records, fraction, seed=1):
+    rng = random.Random(seed)
+    changes = int(len(records) * fraction)
+    fresh = synthetic_records(changes, seed)
+    records = records[changes // 4:] + fresh[:changes // 2]
+    for record in fresh[changes // 2:changes * 3 // 4]:
+        records[rng.randrange(len(records))] = record
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--changes", type=float, nargs="+", default=[0.001, 0.01, 0.05])
+    args = parser.parse_args(argv)
+
+    records = synthetic_records(args.rows)
+    tree = IncrementalMondrian(args.k)
+    start = time.perf_counter()
+    tree.update(records)
+    print("initial build of %d rows: %.2f s, NCP %.2f %%" % (args.rows, time.perf_counter() - start, tree.ncp()))
+    # stored like AnonymisationRelease.store_tree
+    state = tree.to_json()
+
+    print("%10s %14s %12s %14s %12s %10s" % ("changes", "rebuild s", "rebuild NCP", "incremental s",
+                                             "leaves", "NCP"))
+    for fraction in args.changes:
+        changed = changed_records(records, fraction)
+        rebuilt = IncrementalMondrian(args.k)
+        rebuilt.categories, rebuilt.category_code = copy.deepcopy((tree.categories, tree.category_code))
+        start = time.perf_counter()
+        rebuilt.update(changed)
+        rebuild = time.perf_counter() - start
+
+        updated = IncrementalMondrian.from_json(state)
+        start = time.perf_counter()
+        leaves = updated.update(changed)
+        seconds = time.perf_counter() - start
+        print("%9.1f%% %14.2f %12.2f %14.2f %12d %10.2f" % (
+            fraction * 100, rebuild, rebuilt.ncp(), seconds, len(leaves), updated.ncp()))
+
+
+if __name__ == "__main__":
+    main()
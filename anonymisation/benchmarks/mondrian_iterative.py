@@ -0,0 +1,117 @@
+"""
+Benchmark of the stack-based strict and relaxed Mondrian against the former recursion
+
+Usage:
+```
+python -m anonymisation.benchmarks.mondrian_iterative --rows 1000000 --k 10
+```
+Every case runs in its own process. Timings come from a plain run, the peak memory
+allocated while partitioning comes from a second run under tracemalloc.
+"""
+
+import argparse
+import multiprocessing
+import sys
+import time
+import tracemalloc
+
+from anonymisation.anonymise.utils.mondrian import MondrianEngine
+from anonymisation.benchmarks.synthetic import synthetic_records
+
+
+class RecursiveMondrianEngine(MondrianEngine):
+
+    """
+    The recursive partitioning that MondrianEngine used before, kept for comparison
+    """
+
+    depth = 0
+    max_depth = 0
+
+    def anonymize_strict(self, partition):
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        try:
+            for _ in range(sum(partition.allow)):
+                dim = self.choose_dimension(partition)
+                split_result = self.split_partition(partition, dim)
+                if split_result is None:
+                    partition.allow[dim] = 0
+                    continue
+                lhs, rhs = split_result
+                if len(lhs) < self.k or len(rhs) < self.k:
+                    partition.allow[dim] = 0
+                    continue
+                self.anonymize_strict(lhs)
+                self.anonymize_strict(rhs)
+                return
+            self.result.append(partition)
+        finally:
+            self.depth -= 1
+
+    def anonymize_relaxed(self, partition):
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        try:
+            if sum(partition.allow) == 0:
+                self.result.append(partition)
+                return
+            dim = self.choose_dimension(partition)
+            split_result = self.split_partition_relaxed(partition, dim)
+            if split_result is None:
+                self.anonymize_relaxed(partition)
+                return
+            lhs, rhs = split_result
+            self.anonymize_relaxed(lhs)
+            self.anonymize_relaxed(rhs)
+        finally:
+            self.depth -= 1
+
+
+def run_case(engine_class, rows, k, relax, seed, skewed, traced=False):
+    data = synthetic_records(rows, seed, skewed)
+    engine = engine_class(data, k, 4)
+    if traced:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        _, (ncp, _) = engine.anonymize(relax)
+        outcome = "ok"
+    except RecursionError:
+        ncp = float("nan")
+        outcome = "RecursionError"
+    seconds = time.perf_counter() - start
+    peak_mb = 0.0
+    if traced:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    depth = getattr(engine, "max_depth", 0)
+    return outcome, seconds, len(engine.result), ncp, peak_mb, depth
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    context = multiprocessing.get_context("spawn")
+    print("%-10s %-8s %-7s %-15s %10s %11s %8s %12s %10s" % (
+        "engine", "model", "data", "outcome", "seconds", "partitions", "NCP %", "peak MB", "max depth"))
+    for skewed in (False, True):
+        for relax in (False, True):
+            for name, engine_class in (("recursive", RecursiveMondrianEngine), ("stack", MondrianEngine)):
+                case = (engine_class, args.rows, args.k, relax, args.seed, skewed)
+                with context.Pool(1) as pool:
+                    outcome, seconds, partitions, ncp, _, depth = pool.apply(run_case, case)
+                with context.Pool(1) as pool:
+                    peak = pool.apply(run_case, case + (True,))[4]
+                print("%-10s %-8s %-7s %-15s %10.2f %11d %8.2f %12.1f %10s" % (
+                    name, "relaxed" if relax else "strict", "skewed" if skewed else "uniform",
+                    outcome, seconds, partitions, ncp, peak, depth or "-"))
+                sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
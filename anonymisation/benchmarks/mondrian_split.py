@@ -0,0 +1,108 @@
+"""
+Micro-benchmark of one split of the classic Mondrian engine: the counting median over
+integer ranks against the former frequency dict sorted with cmp_value
+
+Usage:
+```
+python -m anonymisation.benchmarks.mondrian_split --sizes 1000 10000 100000
+```
+Postal codes are also measured as numeric strings, the case where every comparison of
+the former path went through cmp_str.
+"""
+
+import argparse
+import timeit
+from array import array
+from functools import cmp_to_key
+
+from anonymisation.anonymise.utils.mondrian import MondrianEngine, Partition
+from anonymisation.anonymise.utils.utility import cmp_value
+from anonymisation.benchmarks.synthetic import synthetic_records
+
+QI_NAMES = ["age", "gender", "postal_code", "citizenship"]
+
+
+def legacy_find_median(engine, records, dim):
+    """
+    find_median as it was before the engine worked on ranks, on a list of records
+    """
+    frequency = {}
+    for record in records:
+        try:
+            frequency[record[dim]] += 1
+        except KeyError:
+            frequency[record[dim]] = 1
+    value_list = list(frequency.keys())
+    value_list.sort(key=cmp_to_key(cmp_value))
+    middle = sum(frequency.values()) // 2
+    if middle < engine.k or len(value_list) <= 1:
+        return '', '', value_list[0], value_list[-1]
+    index = 0
+    split_index = 0
+    for i, qi_value in enumerate(value_list):
+        index += frequency[qi_value]
+        if index >= middle:
+            split_index = i
+            break
+    split_val = value_list[split_index]
+    try:
+        next_val = value_list[split_index + 1]
+    except IndexError:
+        next_val = split_val
+    return split_val, next_val, value_list[0], value_list[-1]
+
+
+def legacy_split(engine, records, dim):
+    split_val, _, _, _ = legacy_find_median(engine, records, dim)
+    if split_val == '':
+        return None
+    mean = engine.qi_dict[dim][split_val]
+    lhs, rhs = [], []
+    for record in records:
+        if engine.qi_dict[dim][record[dim]] <= mean:
+            lhs.append(record)
+        else:
+            rhs.append(record)
+    return lhs, rhs
+
+
+def rank_split(engine, member, dim):
+    low = [0] * engine.qi_len
+    high = [len(order) - 1 for order in engine.qi_order]
+    return engine.split_partition(Partition(member, low, high), dim)
+
+
+def measure(size, string_postal, repeat):
+    data = synthetic_records(size)
+    if string_postal:
+        for record in data:
+            record[2] = str(record[2])
+    engine = MondrianEngine(data, 10, 4)
+    member = array('i', range(size))
+    rows = []
+    for dim, name in enumerate(QI_NAMES):
+        legacy = min(timeit.repeat(lambda: legacy_split(engine, data, dim), number=1, repeat=repeat))
+        ranked = min(timeit.repeat(lambda: rank_split(engine, member, dim), number=1, repeat=repeat))
+        rows.append((name, legacy, ranked))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print("%-8s %-12s %-7s %12s %12s %8s" % ("rows", "QI", "type", "former ms", "ranks ms", "speedup"))
+    for size in args.sizes:
+        for string_postal in (False, True):
+            for name, legacy, ranked in measure(size, string_postal, args.repeat):
+                if string_postal and name != "postal_code":
+                    continue
+                print("%-8d %-12s %-7s %12.2f %12.2f %7.1fx" % (
+                    size, name, "str" if string_postal else "int",
+                    legacy * 1000, ranked * 1000, legacy / ranked))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Memory benchmark of the slotted Partition of the classic Mondrian engine, holding arrays of
+record indices, against the former partitions with a __dict__ and lists
+
+Usage:
+```
+python -m anonymisation.benchmarks.partition_memory --rows 100000 1000000 --k 10
+```
+Every case runs in its own process. Timings come from a plain run, the memory from a second
+run under tracemalloc: the peak is the memory allocated while partitioning, "kept" is the
+memory of the resulting partitions.
+"""
+
+import argparse
+import multiprocessing
+import sys
+import time
+import tracemalloc
+from array import array
+
+from anonymisation.anonymise.utils import mondrian
+from anonymisation.benchmarks.synthetic import synthetic_records
+
+
+class ListPartition(object):
+
+    """
+    Partition as it was before it was slotted, lists of indices in a __dict__
+    """
+
+    def __init__(self, data, low, high):
+        self.low = list(low)
+        self.high = list(high)
+        self.member = data[:]
+        self.allow = [1] * len(self.low)
+
+    def add_record(self, record, _):
+        self.member.append(record)
+
+    def add_multiple_record(self, records, dim):
+        for record in records:
+            self.add_record(record, dim)
+
+    def __len__(self):
+        return len(self.member)
+
+
+class ListMondrianEngine(mondrian.MondrianEngine):
+
+    """
+    The strict split that appended every index to a ListPartition, kept for comparison
+    """
+
+    def split_partition(self, partition, dim):
+        (mean, next_rank, low, high) = self.find_median(partition, dim)
+        if mean is None or mean == next_rank:
+            partition.allow[dim] = 0
+            return None
+        partition.low[dim] = low
+        partition.high[dim] = high
+        lhs_high = partition.high[:]
+        rhs_low = partition.low[:]
+        lhs_high[dim] = mean
+        rhs_low[dim] = next_rank
+        lhs = ListPartition([], partition.low, lhs_high)
+        rhs = ListPartition([], rhs_low, partition.high)
+        ranks = self.qi_rank[dim]
+        for record in partition.member:
+            if ranks[record] <= mean:
+                lhs.add_record(record, dim)
+            else:
+                rhs.add_record(record, dim)
+        return lhs, rhs
+
+
+def partition_bytes(partition):
+    size = sys.getsizeof(partition) + sum(sys.getsizeof(getattr(partition, name))
+                                          for name in ("member", "low", "high", "allow"))
+    if hasattr(partition, "__dict__"):
+        size += sys.getsizeof(partition.__dict__)
+    return size
+
+
+def run_case(name, rows, k, traced=False):
+    data = synthetic_records(rows)
+    if name == "list":
+        engine = ListMondrianEngine(data, k, 4)
+        whole_partition = ListPartition(list(range(rows)), [0] * engine.qi_len,
+                                        [len(order) - 1 for order in engine.qi_order])
+    else:
+        engine = mondrian.MondrianEngine(data, k, 4)
+        whole_partition = mondrian.Partition(array('i', range(rows)), [0] * engine.qi_len,
+                                             [len(order) - 1 for order in engine.qi_order])
+    if traced:
+        tracemalloc.start()
+    start = time.perf_counter()
+    engine.anonymize_strict(whole_partition)
+    seconds = time.perf_counter() - start
+    del whole_partition
+    kept, peak = 0, 0
+    if traced:
+        kept, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    per_partition = sum(map(partition_bytes, engine.result)) / len(engine.result)
+    return len(engine.result), seconds, peak / 2 ** 20, kept / 2 ** 20, per_partition
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    context = multiprocessing.get_context("spawn")
+    print("%-8s %10s %11s %10s %10s %10s %16s" % (
+        "type", "rows", "partitions", "seconds", "peak MB", "kept MB", "bytes/partition"))
+    for rows in args.rows:
+        for name in ("list", "slotted"):
+            with context.Pool(1) as pool:
+                partitions, seconds, _, _, per_partition = pool.apply(run_case, (name, rows, args.k))
+            with context.Pool(1) as pool:
+                peak, kept = pool.apply(run_case, (name, rows, args.k, True))[2:4]
+            print("%-8s %10d %11d %10.2f %10.1f %10.1f %16.0f" % (
+                name, rows, partitions, seconds, peak, kept, per_partition))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
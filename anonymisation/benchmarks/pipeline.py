@@ -0,0 +1,170 @@
+"""
+Benchmark of the stages of anonymise_wrapper and of storing its release, over synthetic banks
+of increasing size, see synthetic_bank.py and the benchmark_anonymisation command
+
+Every stage of one k value is timed on its own:
+- extract: the aggregate query of WithdrawalRetriever.retrieve_records, or with legacy, the
+  ORM queries of retrieve_transactions and retrieve_accounts then format and read_data
+- read_records, mondrian (the engine and its information loss), covert_to_raw,
+  prepare_output and format_anon_data, like anonymise and get_result_one
+- store: store_anon_database of the release, utility: the ground truth and both queries
+  over the release, like save_statistics but without storing any statistics
+Each stage reports its wall time, the records (customers) it handled per second and the peak
+of the memory it allocated, traced with tracemalloc (numpy reports its buffers to it) in a
+run of its own, so the timed runs are not slowed down by the tracing.
+A run is saved as JSON and compared against an earlier one, see compare.
+"""
+
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+from django.db import connection
+
+from anonymisation.anonymise.overall import (NUM_YEARS1, TRANSACTION_TYPE1, WithdrawalRetriever, ground_truth,
+                                             perform_query)
+from anonymisation.anonymise.utils import anonymiser
+from anonymisation.anonymise.utils.anonymiser import MONDRIAN_ENGINES, covert_to_raw, loss_detail, prepare_output
+from anonymisation.anonymise.utils.database import store_anon_database
+from anonymisation.anonymise.utils.format import AnonymisedDataFormatterBase
+from anonymisation.anonymise.utils.read_data import read_data, read_records
+
+# A stage regresses when it is that much slower, or uses that much more memory, than the
+# baseline, and the difference is above the noise floor
+TIME_TOLERANCE = 0.2
+MEMORY_TOLERANCE = 0.2
+TIME_FLOOR = 0.05
+MEMORY_FLOOR = 8.0
+
+
+def measure(function, *args):
+    """
+    Returns (result of function(*args), seconds, peak MB allocated above the memory allocated
+    at the start, None when tracemalloc is not tracing)
+    """
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    peak_mb = (tracemalloc.get_traced_memory()[1] - start_bytes) / 2 ** 20 if tracing else None
+    return result, seconds, peak_mb
+
+
+def run_pipeline(k_value, legacy=False):
+    """
+    Runs every stage once over the data in the database
+    Returns (records, {stage: {"seconds", "peak_mb"}}), records is 0 when there are fewer than
+    k_value records
+    """
+    retriever = WithdrawalRetriever(TRANSACTION_TYPE1, NUM_YEARS1)
+    stages = {}
+
+    def stage(name, function, *args):
+        result, seconds, peak_mb = measure(function, *args)
+        stages[name] = {"seconds": seconds, "peak_mb": peak_mb}
+        return result
+
+    if legacy:
+        transaction_data, account_data = stage(
+            "orm_extract", lambda: (list(retriever.retrieve_transactions()), list(retriever.retrieve_accounts())))
+        lines = stage("format", retriever.format, transaction_data, account_data)
+        del transaction_data, account_data
+        records = len(lines)
+        data, intuitive_order, qi_num, sa_num = stage("read_data", read_data, lines)
+        del lines
+    else:
+        withdrawal_records = stage("extract", retriever.retrieve_records)
+        records = len(withdrawal_records)
+        data, intuitive_order, qi_num, sa_num = stage("read_records", read_records, withdrawal_records)
+        del withdrawal_records
+    if records < k_value:
+        return 0, {}
+
+    def mondrian():
+        engine = MONDRIAN_ENGINES[anonymiser.ENGINE](data, k_value, qi_num)
+        result, (ncp, _) = engine.anonymize(anonymiser.RELAX)
+        return result, ncp, loss_detail(*engine.information_loss()[1:])
+
+    result = stage("mondrian", mondrian)[0]
+    result = stage("covert_to_raw", covert_to_raw, result, intuitive_order, sa_num, qi_num)
+    output = stage("prepare_output", prepare_output, result)
+    del result
+    anon_data = stage("format_anon_data", AnonymisedDataFormatterBase().format_anon_data, output)
+    del output
+    release = stage("store", lambda: store_anon_database(anon_data, k_value=k_value, publish=False))
+
+    def utility():
+        truth = ground_truth()
+        return perform_query("1", release, truth), perform_query("2", release, truth)
+
+    try:
+        stage("utility", utility)
+    finally:
+        release.delete()
+    return records, stages
+
+
+def run_size(k_value, legacy=False, repeat=1):
+    """
+    Lowest time of repeat runs of every stage, and its peak memory in one traced run
+    Returns {"records", "stages": {stage: {"seconds", "peak_mb", "rows_per_second"}}, "total_seconds"}
+    """
+    records, best = 0, {}
+    for _ in range(repeat):
+        records, stages = run_pipeline(k_value, legacy)
+        for name, measured in stages.items():
+            best[name] = min(best.get(name, measured["seconds"]), measured["seconds"])
+    tracemalloc.start()
+    try:
+        _, traced = run_pipeline(k_value, legacy)
+    finally:
+        tracemalloc.stop()
+    stages = {}
+    for name, seconds in best.items():
+        stages[name] = {
+            "seconds": round(seconds, 4),
+            "peak_mb": round(traced[name]["peak_mb"], 1),
+            "rows_per_second": round(records / seconds) if seconds else None,
+        }
+    return {"records": records, "stages": stages, "total_seconds": round(sum(best.values()), 4)}
+
+
+def environment():
+    with connection.cursor() as cursor:
+        cursor.execute("SHOW server_version")
+        server_version = cursor.fetchone()[0]
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "postgresql": server_version,
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "engine": anonymiser.ENGINE,
+    }
+
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    """
+    Compares the stages of every size of results with the same size and stage of baseline,
+    both in the JSON format of the command
+    Returns [(customers, stage, metric, baseline value, value)] of the regressions
+    """
+    limits = {"seconds": (time_tolerance, TIME_FLOOR), "peak_mb": (memory_tolerance, MEMORY_FLOOR)}
+    sizes = {size["customers"]: size for size in baseline["sizes"]}
+    regressions = []
+    for size in results["sizes"]:
+        before = sizes.get(size["customers"])
+        if before is None:
+            continue
+        for name, measured in size["stages"].items():
+            if name not in before["stages"]:
+                continue
+            for metric, (tolerance, floor) in limits.items():
+                old, new = before["stages"][name][metric], measured[metric]
+                if new > old * (1 + tolerance) and new - old > floor:
+                    regressions.append((size["customers"], name, metric, old, new))
+    return regressions
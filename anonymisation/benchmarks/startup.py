@@ -0,0 +1,101 @@
+"""
+Startup benchmark of a web worker: import time and resident memory once django.setup()
+ran and main.urls was imported, as the first request of a worker does
+
+Usage (with the environment of main.settings):
+```
+DJANGO_SETTINGS_MODULE=main.settings python -m anonymisation.benchmarks.startup --runs 5
+```
+Every run is a fresh interpreter started with -X importtime. "worker" is what every worker
+now pays, "first anonymisation request" adds the imports of the anonymisation serializers,
+what every worker paid before they were deferred to the handlers of anonymisation/views.py.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ["numpy", "matplotlib", "pyarrow"]
+
+# Prints {"rss": {stage: kB}, "modules": heavy modules imported} as its last line
+STARTUP_SCRIPT = """
+import json, sys
+
+def rss():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+result = {"rss": {"interpreter": rss()}}
+import django
+django.setup()
+result["rss"]["django.setup"] = rss()
+import main.urls
+result["rss"]["worker"] = rss()
+if %(anonymisation)r:
+    import anonymisation.serializers
+    result["rss"]["first anonymisation request"] = rss()
+result["modules"] = [name for name in %(heavy)r if name in sys.modules]
+print(json.dumps(result))
+"""
+
+
+def import_times(stderr):
+    """
+    Returns the total import time in microseconds of -X importtime and the cumulative
+    import time of every module
+    """
+    total, times = 0, {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(cumulative)
+        except ValueError:
+            # the header line
+            continue
+        times[name.strip()] = cumulative
+        if not name.startswith("  "):
+            total += cumulative
+    return total, times
+
+
+def run_startup(anonymisation=False):
+    """
+    Returns (rss per stage in kB, heavy modules imported, import times, see import_times)
+    of a fresh worker
+    """
+    script = STARTUP_SCRIPT % {"anonymisation": anonymisation, "heavy": HEAVY_MODULES}
+    environment = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get("DJANGO_SETTINGS_MODULE", "main.settings"))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", script], capture_output=True, text=True,
+                             env=environment, check=True)
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    return result["rss"], result["modules"], import_times(process.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print("%-30s %12s %12s %10s  %s" % ("case", "import ms", "heavy ms", "RSS MB", "heavy modules"))
+    for name, anonymisation in [("worker", False), ("first anonymisation request", True)]:
+        runs = [run_startup(anonymisation) for _ in range(args.runs)]
+        total = statistics.median(total for _, _, (total, _) in runs) / 1000
+        heavy = statistics.median(sum(times.get(module, 0) for module in HEAVY_MODULES)
+                                  for _, _, (_, times) in runs) / 1000
+        rss = statistics.median(rss[name] for rss, _, _ in runs) / 1024
+        print("%-30s %12.1f %12.1f %10.1f  %s" % (name, total, heavy, rss, ", ".join(runs[0][1]) or "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark of the memory used to extract and anonymise the customer base, streamed into
+column buffers (read_columns) against fully materialised records (read_records)
+
+Usage:
+```
+python -m anonymisation.benchmarks.streaming_extraction --rows 5000000 --records-rows 1000000
+DJANGO_SETTINGS_MODULE=main.settings python -m anonymisation.benchmarks.streaming_extraction --database
+```
+Synthetic rows are produced chunk by chunk, like a server-side cursor would return them,
+--database streams the rows of WithdrawalRetriever.records_queryset instead.
+Every case runs in its own process and reports the growth of its peak RSS.
+"""
+
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy as np
+
+from anonymisation.anonymise.utils.read_data import read_columns, read_records
+from anonymisation.anonymise.utils.vector_mondrian import VectorMondrian, encode_qi
+
+GENDERS = ['Female', 'Male', 'Others']
+CITIZENSHIPS = ['Singaporean Citizen', 'Singaporean PR', 'Non-Singaporean']
+
+
+def synthetic_chunks(rows, chunk_size, seed=0):
+    """
+    Yields lists of typed records of WithdrawalRetriever.records, amounts are floats
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, rows, chunk_size):
+        size = min(chunk_size, rows - start)
+        ages = rng.integers(18, 90, size).tolist()
+        genders = rng.integers(0, 3, size).tolist()
+        postal_codes = rng.integers(10000, 830000, size).tolist()
+        citizenships = rng.integers(0, 3, size).tolist()
+        amounts = np.round(rng.gamma(2.0, 800.0, (size, 8)), 2).tolist()
+        yield [(age, GENDERS[gender], postal_code, CITIZENSHIPS[citizenship], *amount)
+               for age, gender, postal_code, citizenship, amount
+               in zip(ages, genders, postal_codes, citizenships, amounts)]
+
+
+def database_chunks(chunk_size):
+    import django
+    django.setup()
+    from anonymisation.anonymise.overall import NUM_YEARS1, WithdrawalRetriever
+    return WithdrawalRetriever('Withdrawal', NUM_YEARS1).stream_records(chunk_size)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(mode, rows, chunk_size, k, database):
+    baseline = peak_rss_mb()
+    chunks = database_chunks(chunk_size) if database else synthetic_chunks(rows, chunk_size)
+    start = time.perf_counter()
+    if mode == "stream":
+        columns = read_columns(chunks, rows)
+        rows = len(columns)
+        qi_rank, qi_order = encode_qi(columns.qi_codes(), columns.qi_num)
+    else:
+        records = [record for chunk in chunks for record in chunk]
+        data, _, qi_num, _ = read_records(records)
+        rows = len(data)
+        qi_rank, qi_order = encode_qi(data, qi_num)
+    extraction = time.perf_counter() - start
+    extraction_mb = peak_rss_mb() - baseline
+    engine = VectorMondrian.from_encoded(qi_rank, qi_order, k)
+    engine.run()
+    total = time.perf_counter() - start
+    return rows, extraction, total, extraction_mb, peak_rss_mb() - baseline
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000000)
+    parser.add_argument("--records-rows", type=int, default=1000000,
+                        help="rows of the materialised case, 0 to skip it")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--database", action="store_true")
+    args = parser.parse_args(argv)
+
+    cases = [("stream", args.rows)]
+    if args.records_rows:
+        cases = [("records", args.records_rows), ("stream", args.records_rows)] + cases
+    context = multiprocessing.get_context("spawn")
+    print("%-8s %10s %14s %14s %12s %16s %14s" % (
+        "mode", "rows", "extract s", "rows/s", "total s", "extract +RSS MB", "total +RSS MB"))
+    for mode, rows in cases:
+        with context.Pool(1) as pool:
+            rows, extraction, total, extraction_mb, total_mb = pool.apply(
+                run_case, (mode, rows, args.chunk_size, args.k, args.database))
+        print("%-8s %10d %14.2f %14.0f %12.2f %16.1f %14.1f" % (
+            mode, rows, extraction, rows / extraction, total, extraction_mb, total_mb))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
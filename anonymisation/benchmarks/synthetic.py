@@ -0,0 +1,33 @@
+"""
+Synthetic records in the format returned by read_data, for benchmarks of the engines
+"""
+
+import numpy as np
+
+GENDER_WEIGHTS = [0.49, 0.49, 0.02]
+CITIZENSHIP_WEIGHTS = [0.62, 0.14, 0.24]
+
+
+def synthetic_records(size, seed=0, skewed=False):
+    """
+    Returns size records [age, gender, postal_code, citizenship, 5 withdrawal sums, 3 balances],
+    QIs are integers (categorical QIs already coded) and SAs are strings, like read_data.
+    skewed concentrates ages and postal codes on a few values, which gives long chains of
+    unbalanced splits
+    """
+    rng = np.random.default_rng(seed)
+    if skewed:
+        ages = np.minimum(18 + rng.geometric(0.08, size), 99)
+        postal_codes = 10000 + rng.zipf(1.3, size) % 820000
+    else:
+        ages = rng.integers(18, 90, size)
+        postal_codes = rng.integers(10000, 830000, size)
+    genders = rng.choice(3, size, p=GENDER_WEIGHTS)
+    citizenships = rng.choice(3, size, p=CITIZENSHIP_WEIGHTS)
+    sums = np.round(rng.gamma(2.0, 800.0, (size, 5)) * (rng.random((size, 5)) < 0.8), 2)
+    balances = np.round(rng.lognormal(7.5, 1.2, (size, 3)) * (rng.random((size, 3)) < 0.6), 2)
+    records = []
+    for qi, sa in zip(np.column_stack((ages, genders, postal_codes, citizenships)).tolist(),
+                      np.column_stack((sums, balances)).astype(str).tolist()):
+        records.append(qi + sa)
+    return records
@@ -0,0 +1,401 @@
+"""
+Synthetic banking database for benchmarks: customers, staff, accounts, tickets, the
+transactions of the last years and login/access logs
+
+Unlike synthetic.py, which makes the records read_data returns, this fills the tables that
+the anonymisation and the rest of the application read, at scales of 10^4 to 10^7 rows.
+Customers are generated SyntheticBank.chunk_size at a time, every chunk is written with one
+PostgreSQL COPY per table. Everything is drawn from a generator seeded with the seed and the
+chunk, so the same options give the same data, apart from the dates, which are relative to
+today like the windows of the anonymisation.
+
+Distributions:
+- citizenship and gender mix of synthetic.py, adult ages, postal codes of the sectors of
+  every district with the residential districts three times as likely
+- every customer has a savings account, some a credit card or investments, log-normal balances
+- withdrawals are more frequent around Chinese New Year, the June holidays and year-end,
+  see WITHDRAWAL_SEASONALITY, and most transactions are made during the day
+"""
+
+import csv
+import io
+from datetime import datetime, timezone
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+
+from anonymisation.anonymise.utils.hierarchy import POSTAL_DISTRICTS
+from anonymisation.benchmarks.synthetic import CITIZENSHIP_WEIGHTS, GENDER_WEIGHTS
+from customer.models import Accounts, AccountTypes, Customer, Transactions
+from log.models import AccessControlLogs, ConflictOfInterestLogs, LoginLog, Severity
+from staff.models import RequestCloseAccount, RequestOpenAccount, Staff, Tickets
+from user.models import TwoFA, User
+
+GENDERS = [Customer.Gender.FEMALE, Customer.Gender.MALE, Customer.Gender.OTHERS]
+CITIZENSHIPS = [Customer.Citizenship.CITIZEN, Customer.Citizenship.PR, Customer.Citizenship.NON_SINGAPOREAN]
+# (lowest age, highest age, share of the customers)
+AGE_BRACKETS = [(18, 24, 0.10), (25, 34, 0.19), (35, 44, 0.20), (45, 54, 0.19), (55, 64, 0.17), (65, 74, 0.11),
+                (75, 90, 0.04)]
+RESIDENTIAL_DISTRICTS = [5, 12, 16, 18, 19, 20, 22, 23, 25, 27]
+# (account type, share of the customers with one, mean and sigma of the log of the balance)
+ACCOUNTS = [("Savings", 1.0, 9.0, 1.2), ("Credit Card", 0.6, 7.0, 1.0), ("Investments", 0.3, 10.0, 1.5)]
+ACCOUNT_STATUS_WEIGHTS = [0.95, 0.02, 0.03]
+# Withdrawals of every month relative to an average month
+WITHDRAWAL_SEASONALITY = [1.3, 1.25, 0.9, 0.9, 0.95, 1.1, 1.0, 0.95, 0.9, 0.95, 1.05, 1.4]
+# Transactions of every hour of the day, in Singapore time
+HOUR_WEIGHTS = [1, 0.5, 0.3, 0.2, 0.2, 0.4, 1, 2, 4, 5, 5, 6, 7, 6, 5, 5, 5, 6, 7, 7, 6, 4, 3, 2]
+SINGAPORE_OFFSET = np.timedelta64(8, "h")
+# (type, share of the transactions, mean and sigma of the log of the amount, description)
+TRANSACTIONS = [(Transactions.TransactionTypes.WITHDRAWAL, 0.5, 4.5, 0.8, "ATM Withdrawal"),
+                (Transactions.TransactionTypes.DEPOSIT, 0.3, 6.0, 0.9, "ATM Deposit"),
+                (Transactions.TransactionTypes.TRANSFER, 0.2, 5.0, 1.0, "Transfer")]
+# Titles of the staff, in turn
+STAFF_TITLES = [Staff.Title.REVIEWER] * 4 + [Staff.Title.AUDITOR, Staff.Title.RESEARCHER, Staff.Title.ANONYMISER]
+TICKET_STATUS_WEIGHTS = [0.25, 0.6, 0.15]
+LOGIN_SUCCESS_RATE = 0.92
+ACCESS_VIEWS = ["View Anon Stats", "Set K Value", "Get Anon Data", "Query Anon", "Get Login Logs", "Get Tickets"]
+FIRST_NAMES = ["Wei Ming", "Hui Min", "Jun Jie", "Siti", "Muhammad", "Priya", "Arjun", "Mei Ling", "Kumar", "Nur",
+               "Daniel", "Rachel", "Jia Hui", "Ahmad", "Li Na", "Ravi"]
+LAST_NAMES = ["Tan", "Lim", "Lee", "Ng", "Ong", "Wong", "Goh", "Chua", "Koh", "Teo", "Abdullah", "Rahman", "Singh",
+              "Pillai", "Chan", "Yeo"]
+PASSWORD = "Synthetic@Bank1"
+CUSTOMER_USERNAME = "synthetic_customer_%d"
+STAFF_USERNAME = "synthetic_staff_%d"
+UUID_VARIANT = 0x8000000000000000
+# Every table the generator writes, in the order of their foreign keys
+TABLES = [User, Customer, Staff, Accounts, Transactions, Tickets, RequestOpenAccount, RequestCloseAccount, LoginLog,
+          AccessControlLogs]
+
+
+def copy_rows(cursor, model, columns, rows):
+    """
+    Loads rows with a single PostgreSQL COPY, like copy_anon_rows. None is written as NULL,
+    so no column may hold an empty string.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    table = cursor.db.ops.quote_name(model._meta.db_table)
+    columns = ', '.join(map(cursor.db.ops.quote_name, columns))
+    cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (table, columns), buffer)
+
+
+def truncate_tables(cursor):
+    """
+    Empties the tables the generator writes, and every table referencing them
+    """
+    # TRUNCATE fails while deferred foreign key checks are pending in the transaction
+    cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    models = TABLES + [ConflictOfInterestLogs, TwoFA]
+    cursor.execute("TRUNCATE %s CASCADE" % ", ".join(cursor.db.ops.quote_name(model._meta.db_table)
+                                                     for model in models))
+    cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+
+
+def timestamps(values):
+    return np.datetime_as_string(values, unit="s", timezone="UTC").tolist()
+
+
+def amounts(rng, mean, sigma, size, highest=1e9):
+    return np.round(np.minimum(rng.lognormal(mean, sigma, size), highest), 2).tolist()
+
+
+class SyntheticBank(object):
+
+    """
+    self.customers, self.staff: how many of each to generate
+    self.years: transactions are dated from the 1st of January years - 1 years ago to now
+    self.transactions_per_year, self.logins_per_year: mean per customer and per user,
+    self.tickets_per_customer: mean per customer
+    """
+
+    def __init__(self, customers, staff=50, years=5, transactions_per_year=24, tickets_per_customer=0.2,
+                 logins_per_year=12, seed=0, chunk_size=2000, now=None):
+        self.customers = customers
+        self.staff = max(staff, len(STAFF_TITLES))
+        self.years = years
+        self.transactions_per_year = transactions_per_year
+        self.tickets_per_customer = tickets_per_customer
+        self.logins_per_year = logins_per_year
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.now = np.datetime64((now or datetime.now(timezone.utc)).replace(tzinfo=None), "s")
+
+        rng = np.random.default_rng([seed])
+        # high 64 bits of the uuids of every table, the low ones are the index of the row
+        self.prefixes = {name: (int(rng.integers(2 ** 63)) & ~0xF000) | 0x4000
+                         for name in ["customer", "staff", "account", "transaction", "ticket"]}
+        self.password = make_password(PASSWORD, salt="synthetic")
+        local_today = (self.now + SINGAPORE_OFFSET).astype("datetime64[D]")
+        start = np.datetime64("%d-01-01" % (local_today.astype("datetime64[Y]").astype(int) + 1970 - years + 1))
+        self.days = np.arange(start, local_today + 1)
+        self.window_years = len(self.days) / 365.25
+        months = self.days.astype("datetime64[M]").astype(int) % 12
+        weights = np.array(WITHDRAWAL_SEASONALITY)[months]
+        self.withdrawal_days = weights / weights.sum()
+        self.hours = np.array(HOUR_WEIGHTS) / sum(HOUR_WEIGHTS)
+        sectors = [sector for sectors in POSTAL_DISTRICTS for sector in sectors]
+        sector_weights = np.array([3.0 if district + 1 in RESIDENTIAL_DISTRICTS else 1.0
+                                   for district, sectors in enumerate(POSTAL_DISTRICTS) for _ in sectors])
+        self.sectors = np.array(sectors)
+        self.sector_weights = sector_weights / sector_weights.sum()
+        self.reviewers = [index for index in range(self.staff)
+                          if STAFF_TITLES[index % len(STAFF_TITLES)] == Staff.Title.REVIEWER]
+        self.account_types = None
+        self.transaction_count = 0
+        self.ticket_count = 0
+
+    def uuids(self, name, indices):
+        prefix = self.prefixes[name]
+        return ["%016x%016x" % (prefix, UUID_VARIANT | index) for index in indices]
+
+    def customer_ids(self, indices):
+        return self.uuids("customer", indices)
+
+    def staff_ids(self, indices):
+        return self.uuids("staff", indices)
+
+    def account_ids(self, customers, slots):
+        # slot is the index of the account type in ACCOUNTS, so the account of any customer is known
+        return self.uuids("account", (np.asarray(customers) * len(ACCOUNTS) + slots).tolist())
+
+    def moments(self, rng, size, day_weights=None):
+        """
+        Random times of the window, Singapore days weighted by day_weights and hours by HOUR_WEIGHTS,
+        none after now
+        """
+        days = self.days[rng.choice(len(self.days), size, p=day_weights)]
+        seconds = rng.choice(24, size, p=self.hours) * 3600 + rng.integers(0, 3600, size)
+        values = days.astype("datetime64[s]") + seconds.astype("timedelta64[s]") - SINGAPORE_OFFSET
+        return np.minimum(values, self.now)
+
+    def before_window(self, rng, size, days=3650):
+        start = self.days[0].astype("datetime64[s]") - SINGAPORE_OFFSET
+        return start - rng.integers(1, days * 86400, size).astype("timedelta64[s]")
+
+    def users(self, rng, ids, usernames, user_type):
+        size = len(ids)
+        joined = timestamps(self.before_window(rng, size))
+        phones = (rng.choice([80000000, 90000000], size) + rng.integers(0, 10000000, size)).tolist()
+        return [(user, self.password, last_login, False, username, username + "@example.com", phone, user_type,
+                 last_login, True)
+                for user, username, phone, last_login in zip(ids, usernames, phones, joined)]
+
+    def user_columns(self):
+        return ["user", "password", "last_login", "is_superuser", "username", "email", "phone_no", "type",
+                "date_joined", "is_active"]
+
+    def people(self, rng, size):
+        """
+        Returns names, birth dates and genders of size people
+        """
+        brackets = rng.choice(len(AGE_BRACKETS), size, p=[share for _, _, share in AGE_BRACKETS])
+        lowest = np.array([low for low, _, _ in AGE_BRACKETS])[brackets]
+        highest = np.array([high for _, high, _ in AGE_BRACKETS])[brackets]
+        ages = rng.integers(lowest, highest + 1)
+        today = self.days[-1]
+        birth_dates = (today - (ages * 365.25 + rng.integers(1, 365, size)).astype("timedelta64[D]"))
+        first_names = rng.choice(FIRST_NAMES, size).tolist()
+        last_names = rng.choice(LAST_NAMES, size).tolist()
+        genders = rng.choice(GENDERS, size, p=GENDER_WEIGHTS).tolist()
+        return first_names, last_names, np.datetime_as_string(birth_dates).tolist(), birth_dates, genders
+
+    def staff_tables(self):
+        rng = np.random.default_rng([self.seed, 0])
+        indices = range(self.staff)
+        ids = self.staff_ids(indices)
+        usernames = [STAFF_USERNAME % index for index in indices]
+        first_names, last_names, birth_dates, _, genders = self.people(rng, self.staff)
+        titles = [STAFF_TITLES[index % len(STAFF_TITLES)] for index in indices]
+        yield User, self.user_columns(), self.users(rng, ids, usernames, User.user_type.STAFF)
+        yield Staff, ["user_id", "first_name", "last_name", "title", "birth_date", "gender"], \
+            zip(ids, first_names, last_names, titles, birth_dates, genders)
+        yield from self.log_tables(rng, ids, usernames, User.user_type.STAFF, titles)
+
+    def customer_tables(self, start, size):
+        """
+        Yields (model, columns, rows) of every table for the customers start to start + size
+        """
+        rng = np.random.default_rng([self.seed, 1 + start // self.chunk_size])
+        indices = np.arange(start, start + size)
+        ids = self.customer_ids(indices.tolist())
+        usernames = [CUSTOMER_USERNAME % index for index in indices.tolist()]
+        yield User, self.user_columns(), self.users(rng, ids, usernames, User.user_type.CUSTOMER)
+
+        first_names, last_names, birth_dates, birth_days, genders = self.people(rng, size)
+        citizenships = rng.choice(len(CITIZENSHIPS), size, p=CITIZENSHIP_WEIGHTS)
+        # S and T for citizens and PRs born before and since 2000, F and G for foreigners
+        born_2000 = (birth_days >= np.datetime64("2000-01-01")).astype(int)
+        prefixes = np.where(citizenships < 2, np.array(["S", "T"])[born_2000], np.array(["F", "G"])[born_2000])
+        identity_nos = ["%s%07d%s" % identity for identity in zip(
+            prefixes.tolist(), rng.integers(0, 10000000, size).tolist(),
+            rng.choice(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"), size).tolist())]
+        sectors = rng.choice(self.sectors, size, p=self.sector_weights)
+        postal_codes = ["%06d" % code for code in (sectors * 10000 + rng.integers(0, 10000, size)).tolist()]
+        addresses = ["Blk %d Street %d #%02d-%02d" % address for address in zip(
+            *(rng.integers(1, high, size).tolist() for high in [999, 99, 30, 200]))]
+        yield Customer, ["user_id", "first_name", "last_name", "birth_date", "identity_no", "address", "postal_code",
+                         "citizenship", "gender"], \
+            zip(ids, first_names, last_names, birth_dates, identity_nos, addresses, postal_codes,
+                [CITIZENSHIPS[citizenship] for citizenship in citizenships.tolist()], genders)
+
+        owners, slots = [], []
+        balances, types = [], []
+        for slot, (name, share, mean, sigma) in enumerate(ACCOUNTS):
+            has_account = rng.random(size) < share
+            owners.append(indices[has_account])
+            slots.append(np.full(has_account.sum(), slot))
+            balances += amounts(rng, mean, sigma, has_account.sum())
+            types += [self.account_types[name]] * int(has_account.sum())
+        owners, slots = np.concatenate(owners), np.concatenate(slots)
+        statuses = rng.choice(Accounts.AccountStatus.values, len(owners), p=ACCOUNT_STATUS_WEIGHTS).tolist()
+        yield Accounts, ["account", "user_id", "type_id", "balance", "status", "date_created"], \
+            zip(self.account_ids(owners, slots), self.customer_ids(owners.tolist()), types, balances, statuses,
+                timestamps(self.before_window(rng, len(owners), 365)))
+
+        yield Transactions, ["transaction", "transaction_type", "sender_id", "recipient_id", "description", "amount",
+                             "date"], self.transactions(rng, indices)
+        yield from self.ticket_tables(rng, indices)
+        yield from self.log_tables(rng, ids, usernames, User.user_type.CUSTOMER,
+                                   [User.user_type.CUSTOMER] * size)
+
+    def transactions(self, rng, indices):
+        """
+        Transactions of the savings accounts of the customers: withdrawals from it, deposits
+        into it and transfers to the savings account of a customer generated so far
+        """
+        counts = rng.poisson(self.transactions_per_year * self.window_years, len(indices))
+        spending = rng.lognormal(0, 0.5, len(indices))
+        owners = np.repeat(indices, counts)
+        factors = np.repeat(spending, counts)
+        size = len(owners)
+        kinds = rng.choice(len(TRANSACTIONS), size, p=[share for _, share, _, _, _ in TRANSACTIONS])
+        rows = []
+        for kind, (transaction_type, _, mean, sigma, description) in enumerate(TRANSACTIONS):
+            chosen = kinds == kind
+            count = int(chosen.sum())
+            accounts = self.account_ids(owners[chosen], 0)
+            day_weights = self.withdrawal_days if transaction_type == Transactions.TransactionTypes.WITHDRAWAL else None
+            dates = timestamps(self.moments(rng, count, day_weights))
+            values = np.round(np.minimum(rng.lognormal(mean, sigma, count) * factors[chosen], 1e9), 2).tolist()
+            if transaction_type == Transactions.TransactionTypes.DEPOSIT:
+                senders, recipients = [None] * count, accounts
+            elif transaction_type == Transactions.TransactionTypes.WITHDRAWAL:
+                senders, recipients = accounts, [None] * count
+            else:
+                others = rng.integers(0, indices[-1] + 1, count)
+                # a customer does not transfer to their own account
+                others = np.where(others == owners[chosen], (others + 1) % (indices[-1] + 1), others)
+                senders, recipients = accounts, self.account_ids(others, 0)
+            rows += zip(senders, recipients, [description] * count, values, dates, [transaction_type] * count)
+        ids = self.uuids("transaction", range(self.transaction_count, self.transaction_count + len(rows)))
+        self.transaction_count += len(rows)
+        return [(transaction, transaction_type, sender, recipient, description, amount, date)
+                for transaction, (sender, recipient, description, amount, date, transaction_type) in zip(ids, rows)]
+
+    def ticket_tables(self, rng, indices):
+        """
+        Requests to open an account and to close the savings account, closed by a ticket reviewer
+        unless they are still open
+        """
+        counts = rng.poisson(self.tickets_per_customer, len(indices))
+        creators = np.repeat(indices, counts)
+        size = len(creators)
+        ids = self.uuids("ticket", range(self.ticket_count, self.ticket_count + size))
+        self.ticket_count += size
+        opening = rng.random(size) < 0.7
+        statuses = rng.choice(Tickets.TicketStatus.values, size, p=TICKET_STATUS_WEIGHTS)
+        created = self.moments(rng, size)
+        closed = created + rng.integers(60, 7 * 86400, size).astype("timedelta64[s]")
+        is_open = statuses == Tickets.TicketStatus.OPEN
+        reviewers = self.staff_ids(rng.choice(self.reviewers, size).tolist())
+        yield Tickets, ["ticket", "ticket_type", "status", "created_by_id", "created_date", "closed_by_id",
+                        "closed_date"], \
+            zip(ids, np.where(opening, Tickets.TicketType.OPEN_ACCOUNT, Tickets.TicketType.CLOSE_ACCOUNT).tolist(),
+                statuses.tolist(), self.customer_ids(creators.tolist()), timestamps(created),
+                [None if still_open else reviewer for still_open, reviewer in zip(is_open.tolist(), reviewers)],
+                [None if still_open else date for still_open, date in zip(is_open.tolist(), timestamps(closed))])
+        account_types = rng.choice(list(self.account_types.values()), size).tolist()
+        yield RequestOpenAccount, ["ticket_id", "account_type_id"], \
+            [(ticket, account_type) for ticket, account_type, is_opening in zip(ids, account_types, opening) if is_opening]
+        yield RequestCloseAccount, ["ticket_id", "account_id_id"], \
+            [(ticket, account) for ticket, account, is_opening
+             in zip(ids, self.account_ids(creators, 0), opening) if not is_opening]
+
+    def log_tables(self, rng, ids, usernames, user_type, permission_types):
+        """
+        Login attempts of every user, from the address of the user, and a few access control
+        violations, with the counts and severities of log.logging
+        """
+        addresses = ["10.%d.%d.%d" % address for address in zip(*(rng.integers(0, 256, (3, len(ids))).tolist()))]
+        counts = rng.poisson(self.logins_per_year * self.window_years, len(ids))
+        users = np.repeat(np.arange(len(ids)), counts)
+        size = len(users)
+        success = rng.random(size) < LOGIN_SUCCESS_RATE
+        failures = np.where(success, 0, np.minimum(rng.geometric(0.6, size), 10))
+        severities = np.select([success, failures > 4, failures > 2], [Severity.INFO, Severity.HIGH, Severity.MEDIUM],
+                               Severity.LOW).tolist()
+        yield LoginLog, ["login_type", "is_success", "username", "user_id", "ip", "timestamp", "count", "severity"], \
+            [(user_type, is_success, usernames[user], ids[user], addresses[user], moment, count, severity)
+             for user, is_success, moment, count, severity
+             in zip(users.tolist(), success.tolist(), timestamps(self.moments(rng, size)), failures.tolist(),
+                    severities)]
+
+        counts = rng.poisson(0.05 * self.window_years, len(ids))
+        users = np.repeat(np.arange(len(ids)), counts)
+        size = len(users)
+        violations = np.minimum(rng.geometric(0.5, size), 10)
+        severities = np.select([violations > 4, violations > 2], [Severity.HIGH, Severity.MEDIUM], Severity.LOW).tolist()
+        api_types = rng.choice(Staff.Title.values, size).tolist()
+        views = rng.choice(ACCESS_VIEWS, size).tolist()
+        yield AccessControlLogs, ["user_id", "user_permission_type", "user_violation_count", "api_permission_type",
+                                  "api_view_name", "ip", "ip_violation_count", "timestamp", "severity"], \
+            [(ids[user], permission_types[user], violation, api_type, view, addresses[user], violation, moment, severity)
+             for user, violation, api_type, view, moment, severity
+             in zip(users.tolist(), violations.tolist(), api_types, views, timestamps(self.moments(rng, size)),
+                    severities)]
+
+    def chunks(self):
+        """
+        Yields the tables of the staff, then of every chunk of customers, as lists of
+        (model, columns, rows)
+        """
+        yield list(self.staff_tables())
+        for start in range(0, self.customers, self.chunk_size):
+            yield list(self.customer_tables(start, min(self.chunk_size, self.customers - start)))
+
+    def load_account_types(self):
+        self.account_types = {}
+        for name, _, _, _ in ACCOUNTS:
+            self.account_types[name] = AccountTypes.objects.get_or_create(name=name)[0].pk
+
+    def load(self, truncate=False, progress=None):
+        """
+        Writes every chunk in a transaction of its own, which bounds the deferred foreign key
+        checks PostgreSQL keeps, and analyzes the tables. progress is called with the rows
+        written so far after every chunk.
+        Returns {model: rows written}
+        """
+        written = dict.fromkeys(TABLES, 0)
+        with transaction.atomic():
+            if truncate:
+                with connection.cursor() as cursor:
+                    truncate_tables(cursor)
+            self.load_account_types()
+        for tables in self.chunks():
+            with transaction.atomic(), connection.cursor() as cursor:
+                for model, columns, rows in tables:
+                    rows = list(rows)
+                    if rows:
+                        copy_rows(cursor, model, columns, rows)
+                    written[model] += len(rows)
+            if progress is not None:
+                progress(written)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE %s" % ", ".join(connection.ops.quote_name(model._meta.db_table) for model in TABLES))
+        return written
+
+
+def synthetic_bank_exists():
+    return User.objects.filter(username__in=[CUSTOMER_USERNAME % 0, STAFF_USERNAME % 0]).exists()
@@ -0,0 +1,139 @@
+"""
+Streaming export of the published release
+
+The rows are read with values_list().iterator(), a server-side cursor, and encoded
+EXPORT_CHUNK_SIZE rows at a time, so the memory of a download does not grow with the
+size of the release. The format is one of EXPORT_FORMATS:
+- csv, and csv.gz compressed on the fly
+- parquet and arrow (Arrow IPC stream), columnar and compressed, they need pyarrow,
+  which is only imported when such a file is asked for
+"""
+
+import csv
+import io
+import zlib
+
+from anonymisation.models import Anonymisation
+
+EXPORT_CHUNK_SIZE = 10000
+ANON_FIELDS = ["id", "age", "gender", "postal_code", "citizenship", "first_sum", "second_sum", "third_sum",
+               "fourth_sum", "fifth_sum", "first_balance", "second_balance", "third_balance"]
+HEADER = ["id", "age", "gender", "postal_code", "citizenship", "2019 sum", "2020 sum", "2021 sum", "2022 sum",
+          "2023 sum", "savings balance", "credit card balance", "investment balance"]
+# format: (content type, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "csv.gz": ("application/gzip", "csv.gz"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow"),
+}
+FILE_NAME = "drck_banking_anon_data"
+
+
+def anon_chunks(chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields the rows of the published release in lists of up to chunk_size tuples
+    """
+    rows = Anonymisation.objects.published().order_by("id").values_list(*ANON_FIELDS).iterator(chunk_size)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_stream(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HEADER)
+    for chunk in chunks:
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def gzip_stream(stream):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for data in stream:
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class ChunkSink(io.RawIOBase):
+
+    """
+    Write-only file that keeps what was written until it is drained
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def arrow_schema():
+    import pyarrow as pa
+
+    fields = [pa.field("id", pa.int32())]
+    fields += [pa.field(name, pa.string()) for name in HEADER[1:5]]
+    fields += [pa.field(name, pa.decimal128(24, 2)) for name in HEADER[5:10]]
+    fields += [pa.field(name, pa.decimal128(12, 2)) for name in HEADER[10:]]
+    return pa.schema(fields)
+
+
+def columnar_stream(chunks, file_format):
+    """
+    Encodes every chunk as one record batch of an Arrow IPC stream, or one row group of a
+    Parquet file, and yields the bytes written for it
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = arrow_schema()
+    sink = ChunkSink()
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+    for chunk in chunks:
+        batch = pa.RecordBatch.from_arrays([pa.array(column, type=field.type)
+                                            for column, field in zip(zip(*chunk), schema)], schema=schema)
+        writer.write_batch(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_stream(file_format, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Returns an iterator over the bytes of the published release in file_format
+    """
+    chunks = anon_chunks(chunk_size)
+    if file_format == "csv":
+        return csv_stream(chunks)
+    if file_format == "csv.gz":
+        return gzip_stream(csv_stream(chunks))
+    return columnar_stream(chunks, file_format)
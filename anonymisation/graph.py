@@ -0,0 +1,175 @@
+"""
+Graph of the information loss and utilities of every k value
+
+Statistics only change when a sweep or generate_k_anon stores them, so the graph is rendered
+once per version of the statistics (a hash of the plotted values) and kept in the cache.
+The version is the ETag of ViewAnonStatsView. Besides the PNG drawn with matplotlib there
+is an SVG drawn without it, and the plotted values themselves as JSON.
+"""
+
+import hashlib
+import io
+import json
+from xml.sax.saxutils import escape
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from anonymisation.models import Statistics
+
+GRAPH_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+# format: content type
+GRAPH_FORMATS = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "json": "application/json",
+}
+TITLE = "Information Loss and Utility against k-value"
+# (key in the series, label, colour, left or right axis)
+LINES = [
+    ("info_loss", "Information Loss (%)", "red", "left"),
+    ("utility_query1", "Utility for Query 1 (%)", "blue", "right"),
+    ("utility_query2", "Utility for Query 2 (%)", "green", "right"),
+]
+
+SVG_WIDTH, SVG_HEIGHT = 640, 480
+SVG_PLOT = (96, 72, 544, 408)  # left, top, right, bottom
+
+
+def statistics_series():
+    """
+    Returns the plotted values, in increasing order of k, with the time of the oldest statistic
+    """
+    series = {"k_values": [], "info_loss": [], "utility_query1": [], "utility_query2": []}
+    last_updated = timezone.now()
+    rows = Statistics.objects.order_by("k_value").values_list(
+        "k_value", "info_loss", "utility_query1", "utility_query2", "last_updated")
+    for k_value, info_loss, utility_query1, utility_query2, updated in rows:
+        series["k_values"].append(k_value)
+        series["info_loss"].append(float(info_loss))
+        series["utility_query1"].append(float(utility_query1))
+        series["utility_query2"].append(float(utility_query2))
+        last_updated = min(last_updated, updated)
+    series["last_updated"] = last_updated.astimezone().isoformat() if series["k_values"] else None
+    return series
+
+
+def series_version(series):
+    return hashlib.sha256(json.dumps(series, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def footer(series):
+    return "Last updated: " + (series["last_updated"] or timezone.now().astimezone().isoformat())
+
+
+def render_png(series):
+    """
+    Draws the graph on a figure of its own, no pyplot state is kept between requests
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axis1 = figure.add_axes((0.15, 0.15, 0.7, 0.7))
+    axis2 = axis1.twinx()
+    for key, label, colour, side in LINES:
+        (axis1 if side == "left" else axis2).plot(series["k_values"], series[key], color=colour, label=label)
+
+    axis1.set_xlabel("k-value")
+    axis1.set_ylabel("Information Loss (%)")
+    axis2.set_ylabel("Utility (%)")
+    lines, labels = axis1.get_legend_handles_labels()
+    lines2, labels2 = axis2.get_legend_handles_labels()
+    axis2.legend(lines + lines2, labels + labels2)
+    axis1.set_xticks(series["k_values"])
+    axis2.set_title(TITLE, fontweight="bold")
+    figure.text(0.55, 0.01, footer(series), horizontalalignment="left", fontsize=8)
+
+    stream = io.BytesIO()
+    figure.savefig(stream, format="png")
+    return stream.getvalue()
+
+
+def axis_limit(values):
+    """
+    Upper limit of an axis starting at 0, rounded up to a multiple of 10
+    """
+    highest = max(values, default=0)
+    return max(10, -(-highest // 10) * 10)
+
+
+def render_svg(series):
+    """
+    Draws the same graph as render_png as plain SVG, without matplotlib
+    """
+    left, top, right, bottom = SVG_PLOT
+    k_values = series["k_values"]
+    k_low, k_high = (k_values[0], k_values[-1]) if k_values else (0, 1)
+    limits = {"left": axis_limit(series["info_loss"]),
+              "right": axis_limit(series["utility_query1"] + series["utility_query2"])}
+
+    def x(k_value):
+        if k_high == k_low:
+            return (left + right) / 2
+        return left + (k_value - k_low) * (right - left) / (k_high - k_low)
+
+    def y(value, side):
+        return bottom - value * (bottom - top) / limits[side]
+
+    parts = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d" '
+        'font-family="sans-serif" font-size="11">' % (SVG_WIDTH, SVG_HEIGHT, SVG_WIDTH, SVG_HEIGHT),
+        '<rect width="100%" height="100%" fill="white"/>',
+        '<text x="%d" y="40" text-anchor="middle" font-size="14" font-weight="bold">%s</text>'
+        % (SVG_WIDTH / 2, escape(TITLE)),
+        '<rect x="%d" y="%d" width="%d" height="%d" fill="none" stroke="black"/>'
+        % (left, top, right - left, bottom - top),
+    ]
+    for k_value in k_values:
+        parts.append('<text x="%.1f" y="%d" text-anchor="middle">%d</text>' % (x(k_value), bottom + 16, k_value))
+    for step in range(6):
+        for side, anchor, position in [("left", "end", left - 6), ("right", "start", right + 6)]:
+            value = limits[side] * step / 5
+            parts.append('<text x="%d" y="%.1f" text-anchor="%s">%g</text>'
+                         % (position, y(value, side) + 4, anchor, value))
+    parts += [
+        '<text x="%d" y="%d" text-anchor="middle">k-value</text>' % ((left + right) / 2, bottom + 36),
+        '<text transform="translate(%d %d) rotate(-90)" text-anchor="middle">Information Loss (%%)</text>'
+        % (left - 48, (top + bottom) / 2),
+        '<text transform="translate(%d %d) rotate(90)" text-anchor="middle">Utility (%%)</text>'
+        % (right + 48, (top + bottom) / 2),
+    ]
+    for index, (key, label, colour, side) in enumerate(LINES):
+        points = " ".join("%.1f,%.1f" % (x(k_value), y(value, side)) for k_value, value in zip(k_values, series[key]))
+        parts.append('<polyline points="%s" fill="none" stroke="%s" stroke-width="1.5"/>' % (points, colour))
+        legend_y = top + 16 + index * 16
+        parts.append('<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="%s" stroke-width="1.5"/>'
+                     % (right - 170, legend_y - 4, right - 150, legend_y - 4, colour))
+        parts.append('<text x="%d" y="%d">%s</text>' % (right - 144, legend_y, escape(label)))
+    parts.append('<text x="%d" y="%d" font-size="8">%s</text>' % (SVG_WIDTH * 0.55, SVG_HEIGHT - 6, escape(footer(series))))
+    parts.append("</svg>")
+    return "\n".join(parts).encode()
+
+
+def render(series, graph_format):
+    if graph_format == "png":
+        return render_png(series)
+    if graph_format == "svg":
+        return render_svg(series)
+    return json.dumps(series).encode()
+
+
+def stats_graph(graph_format, series=None):
+    """
+    Returns (version, content) of the graph in graph_format, it is only rendered when
+    the cache has none for the current version of the statistics
+    """
+    series = statistics_series() if series is None else series
+    version = series_version(series)
+    key = "anonymisation:stats_graph:%s:%s" % (version, graph_format)
+    content = cache.get(key)
+    if content is None:
+        content = render(series, graph_format)
+        cache.set(key, content, GRAPH_CACHE_TIMEOUT)
+    return version, content
@@ -0,0 +1,94 @@
+"""
+Background statistics sweeps
+
+CalculateAnonView only queues an AnonymisationJob, the sweep runs in a worker process
+(manage.py run_anonymisation_worker) that polls the job table. No broker is needed, the
+database is the queue. Cancellation is cooperative: the worker checks the job between
+two k values and stops there.
+"""
+
+from django.db import transaction
+from django.utils import timezone
+
+from anonymisation.anonymise.overall import TooShortException
+from anonymisation.graph import stats_graph
+from anonymisation.models import AnonymisationJob
+from anonymisation.wrapper import generate_statistics
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def submit_job(force=False):
+    """
+    Queues a sweep and returns its job, or the job already queued or running
+    """
+    with transaction.atomic():
+        job = AnonymisationJob.objects.select_for_update().filter(status__in=AnonymisationJob.ACTIVE).order_by("id").first()
+        if job is None:
+            job = AnonymisationJob.objects.create(force=force)
+    return job
+
+
+def cancel_job(job):
+    """
+    Cancels a queued job at once, a running job stops at its next progress report
+    """
+    if job.status == AnonymisationJob.Status.QUEUED:
+        AnonymisationJob.objects.filter(pk=job.pk, status=AnonymisationJob.Status.QUEUED).update(
+            status=AnonymisationJob.Status.CANCELLED, cancel_requested=True, finished=timezone.now())
+    elif job.status == AnonymisationJob.Status.RUNNING:
+        AnonymisationJob.objects.filter(pk=job.pk).update(cancel_requested=True)
+    job.refresh_from_db()
+    return job
+
+
+def claim_job():
+    """
+    Marks the oldest queued job as running and returns it, None if there is none.
+    Concurrent workers skip the rows locked by each other (a no-op on SQLite).
+    """
+    with transaction.atomic():
+        job = (AnonymisationJob.objects.select_for_update(skip_locked=True)
+               .filter(status=AnonymisationJob.Status.QUEUED).order_by("id").first())
+        if job is None:
+            return None
+        job.status = AnonymisationJob.Status.RUNNING
+        job.started = timezone.now()
+        job.save(update_fields=["status", "started"])
+    return job
+
+
+def job_progress(job):
+    """
+    Progress callback of generate_statistics for job, raises JobCancelled once it is requested
+    """
+    def progress(stage, done, total):
+        AnonymisationJob.objects.filter(pk=job.pk).update(stage=stage, done=done, total=total)
+        if AnonymisationJob.objects.filter(pk=job.pk, cancel_requested=True).exists():
+            raise JobCancelled("Cancelled during %s." % stage)
+    return progress
+
+
+def run_job(job):
+    """
+    Runs the sweep of a claimed job and records how it ended
+    """
+    status, cached, message = AnonymisationJob.Status.SUCCEEDED, None, ""
+    try:
+        cached = not generate_statistics(force=job.force, progress=job_progress(job))
+    except JobCancelled as error:
+        status, message = AnonymisationJob.Status.CANCELLED, str(error)
+    except TooShortException as error:
+        # statistics were still stored for the k values that the data allows
+        message = str(error)
+    except Exception as error:
+        status, message = AnonymisationJob.Status.FAILED, str(error)
+    AnonymisationJob.objects.filter(pk=job.pk).update(status=status, cached=cached, message=message,
+                                                      finished=timezone.now())
+    if status == AnonymisationJob.Status.SUCCEEDED:
+        # the graph of the new statistics is drawn here rather than by the first request
+        stats_graph("png")
+    job.refresh_from_db()
+    return job
@@ -0,0 +1,81 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from anonymisation.benchmarks.pipeline import (MEMORY_TOLERANCE, TIME_TOLERANCE, compare, environment,
+                                               run_size)
+from anonymisation.benchmarks.synthetic_bank import SyntheticBank
+from customer.models import Customer
+
+
+class Command(BaseCommand):
+    help = ("Times every stage of the anonymisation of one k value over synthetic banks of increasing size, "
+            "see anonymisation/benchmarks/pipeline.py")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                            help="customers of every synthetic bank")
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--repeat", type=int, default=1, help="runs of every size, the best one is kept")
+        parser.add_argument("--legacy", action="store_true",
+                            help="extract with the ORM queries, format and read_data")
+        parser.add_argument("--existing", action="store_true",
+                            help="benchmark the data in the database instead of synthetic banks")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--transactions-per-year", type=float, default=24, help="mean per customer")
+        parser.add_argument("--output", help="file the results are written to as JSON")
+        parser.add_argument("--baseline", help="results of an earlier run to compare with")
+        parser.add_argument("--time-tolerance", type=float, default=TIME_TOLERANCE)
+        parser.add_argument("--memory-tolerance", type=float, default=MEMORY_TOLERANCE)
+        parser.add_argument("--noinput", "--no-input", action="store_false", dest="interactive",
+                            help="do not ask before the tables are emptied")
+
+    def handle(self, *args, **options):
+        if not options["existing"] and options["interactive"]:
+            confirm = input("Every synthetic bank empties the customer, staff, user and log tables. "
+                            "Type 'yes' to continue: ")
+            if confirm != "yes":
+                raise CommandError("Benchmark cancelled.")
+        results = {
+            "created": timezone.now().isoformat(),
+            "k_value": options["k"],
+            "legacy": options["legacy"],
+            "environment": environment(),
+            "sizes": [],
+        }
+        sizes = [None] if options["existing"] else options["sizes"]
+        for customers in sizes:
+            if customers is None:
+                customers = Customer.objects.count()
+            else:
+                SyntheticBank(customers, seed=options["seed"],
+                              transactions_per_year=options["transactions_per_year"]).load(truncate=True)
+            size = run_size(options["k"], options["legacy"], options["repeat"])
+            if not size["records"]:
+                raise CommandError("Fewer than %d customers to anonymise." % options["k"])
+            size["customers"] = customers
+            results["sizes"].append(size)
+            self.write_size(size)
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write("Results written to %s" % options["output"])
+        if options["baseline"]:
+            with open(options["baseline"]) as baseline:
+                regressions = compare(results, json.load(baseline), options["time_tolerance"],
+                                      options["memory_tolerance"])
+            for customers, name, metric, old, new in regressions:
+                self.stdout.write("Regression: %d customers, %s %s %.4g -> %.4g" % (customers, name, metric, old, new))
+            if regressions:
+                raise CommandError("%d regressions against %s" % (len(regressions), options["baseline"]))
+            self.stdout.write("No regression against %s" % options["baseline"])
+
+    def write_size(self, size):
+        self.stdout.write("%d customers, %d records" % (size["customers"], size["records"]))
+        self.stdout.write("  %-18s %10s %10s %14s" % ("stage", "seconds", "peak MB", "records/s"))
+        for name, measured in size["stages"].items():
+            self.stdout.write("  %-18s %10.3f %10.1f %14s" % (name, measured["seconds"], measured["peak_mb"],
+                                                             measured["rows_per_second"]))
+        self.stdout.write("  %-18s %10.3f" % ("total", size["total_seconds"]))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from anonymisation.benchmarks.synthetic_bank import SyntheticBank, synthetic_bank_exists
+
+
+class Command(BaseCommand):
+    help = ("Fills the database with a synthetic bank: customers, staff, accounts, tickets, "
+            "transactions and logs, see anonymisation/benchmarks/synthetic_bank.py")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--customers", type=int, default=10000)
+        parser.add_argument("--staff", type=int, default=50)
+        parser.add_argument("--years", type=int, default=5, help="years of transactions, up to today")
+        parser.add_argument("--transactions-per-year", type=float, default=24, help="mean per customer")
+        parser.add_argument("--tickets-per-customer", type=float, default=0.2, help="mean per customer")
+        parser.add_argument("--logins-per-year", type=float, default=12, help="mean per user")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--chunk-size", type=int, default=2000, help="customers written per transaction")
+        parser.add_argument("--truncate", action="store_true",
+                            help="empty the customer, staff, user and log tables first, sample accounts included")
+
+    def handle(self, *args, **options):
+        if not options["truncate"] and synthetic_bank_exists():
+            raise CommandError("A synthetic bank was already generated, run with --truncate to replace it.")
+        bank = SyntheticBank(options["customers"], options["staff"], options["years"], options["transactions_per_year"],
+                             options["tickets_per_customer"], options["logins_per_year"], options["seed"],
+                             options["chunk_size"])
+        start = time.perf_counter()
+
+        def progress(written):
+            self.stdout.write("%d rows written in %.1f s" % (sum(written.values()), time.perf_counter() - start))
+
+        written = bank.load(options["truncate"], progress if options["verbosity"] > 1 else None)
+        elapsed = time.perf_counter() - start
+        for model, rows in written.items():
+            self.stdout.write("%-24s %12d" % (model.__name__, rows))
+        total = sum(written.values())
+        self.stdout.write("%d rows in %.1f s, %.0f rows/s" % (total, elapsed, total / elapsed))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from anonymisation.jobs import claim_job, run_job
+from anonymisation.models import AnonymisationJob
+
+
+class Command(BaseCommand):
+    help = "Runs the queued anonymisation jobs, polling the job table for new ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="exit once the queue is empty")
+        parser.add_argument("--poll-interval", type=float, default=5.0, help="seconds between two polls")
+        parser.add_argument("--recover", action="store_true",
+                            help="fail the jobs left running by a worker that stopped, "
+                                 "only when no other worker is running")
+
+    def handle(self, *args, **options):
+        if options["recover"]:
+            AnonymisationJob.objects.filter(status=AnonymisationJob.Status.RUNNING).update(
+                status=AnonymisationJob.Status.FAILED, message="Worker stopped.", finished=timezone.now())
+        while True:
+            job = claim_job()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+                # like after a request, drops a connection that the database closed while idle
+                close_old_connections()
+                continue
+            self.stdout.write("Running anonymisation job %d" % job.id)
+            job = run_job(job)
+            self.stdout.write("Anonymisation job %d %s %s" % (job.id, job.status, job.message))
@@ -1,13 +1,78 @@
-from django.db import models
+from django.db import models, transaction
 from decimal import Decimal
 
 # Create your models here.
 
+class AnonymisationRelease(models.Model):
+    """
+    One version of the anonymised data, for one k value and the state of the source data
+    it was computed from (watermark, see overall.source_watermark).
+    Exactly one release is active at a time, readers only see the rows of the active
+    release, see publish. The other releases of the current watermark are kept so that
+    setting another k value only has to publish them.
+    """
+    class Meta:
+        db_table = 'anonymisation"."release'
+        indexes = [models.Index(fields=["k_value", "watermark"])]
+        constraints = [
+            models.UniqueConstraint(fields=["active"], condition=models.Q(active=True), name="single_active_release"),
+        ]
+
+    id = models.AutoField(primary_key=True)
+    active = models.BooleanField(default=False)
+    k_value = models.IntegerField(null=True)
+    watermark = models.CharField(max_length=64, default="")
+    created = models.DateTimeField(auto_now_add=True)
+    # split tree of the incremental.IncrementalMondrian the release was generalised with, if
+    # any, as plain data, see IncrementalMondrian.to_json
+    tree = models.JSONField(null=True)
+
+    @classmethod
+    def cached(cls, k_value, watermark):
+        """
+        Returns the latest release of k_value for the watermark, None on a cache miss
+        """
+        return cls.objects.filter(k_value=k_value, watermark=watermark).order_by("-id").first()
+
+    @classmethod
+    def latest_tree(cls, k_value):
+        """
+        Returns the split tree of the latest release of k_value that kept one, None if there is none
+        """
+        from anonymisation.anonymise.utils.incremental import IncrementalMondrian
+
+        tree = (cls.objects.filter(k_value=k_value, tree__isnull=False).order_by("-id")
+                .values_list("tree", flat=True).first())
+        return None if tree is None else IncrementalMondrian.from_json(tree)
+
+    def store_tree(self, tree):
+        self.tree = tree.to_json()
+        self.save(update_fields=["tree"])
+
+    def publish(self):
+        """
+        Swaps this release in for the active one in a single short transaction,
+        the previous release stays visible to readers until it commits
+        """
+        with transaction.atomic():
+            AnonymisationRelease.objects.filter(active=True).exclude(pk=self.pk).update(active=False)
+            self.active = True
+            self.save(update_fields=["active"])
+
+
+class AnonymisationQuerySet(models.QuerySet):
+    def published(self):
+        return self.filter(release__active=True)
+
+
 class Anonymisation(models.Model):
+    objects = AnonymisationQuerySet.as_manager()
+
     class Meta:
         db_table = 'anonymisation"."anon'
 
     id = models.AutoField(primary_key=True)
+    release = models.ForeignKey(AnonymisationRelease, null=True, on_delete=models.CASCADE)
     age = models.CharField(max_length=10)
     gender = models.CharField(max_length=50)
     postal_code = models.CharField(max_length=50)
@@ -30,6 +95,8 @@ class Statistics(models.Model):
     utility_query1 = models.DecimalField(max_digits=5, decimal_places=2, default=Decimal(0))
     utility_query2 = models.DecimalField(max_digits=5, decimal_places=2, default=Decimal(0))
     info_loss = models.DecimalField(max_digits=5, decimal_places=2, default=Decimal(0))
+    # NCP of every QI and distribution of the NCP of the partitions, see anonymiser.loss_detail
+    info_loss_detail = models.JSONField(default=dict)
     set_k_value = models.BooleanField(default=False)
     first_average = models.DecimalField(max_digits=24, decimal_places=2, default=Decimal(0))
     second_average = models.DecimalField(max_digits=24, decimal_places=2, default=Decimal(0))
@@ -40,6 +107,16 @@ class Statistics(models.Model):
     second_balance_average = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
     third_balance_average = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
     last_updated = models.DateTimeField(auto_now_add=True)
+    # source data the statistics were computed from, see overall.source_watermark
+    watermark = models.CharField(max_length=64, default="")
+
+    @classmethod
+    def is_current(cls, watermark):
+        """
+        Returns whether statistics exist and were all computed from the source data of watermark,
+        the rows of a sweep only get their watermark once it is complete, see generate_statistics
+        """
+        return cls.objects.exists() and not cls.objects.exclude(watermark=watermark).exists()
 
     def set_k_value_to_true(self, k_value):
         for instance in Statistics.objects.all():
@@ -49,3 +126,53 @@ class Statistics(models.Model):
         instance = Statistics.objects.get(k_value=k_value)
         instance.set_k_value = True
         instance.save()
+
+
+class AnonymisationJob(models.Model):
+    """
+    A statistics sweep requested by an anonymiser, run by the run_anonymisation_worker
+    command instead of the HTTP request, see jobs.py.
+    The table is the queue: workers claim the oldest queued job with SELECT ... FOR UPDATE
+    SKIP LOCKED, progress and cancellation requests are plain column updates.
+    """
+    class Meta:
+        db_table = 'anonymisation"."job'
+        indexes = [models.Index(fields=["status", "id"])]
+
+    class Status(models.TextChoices):
+        QUEUED = "queued"
+        RUNNING = "running"
+        SUCCEEDED = "succeeded"
+        FAILED = "failed"
+        CANCELLED = "cancelled"
+
+    ACTIVE = [Status.QUEUED, Status.RUNNING]
+
+    id = models.AutoField(primary_key=True)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED)
+    force = models.BooleanField(default=False)
+    stage = models.CharField(max_length=20, default="")
+    done = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    cancel_requested = models.BooleanField(default=False)
+    # whether the stored statistics were kept because the source data did not change
+    cached = models.BooleanField(null=True)
+    message = models.TextField(default="")
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    def to_json(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "done": self.done,
+            "total": self.total,
+            "cancel_requested": self.cancel_requested,
+            "cached": self.cached,
+            "message": self.message,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
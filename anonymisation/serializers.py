@@ -1,68 +1,35 @@
-import csv
-import io
-
-import matplotlib.pyplot as plt
-import numpy as np
-from django.utils import timezone
+from django.http import StreamingHttpResponse
 from rest_framework import serializers
 from rest_framework.serializers import ValidationError
 
-from anonymisation.models import Anonymisation, Statistics
-from anonymisation.validations import (validate_k_is_set, validate_k_value,
-                                       validate_query)
+from anonymisation.adhoc import run_query
+from anonymisation.export import EXPORT_FORMATS, FILE_NAME, export_stream
+from anonymisation.graph import GRAPH_FORMATS, series_version, statistics_series, stats_graph
+from anonymisation.validations import (validate_adhoc_query, validate_export_format, validate_graph_format,
+                                       validate_k_is_set, validate_k_value, validate_query,
+                                       validate_release_is_published)
 from anonymisation.wrapper import generate_k_anon, save_anon, set_k
 
 
 class ViewAnonStatsSerializer(serializers.Serializer):
+    def __init__(self, json_dict, **kwargs):
+        self.json_dict = json_dict
+        super().__init__(**kwargs)
 
-    def get_graph(self):
-        self.get_statistics()
-        self.plot_graph()
-        return self.stream
-
-    def get_statistics(self):
-        self.k_values = list()
-        self.info_losses = list()
-        self.utilities_query1 = list()
-        self.utilities_query2 = list()
-        self.last_updated = timezone.now()
-
-        for stat in Statistics.objects.all().order_by("k_value"):
-            self.k_values.append(stat.k_value)
-            self.info_losses.append(stat.info_loss)
-            self.utilities_query1.append(stat.utility_query1)
-            self.utilities_query2.append(stat.utility_query2)
-            if stat.last_updated < self.last_updated:
-                self.last_updated = stat.last_updated
-        
-        self.k_values = np.array(self.k_values)
-        self.info_losses = np.array(self.info_losses)
-        self.utilities_query1 = np.array(self.utilities_query1)
-        self.utilities_query2 = np.array(self.utilities_query2)
-        self.text = "Last updated: " + self.last_updated.astimezone().isoformat()
-    
-    def plot_graph(self):
-        axis1 = plt.figure().add_axes((0.15,0.15,0.7,0.7))
-        axis2 = axis1.twinx()
+    def validate(self, attrs):
+        self.graph_format = validate_graph_format(self.json_dict)
+        self.series = statistics_series()
+        return super().validate(attrs)
 
-        axis1.plot(self.k_values, self.info_losses, "r", label="Information Loss (%)")
-        axis2.plot(self.k_values, self.utilities_query1, "b", label="Utility for Query 1 (%)")
-        axis2.plot(self.k_values, self.utilities_query2, "g", label="Utility for Query 2 (%)")
-        
-        axis1.set_xlabel('k-value')
-        axis1.set_ylabel('Information Loss (%)')
-        axis2.set_ylabel("Utility (%)")
-        lines, labels = axis1.get_legend_handles_labels()
-        lines2, labels2 = axis2.get_legend_handles_labels()
-        axis2.legend(lines + lines2, labels + labels2)
-        plt.xticks(self.k_values)
-        plt.title("Information Loss and Utility against k-value", fontweight="bold")
-        plt.figtext(0.55, 0.01, self.text, horizontalalignment='left', fontsize=8)
-        
-        stream = io.BytesIO()
-        plt.savefig(stream, format="png")
-        stream.seek(0)
-        self.stream = stream
+    def get_etag(self):
+        return '"%s-%s"' % (series_version(self.series), self.graph_format)
+
+    def get_content_type(self):
+        return GRAPH_FORMATS[self.graph_format]
+
+    def get_graph(self):
+        _, content = stats_graph(self.graph_format, self.series)
+        return content
 
 
 class GetKValueSerializer(serializers.Serializer):
@@ -82,13 +49,13 @@ class SetKValueSerializer(serializers.Serializer):
     def validate(self, attrs):
         self.k_value = validate_k_value(self.json_dict)
         try:
-            self.anon_json = generate_k_anon(self.k_value)
+            self.release = generate_k_anon(self.k_value)
         except Exception as error:
             raise ValidationError(error)
         return super().validate(attrs)
     
     def set_k(self):
-        save_anon(self.anon_json)
+        save_anon(self.release)
         set_k(self.k_value)
 
 
@@ -123,17 +90,38 @@ class QueryAnonSerializer(serializers.Serializer):
         return response
 
 
-class GetAnonDataSerializer(serializers.Serializer):
+class AdhocQuerySerializer(serializers.Serializer):
+    def __init__(self, json_dict, **kwargs):
+        self.json_dict = json_dict
+        super().__init__(**kwargs)
+
     def validate(self, attrs):
-        self.statistic = validate_k_is_set()
+        validate_k_is_set()
+        self.release = validate_release_is_published()
+        self.query = validate_adhoc_query(self.json_dict, self.release)
+        self.with_utility = self.json_dict.get("utility") in (True, "true", "True")
         return super().validate(attrs)
 
-    def get_anon_data(self, response):
-        anon_fields = ["id", "age", "gender", "postal_code", "citizenship", "first_sum", "second_sum", "third_sum", "fourth_sum", "fifth_sum", "first_balance", "second_balance", "third_balance"]
-        header = ["id", "age", "gender", "postal_code", "citizenship", "2019 sum", "2020 sum", "2021 sum", "2022 sum", "2023 sum", "savings balance", "credit card balance", "investment balance"]        
-        writer = csv.writer(response)
-        writer.writerow(header)
-        for obj in Anonymisation.objects.all():
-            writer.writerow([getattr(obj, field) for field in anon_fields])
+    def get_query_results(self):
+        response = run_query(self.release, self.query, self.with_utility)
+        response["query"] = self.query.to_json()
         return response
 
+
+class GetAnonDataSerializer(serializers.Serializer):
+    def __init__(self, json_dict, **kwargs):
+        self.json_dict = json_dict
+        super().__init__(**kwargs)
+
+    def validate(self, attrs):
+        self.statistic = validate_k_is_set()
+        self.file_format = validate_export_format(self.json_dict)
+        return super().validate(attrs)
+
+    def get_anon_data(self):
+        content_type, extension = EXPORT_FORMATS[self.file_format]
+        return StreamingHttpResponse(
+            export_stream(self.file_format),
+            content_type=content_type,
+            headers={"Content-Disposition": 'attachment; filename="%s.%s"' % (FILE_NAME, extension)},
+        )
@@ -1,9 +1,63 @@
+import copy
+import csv
+import gzip
+import io
+import json
+import random
+import subprocess
+import sys
+import tempfile
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from xml.etree import ElementTree
+from decimal import Decimal
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.core.management import CommandError, call_command
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
 
+from anonymisation import adhoc, export, graph, wrapper
+from anonymisation.benchmarks import pipeline, startup
+from anonymisation.benchmarks.synthetic import synthetic_records
+from anonymisation.benchmarks.synthetic_bank import SyntheticBank
+from anonymisation.anonymise.overall import (ACCOUNT_TYPES, FIRST_QUERY_COLUMNS, NUM_YEARS1, SECOND_QUERY_COLUMNS,
+                                             TRANSACTION_TYPE1, TYPE_OF_CITIZEN1, TYPE_OF_CITIZEN2, TooShortException,
+                                             WithdrawalRetriever, ground_truth, perform_query, source_watermark)
+from anonymisation.anonymise.utils import hierarchy, incremental, mondrian, parallel, vector_mondrian
+from anonymisation.jobs import claim_job, cancel_job, job_progress, JobCancelled, run_job, submit_job
+from anonymisation.models import Anonymisation, AnonymisationJob, AnonymisationRelease, Statistics
+from customer.models import Accounts, Customer, Transactions
+from anonymisation.anonymise.utils import database
+from anonymisation.anonymise.utils.anonymiser import (anonymise_incremental, anonymise_parallel, anonymise_sweep,
+                                                      covert_to_raw, loss_detail, prepare_output)
+from anonymisation.anonymise.utils.first_query import calculate_utility
+from anonymisation.anonymise.utils.format import AnonymisedDataFormatterBase
+from anonymisation.anonymise.utils.read_data import read_columns, read_data, read_records
+from anonymisation.anonymise.utils.requirements import age_convert
 from user.tests import TestLogout
 
 
+def sample_mondrian_data(size, seed):
+    """
+    Records in the format returned by read_data: integer QIs followed by string SAs
+    """
+    rng = random.Random(seed)
+    data = []
+    for _ in range(size):
+        postal_code = rng.choice([rng.randint(10000, 829999), 123456])
+        data.append([rng.randint(18, 90), rng.randint(0, 2), postal_code, rng.randint(0, 2),
+                     str(rng.randint(0, 5000)), str(rng.randint(0, 5000))])
+    return data
+
+
 class TestCalculateAnon(TestLogout): # staff action
     def test_should_not_calculate_anon(self):
         response = self.client.get(reverse("calculate_anon"))
@@ -20,11 +74,36 @@ class TestCalculateAnon(TestLogout): # staff action
     def calculate_anon(self):
         self.two_fa_staff5()
         response = self.client.get(reverse("calculate_anon"), **self.header)
+        call_command("run_anonymisation_worker", "--once", stdout=StringIO())
         return response
 
+    def anon_job(self, job_id):
+        return self.client.get(reverse("anon_job", args=[job_id]), **self.header)
+
     def test_should_calculate_anon(self):
         response = self.calculate_anon()
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data["status"], AnonymisationJob.Status.QUEUED)
+
+        response = self.anon_job(response.data["job_id"])
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["status"], AnonymisationJob.Status.SUCCEEDED)
+        self.assertFalse(response.data["cached"])
+
+        response = self.calculate_anon()
+        response = self.anon_job(response.data["job_id"])
+        self.assertEqual(response.data["status"], AnonymisationJob.Status.SUCCEEDED)
+        self.assertTrue(response.data["cached"])
+
+    def test_should_not_view_anon_job(self):
+        self.two_fa_staff5()
+        response = self.anon_job(1000)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.two_fa_staff4()
+        job = AnonymisationJob.objects.create()
+        response = self.anon_job(job.id)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
 
 class TestViewAnonStats(TestCalculateAnon): # staff action
@@ -45,6 +124,25 @@ class TestViewAnonStats(TestCalculateAnon): # staff action
         self.two_fa_staff5()
         response = self.client.get(reverse("view_anon_stats"), **self.header)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertTrue(response.content.startswith(b"\x89PNG"))
+
+        etag = response["ETag"]
+        response = self.client.get(reverse("view_anon_stats"), HTTP_IF_NONE_MATCH=etag, **self.header)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get(reverse("view_anon_stats"), {"graph_format": "json"}, **self.header)
+        self.assertEqual(response.json()["k_values"], list(Statistics.objects.order_by("k_value").values_list("k_value", flat=True)))
+        response = self.client.get(reverse("view_anon_stats"), {"graph_format": "svg"}, **self.header)
+        self.assertEqual(response["Content-Type"], "image/svg+xml")
+        response = self.client.get(reverse("view_anon_stats"), {"graph_format": "gif"}, **self.header)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # new statistics, new ETag
+        Statistics.objects.filter(k_value=3).update(info_loss=Decimal("1.5"))
+        response = self.client.get(reverse("view_anon_stats"), HTTP_IF_NONE_MATCH=etag, **self.header)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
 
 
 class TestSetKValue(TestViewAnonStats): # staff action
@@ -150,3 +248,939 @@ class TestGetAnonData(TestQueryAnon): # staff action
         self.two_fa_staff5()
         response = self.client.get(reverse("get_anon_data"), **self.header)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_should_export_anon_data(self):
+        self.set_k_value()
+        self.two_fa_staff4()
+        response = self.client.get(reverse("get_anon_data"), {"file_format": "xlsx"}, **self.header)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        rows = list(Anonymisation.objects.published().order_by("id").values_list(*export.ANON_FIELDS))
+        self.assertTrue(rows)
+        response = self.client.get(reverse("get_anon_data"), **self.header)
+        self.assertTrue(response.streaming)
+        content = b"".join(response.streaming_content)
+        lines = list(csv.reader(io.StringIO(content.decode())))
+        self.assertEqual(lines[0], export.HEADER)
+        self.assertEqual(lines[1:], [[str(value) for value in row] for row in rows])
+
+        response = self.client.get(reverse("get_anon_data"), {"file_format": "csv.gz"}, **self.header)
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="drck_banking_anon_data.csv.gz"')
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), content)
+
+        for file_format, read in [("parquet", pq.read_table), ("arrow", lambda source: pa.ipc.open_stream(source).read_all())]:
+            response = self.client.get(reverse("get_anon_data"), {"file_format": file_format}, **self.header)
+            table = read(pa.BufferReader(b"".join(response.streaming_content)))
+            self.assertEqual(table.column_names, export.HEADER)
+            self.assertEqual(list(zip(*table.to_pydict().values())), rows)
+
+    def test_should_stream_in_chunks(self):
+        database.store_anon_database([{field: "1" for field in database.ANON_FIELDS}] * 25)
+        self.assertEqual([len(chunk) for chunk in export.anon_chunks(10)], [10, 10, 5])
+        self.assertEqual(len(list(export.export_stream("csv", 10))), 4)
+        self.assertEqual(len(list(export.export_stream("arrow", 10))), 4)
+
+
+class TestAdhocQueryAnon(TestSetKValue): # staff action
+    def test_should_not_adhoc_query(self):
+        query = {"group_by": ["gender"]}
+        response = self.client.post(reverse("adhoc_query"), query, format="json")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.two_fa_staff5()
+        response = self.client.post(reverse("adhoc_query"), query, format="json", **self.header)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # k-value not set
+        self.two_fa_staff4()
+        response = self.client.post(reverse("adhoc_query"), query, format="json", **self.header)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.set_k_value()
+        self.two_fa_staff4()
+        for bad_query in [{"group_by": ["first_sum"]}, {"filter": {"balance": "1"}},
+                          {"aggregates": [{"function": "median", "column": "first_sum"}]},
+                          {"aggregates": [{"function": "avg"}]}, {"aggregates": [{"column": "first_sum"}]},
+                          {"aggregates": "count"}, {"filter": {"age": ["37"], "postal_code": ["123456"]}}]:
+            response = self.client.post(reverse("adhoc_query"), bad_query, format="json", **self.header)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_should_adhoc_query(self):
+        self.set_k_value()
+        query = {"group_by": ["gender"], "aggregates": [{"function": "avg", "column": "first_balance"},
+                                                        {"function": "count"}], "utility": True}
+        self.two_fa_staff4()
+        response = self.client.post(reverse("adhoc_query"), query, format="json", **self.header)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sum(row["count"] for row in response.data["results"]),
+                         Anonymisation.objects.published().count())
+        self.assertIn("utility", response.data)
+
+
+class TestMondrianEngine(SimpleTestCase):
+    def test_should_not_share_state_between_engines(self):
+        data = sample_mondrian_data(300, 1)
+        expected_3 = mondrian.mondrian(copy.deepcopy(data), 3, False, 4)[0]
+        expected_10 = mondrian.mondrian(copy.deepcopy(data), 10, False, 4)[0]
+
+        engine_3 = mondrian.MondrianEngine(copy.deepcopy(data), 3, 4)
+        engine_10 = mondrian.MondrianEngine(copy.deepcopy(data), 10, 4)
+        self.assertEqual(engine_10.anonymize()[0], expected_10)
+        self.assertEqual(engine_3.anonymize()[0], expected_3)
+
+    def test_should_run_concurrently(self):
+        data = sample_mondrian_data(300, 2)
+        k_values = list(range(3, 11))
+        expected = [mondrian.mondrian(copy.deepcopy(data), k, False, 4)[0] for k in k_values]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda k: mondrian.mondrian(copy.deepcopy(data), k, False, 4)[0], k_values))
+        self.assertEqual(results, expected)
+
+    def test_should_find_median_on_ranks(self):
+        # numeric strings are ranked by their integer value, not lexicographically
+        data = [[str(age), 0, 0, 0, "0"] for age in [9, 10, 10, 11, 30, 30, 30, 100, 100, 200]]
+        engine = mondrian.MondrianEngine(data, 2, 4)
+        self.assertEqual(engine.qi_order[0], ["9", "10", "11", "30", "100", "200"])
+        partition = mondrian.Partition(list(range(len(data))), [0] * 4, [5, 0, 0, 0])
+        self.assertEqual(engine.find_median(partition, 0), (3, 4, 0, 5))
+        # a partition narrower than its [low, high] range
+        partition = mondrian.Partition([1, 3, 4, 5], [0] * 4, [5, 0, 0, 0])
+        self.assertEqual(engine.find_median(partition, 0), (2, 3, 1, 3))
+
+    def test_should_find_median_on_wide_rank_range(self):
+        data = [[age, 0, 0, 0, "0"] for age in range(100)]
+        engine = mondrian.MondrianEngine(data, 2, 4)
+        partition = mondrian.Partition([90, 5, 50, 7, 60, 61], [0] * 4, [99, 0, 0, 0])
+        self.assertEqual(engine.find_median(partition, 0), (50, 60, 5, 90))
+
+
+class TestVectorMondrian(SimpleTestCase):
+    def assert_same_as_classic(self, data, k, relax):
+        expected, (expected_ncp, _) = mondrian.mondrian(copy.deepcopy(data), k, relax, 4)
+        result, (ncp, _) = vector_mondrian.mondrian(copy.deepcopy(data), k, relax, 4)
+        self.assertEqual(result, expected)
+        self.assertAlmostEqual(ncp, expected_ncp)
+
+    def test_should_match_classic_strict(self):
+        for seed in range(10):
+            data = sample_mondrian_data(random.Random(seed).randint(1, 400), seed)
+            for k in [1, 3, 10]:
+                self.assert_same_as_classic(data, k, False)
+
+    def test_should_match_classic_relaxed(self):
+        for seed in range(10):
+            data = sample_mondrian_data(random.Random(seed).randint(1, 400), seed)
+            for k in [1, 3, 10]:
+                self.assert_same_as_classic(data, k, True)
+
+    def test_should_match_classic_string_qi(self):
+        data = [[str(record[0]), record[1], str(record[2]), record[3]] + record[4:]
+                for record in sample_mondrian_data(200, 42)]
+        self.assert_same_as_classic(data, 5, False)
+
+    def test_should_prune_split_tree(self):
+        data = sample_mondrian_data(500, 7)
+        engine = vector_mondrian.VectorMondrian(copy.deepcopy(data), 3, 4)
+        engine.run()
+        expected, _ = vector_mondrian.mondrian(copy.deepcopy(data), 3, False, 4)
+        self.assertEqual(engine.generalize(engine.prune(3)), expected)
+        for k in range(3, 21):
+            partitions = engine.prune(k)
+            self.assertEqual(partitions.size.sum(), len(data))
+            self.assertGreaterEqual(partitions.size.min(), k)
+
+
+class TestInformationLoss(SimpleTestCase):
+    def test_should_break_down_ncp(self):
+        data = sample_mondrian_data(300, 5)
+        engine = mondrian.MondrianEngine(copy.deepcopy(data), 5, 4)
+        _, (ncp, _) = engine.anonymize()
+        overall, attribute_loss, partition_loss = engine.information_loss()
+        self.assertEqual(ncp, overall)
+        self.assertAlmostEqual(overall, attribute_loss.mean())
+        self.assertEqual(len(partition_loss), len(engine.result))
+
+        # the former loop over every partition and QI
+        expected = sum(sum(engine.get_normalized_width(partition, index) for index in range(4)) * len(partition)
+                       for partition in engine.result) / 4 / len(data) * 100
+        self.assertAlmostEqual(ncp, expected)
+        for partition, loss in zip(engine.result, partition_loss):
+            self.assertAlmostEqual(loss, sum(engine.get_normalized_width(partition, index) for index in range(4)) * 25)
+
+        vector = vector_mondrian.VectorMondrian(copy.deepcopy(data), 5, 4)
+        vector.run()
+        vector_overall, vector_attribute_loss, vector_partition_loss = vector.information_loss()
+        self.assertAlmostEqual(vector_overall, overall)
+        np.testing.assert_allclose(vector_attribute_loss, attribute_loss)
+        np.testing.assert_allclose(vector_partition_loss, partition_loss)
+
+    def test_should_summarise_loss(self):
+        detail = loss_detail(np.array([10.0, 0.0, 55.555, 100.0]), np.array([0.0, 50.0, 100.0]))
+        self.assertEqual(detail["attributes"], {"age": 10.0, "gender": 0.0, "postal_code": 55.56, "citizenship": 100.0})
+        self.assertEqual(detail["partitions"], {"count": 3, "mean": 50.0, "median": 50.0, "p90": 90.0, "max": 100.0})
+        self.assertEqual(loss_detail(np.zeros(4), [])["partitions"]["count"], 0)
+
+
+class TestParallelSweep(SimpleTestCase):
+    def test_should_match_serial_sweep(self):
+        data = sample_mondrian_data(400, 3)
+        qi_rank, qi_order = vector_mondrian.encode_qi(data, 4)
+        k_values = [3, 5, 8]
+
+        results = list(parallel.parallel_sweep(qi_rank, qi_order, k_values, max_workers=2))
+
+        self.assertEqual([k for k, _, _, _, _ in results], k_values)
+        for k, _, (ncp, attribute_loss, _), perm, partitions in results:
+            self.assertEqual(len(attribute_loss), 4)
+            expected, (expected_ncp, _) = mondrian.mondrian(copy.deepcopy(data), k, False, 4)
+            self.assertAlmostEqual(ncp, expected_ncp)
+            engine = vector_mondrian.VectorMondrian(data, k, 4)
+            engine.perm = perm
+            self.assertEqual(sorted(map(str, engine.generalize(partitions))), sorted(map(str, expected)))
+
+    def test_should_generalise_like_sweep(self):
+        records = sample_typed_records(300, 4)
+        columns = read_columns([records], len(records))
+        results = list(anonymise_parallel(columns, [6, 4], max_workers=2))
+        self.assertEqual([k for k, _, _ in results], [4, 6])
+        for k, (ncp, _, detail), output in results:
+            # a sweep of a single k is an exact strict run
+            _, (expected_ncp, _, expected_detail), expected = next(anonymise_sweep(columns, [k]))
+            self.assertAlmostEqual(ncp, expected_ncp)
+            self.assertEqual(detail, expected_detail)
+            self.assertEqual(list(output), list(expected))
+
+    def test_should_not_import_django_in_workers(self):
+        script = "import sys, anonymisation.anonymise.utils.parallel; print('django' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "False")
+
+
+def sample_typed_records(size, seed):
+    """
+    Typed records in the format of WithdrawalRetriever.records
+    """
+    rng = random.Random(seed)
+    return [(rng.randint(18, 90), rng.choice(['Female', 'Male']), rng.randint(10000, 829999),
+             rng.choice(['Singaporean Citizen', 'Singaporean PR', 'Non-Singaporean']))
+            + tuple(Decimal(rng.randint(0, 5000)) for _ in range(8))
+            for _ in range(size)]
+
+
+class TestIncrementalMondrian(SimpleTestCase):
+    def assert_k_anonymous(self, tree, records):
+        leaves = list(tree.leaves())
+        self.assertTrue(all(leaf.size >= tree.k for leaf in leaves))
+        self.assertEqual(sum(leaf.size for leaf in leaves), len(records))
+        for leaf in leaves:
+            self.assertEqual(leaf.size, sum(leaf.count.values()))
+            for qi in leaf.count:
+                self.assertTrue(all(low <= code <= high for low, code, high in zip(leaf.low, qi, leaf.high)))
+
+    def test_should_build_k_anonymous_tree(self):
+        records = sample_typed_records(2000, 0)
+        tree = incremental.IncrementalMondrian(5)
+        tree.update(records)
+        self.assert_k_anonymous(tree, records)
+
+    def test_should_only_touch_changed_leaves(self):
+        records = sample_typed_records(2000, 0)
+        tree = incremental.IncrementalMondrian(5)
+        tree.update(records)
+        before = set(map(id, tree.leaves()))
+
+        # new customers, a changed postal code and a removed customer
+        changed = sample_typed_records(20, 1) + records[1:]
+        changed[50] = (changed[50][0], changed[50][1], 10000) + changed[50][3:]
+        leaves = tree.update(changed)
+        self.assert_k_anonymous(tree, changed)
+        self.assertLess(len(leaves), 100)
+        self.assertGreater(len(before & set(map(id, tree.leaves()))), len(before) - 100)
+
+        # the SAs do not change the tree
+        self.assertEqual(tree.update([record[:4] + (Decimal(0),) * 8 for record in changed]), [])
+
+    def test_should_merge_small_leaves(self):
+        records = sample_typed_records(2000, 0)
+        tree = incremental.IncrementalMondrian(5)
+        tree.update(records)
+        remaining = records[::7]
+        tree.update(remaining)
+        self.assert_k_anonymous(tree, remaining)
+
+        tree.update(records[:4])
+        self.assertEqual(len(list(tree.leaves())), 1)
+
+    def test_should_generalise_records(self):
+        records = sample_typed_records(500, 0)
+        output, (ncp, _, _), tree = anonymise_incremental(records, 5)
+        self.assertEqual(len(output), len(records))
+        self.assertGreater(ncp, 0)
+        for row, record in zip(output, records):
+            self.assertEqual(row['first_sum'], record[4])
+            self.assertIn(record[1], row['gender'].split('~'))
+            self.assertIn(record[3].replace(' ', ''), row['citizenship'].split('~'))
+            ages = [int(age) for age in row['age'].split('~')]
+            self.assertTrue(ages[0] <= record[0] <= ages[-1])
+
+        # a tree of another k is not reused
+        _, _, other = anonymise_incremental(records, 6, tree)
+        self.assertIsNot(other, tree)
+
+    def test_should_rebuild_tree_from_json(self):
+        records = sample_typed_records(2000, 0)
+        tree = incremental.IncrementalMondrian(5)
+        tree.domains = (5, "sector")
+        tree.update(records)
+        data = json.loads(json.dumps(tree.to_json()))
+        rebuilt = incremental.IncrementalMondrian.from_json(data)
+        self.assertEqual(rebuilt.to_json(), data)
+        self.assertEqual(rebuilt.domains, tree.domains)
+        self.assertEqual(rebuilt.generalization(), tree.generalization())
+        self.assertEqual([node.size for node in rebuilt.nodes()], [node.size for node in tree.nodes()])
+        self.assertAlmostEqual(rebuilt.ncp(), tree.ncp())
+
+        # the rebuilt tree is updated like the stored one
+        changed = sample_typed_records(30, 1) + records[40:]
+        self.assertEqual(rebuilt.update(records), [])
+        rebuilt.update(changed)
+        self.assert_k_anonymous(rebuilt, changed)
+
+    def test_should_report_the_ncp_of_the_sweep(self):
+        records = sample_typed_records(2000, 0)
+        _, (sweep_ncp, _, sweep_detail), _ = next(anonymise_sweep(read_columns([records], len(records)), [5]))
+        _, (ncp, _, detail), tree = anonymise_incremental(records, 5)
+        self.assertAlmostEqual(ncp, sweep_ncp)
+        self.assertEqual(detail["partitions"]["count"], sweep_detail["partitions"]["count"])
+
+        # an update with the same records keeps the tree and its NCP
+        self.assertEqual(tree.update(records), [])
+        self.assertAlmostEqual(tree.ncp(), sweep_ncp)
+
+
+class TestWithdrawalRecords(SimpleTestCase):
+    def sample_rows(self):
+        this_year = date.today().year
+        transactions = [
+            {'sender__user__user': 1, 'year': this_year, 'total_amount': Decimal('10.50'),
+             'sender__user__gender': 'Male', 'sender__user__postal_code': '012345',
+             'sender__user__birth_date': date(1990, 1, 1), 'sender__user__citizenship': 'Singaporean Citizen'},
+            {'sender__user__user': 1, 'year': this_year - 2, 'total_amount': Decimal('3'),
+             'sender__user__gender': 'Male', 'sender__user__postal_code': '012345',
+             'sender__user__birth_date': date(1990, 1, 1), 'sender__user__citizenship': 'Singaporean Citizen'},
+        ]
+        accounts = [
+            {'user': 1, 'user__gender': 'Male', 'user__postal_code': '012345', 'user__citizenship': 'Singaporean Citizen',
+             'user__birth_date': date(1990, 1, 1), 'type': 2, 'balance': Decimal('99.90')},
+            {'user': 2, 'user__gender': 'Female', 'user__postal_code': '654321', 'user__citizenship': 'Foreigner',
+             'user__birth_date': date(1970, 6, 1), 'type': 1, 'balance': Decimal('5.00')},
+        ]
+        return transactions, accounts
+
+    @override_settings(ANONYMISATION_AGE_BAND_WIDTH=0, ANONYMISATION_POSTAL_HIERARCHY="none")
+    def test_should_build_typed_records(self):
+        retriever = WithdrawalRetriever('Withdrawal', 5)
+        records = retriever.records(*self.sample_rows())
+        age = age_convert(date(1990, 1, 1))
+        self.assertEqual(records[0], (age, 'Male', 12345, 'Singaporean Citizen',
+                                      0, 0, Decimal('3'), 0, Decimal('10.50'),
+                                      0, Decimal('99.90'), 0))
+        self.assertEqual(records[1][1:], ('Female', 654321, 'Foreigner', 0, 0, 0, 0, 0, Decimal('5.00'), 0, 0))
+
+    def test_should_read_records_like_strings(self):
+        retriever = WithdrawalRetriever('Withdrawal', 5)
+        records = retriever.records(*self.sample_rows())
+        data, intuitive_order, _, _ = read_records(records)
+        string_data, string_order, _, _ = read_data(retriever.format(*self.sample_rows()))
+        self.assertEqual(intuitive_order, string_order)
+        self.assertEqual(intuitive_order[3], ['SingaporeanCitizen', 'Foreigner'])
+        for record, string_record in zip(data, string_data):
+            self.assertEqual(record[:4], string_record[:4])
+            self.assertEqual([Decimal(value) for value in record[4:]], [Decimal(value) for value in string_record[4:]])
+
+
+@override_settings(ANONYMISATION_AGE_BAND_WIDTH=5, ANONYMISATION_POSTAL_HIERARCHY="sector")
+class TestHierarchy(SimpleTestCase):
+    def test_should_encode_leaves(self):
+        records = [(36, 'Male', 12345, 'Singaporean Citizen', 1), (70, 'Female', 829999, 'Foreigner', 2),
+                   (150, 'Female', 10, 'Foreigner', 3)]
+        self.assertEqual(hierarchy.encode_records(records), [(7, 'Male', 1, 'Singaporean Citizen', 1),
+                                                             (14, 'Female', 82, 'Foreigner', 2),
+                                                             (24, 'Female', 0, 'Foreigner', 3)])
+        retriever = WithdrawalRetriever('Withdrawal', 5)
+        records = retriever.records(*TestWithdrawalRecords().sample_rows())
+        self.assertEqual(records[0][:3], (age_convert(date(1990, 1, 1)) // 5, 'Male', 1))
+
+    def test_should_publish_labels(self):
+        ages, sectors = hierarchy.age_bands(5), hierarchy.postal_sectors()
+        self.assertEqual(ages.publish("7"), "35~39")
+        self.assertEqual(ages.publish("4~7"), "20~39")
+        self.assertEqual(sectors.publish("1~12"), "01****~12****")
+        self.assertEqual(sectors.publish("12"), "12****")
+        districts = hierarchy.postal_districts()
+        self.assertEqual([districts.encode(code) for code in [12345, 140000, 810000, 990000]], [0, 2, 16, 28])
+        self.assertEqual(districts.publish("0~2"), "D01~D03")
+
+        record = {'age': "4~7", 'gender': "Male", 'postal_code': "1~12", 'citizenship': "SingaporeanCitizen"}
+        formatted = AnonymisedDataFormatterBase().format_anon_data([dict(record)])[0]
+        self.assertEqual((formatted['age'], formatted['postal_code']), ("20 - 39", "01**** - 12****"))
+        with override_settings(ANONYMISATION_POSTAL_HIERARCHY="district"):
+            formatted = AnonymisedDataFormatterBase().format_anon_data([dict(record, postal_code="0~2")])[0]
+        self.assertEqual(formatted['postal_code'], "D01 - D03")
+
+    def test_should_shrink_domains(self):
+        records = hierarchy.encode_records([tuple(record[:4]) for record in synthetic_records(5000)])
+        data, _, _, _ = read_records([record + ('0',) * 8 for record in records])
+        self.assertLessEqual(len({record[0] for record in data}), 25)
+        self.assertLessEqual(len({record[2] for record in data}), 100)
+
+    def test_should_change_watermark_with_domains(self):
+        self.assertNotEqual(hierarchy.domain_key(), (0, "none"))
+        with override_settings(ANONYMISATION_AGE_BAND_WIDTH=0, ANONYMISATION_POSTAL_HIERARCHY="none"):
+            self.assertEqual(hierarchy.encode_records([(36, 'Male', 12345)]), [(36, 'Male', 12345)])
+            self.assertEqual(hierarchy.domain_key(), (0, "none"))
+
+
+class TestRecordColumns(SimpleTestCase):
+    def sample_records(self, size, seed):
+        rng = random.Random(seed)
+        genders = ['Male', 'Female', 'Others']
+        citizenships = ['Singaporean Citizen', 'Singaporean PR', 'Non-Singaporean']
+        return [(rng.randint(18, 90), rng.choice(genders), rng.randint(10000, 829999), rng.choice(citizenships),
+                 *[Decimal(rng.randint(0, 500000)).scaleb(-2) for _ in range(8)]) for _ in range(size)]
+
+    def test_should_encode_chunks_like_read_records(self):
+        records = self.sample_records(50, 1)
+        # capacity too small on purpose, the buffers have to grow
+        columns = read_columns([records[:20], records[20:45], [], records[45:]], 10)
+        data, intuitive_order, _, _ = read_records(records)
+        self.assertEqual(len(columns), 50)
+        self.assertEqual(columns.intuitive_order, intuitive_order)
+        self.assertEqual(columns.qi_codes().tolist(), [record[:4] for record in data])
+        self.assertEqual(columns.sa_decimals(7), list(records[7][4:]))
+
+    def test_should_sweep_like_records(self):
+        records = self.sample_records(300, 2)
+        columns = read_columns([records], len(records))
+        data, intuitive_order, qi_num, sa_num = read_records(records)
+        engine = vector_mondrian.VectorMondrian(data, 3, qi_num)
+        engine.run()
+        for k, (ncp, _, detail), output in anonymise_sweep(columns, [5, 3]):
+            partitions = engine.prune(k)
+            expected = prepare_output(covert_to_raw(engine.generalize(partitions), intuitive_order, sa_num, qi_num))
+            self.assertAlmostEqual(ncp, engine.ncp(partitions))
+            self.assertEqual(detail["partitions"]["count"], len(partitions))
+            self.assertEqual(list(output), expected)
+
+
+class TestWithdrawalPivot(TestCase):
+    fixtures = ["user/tests.json"]
+
+    def test_should_match_python_merge(self):
+        retriever = WithdrawalRetriever('Withdrawal', 5)
+        expected = retriever.records(retriever.retrieve_transactions(), retriever.retrieve_accounts())
+        with self.assertNumQueries(1):
+            records = retriever.retrieve_records()
+        self.assertTrue(any(any(record[4:9]) for record in records))
+        self.assertEqual(sorted(records), sorted(expected))
+
+    def test_should_sum_balances_of_one_type(self):
+        retriever = WithdrawalRetriever('Withdrawal', 5)
+        account = Accounts.objects.first()
+        customers = list(Customer.objects.filter(accounts__isnull=False).distinct().order_by('pk')
+                         .values_list('pk', flat=True))
+        row, column = customers.index(account.user_id), 9 + ACCOUNT_TYPES.index(account.type_id)
+        balance = retriever.retrieve_records()[row][column]
+        Accounts.objects.create(user=account.user, type=account.type, balance=Decimal('10.50'), status=account.status)
+        self.assertEqual(retriever.retrieve_records()[row][column], balance + Decimal('10.50'))
+
+    def test_should_stream_columns(self):
+        retriever = WithdrawalRetriever('Withdrawal', 5)
+        records = retriever.retrieve_records()
+        columns = retriever.retrieve_columns(chunk_size=5)
+        expected = read_columns([records], len(records))
+        self.assertEqual(len(columns), len(records))
+        self.assertEqual(columns.intuitive_order, expected.intuitive_order)
+        self.assertEqual(columns.qi_codes().tolist(), expected.qi_codes().tolist())
+        self.assertEqual(columns.sa[:len(columns)].tolist(), expected.sa[:len(records)].tolist())
+
+
+class TestQueryAggregates(TestCase):
+    fixtures = ["user/tests.json"]
+
+    def python_averages(self, rows, columns):
+        averages = []
+        for column in columns:
+            values = [float(row[column]) for row in rows if row['citizenship'] == TYPE_OF_CITIZEN1 and float(row[column])]
+            averages.append(sum(values) / len(values) if values else 0)
+        return averages
+
+    def test_should_match_python_ground_truth(self):
+        retriever = WithdrawalRetriever('Withdrawal', 5)
+        current_year = date.today().year
+        totals = [[], [], [], [], []]
+        for row in retriever.retrieve_transactions().filter(sender__user__citizenship=TYPE_OF_CITIZEN1):
+            totals[row['year'] - current_year + 4].append(float(row['total_amount']))
+        balances = [[], [], []]
+        for row in retriever.retrieve_accounts().filter(user__citizenship=TYPE_OF_CITIZEN2):
+            balances[row['type'] - 1].append(float(row['balance']))
+
+        first_list, second_list = ground_truth()
+        self.assertTrue(any(first_list) and any(second_list))
+        for averages, expected in [(first_list, totals), (second_list, balances)]:
+            for average, values in zip(averages, expected):
+                self.assertAlmostEqual(average, sum(values) / len(values) if values else 0)
+
+    def test_should_average_release_rows(self):
+        rng = random.Random(5)
+        rows = []
+        for index in range(40):
+            row = {field: str(rng.choice([0, rng.randint(1, 5000)])) for field in database.ANON_FIELDS[4:]}
+            row.update(age="20 - 30", gender="M", postal_code="10****",
+                       citizenship=[TYPE_OF_CITIZEN1, "Singaporean Citizen - Singapore PR"][index % 2])
+            rows.append(row)
+        release = database.store_anon_database(rows, k_value=3)
+        truth = ground_truth()
+
+        first_list, first_utility, first_json = perform_query("1", release, truth)
+        self.assertEqual(first_list, self.python_averages(rows, FIRST_QUERY_COLUMNS))
+        self.assertEqual(first_utility, calculate_utility(first_list, truth[0]))
+        self.assertEqual([record["average_amount"] for record in json.loads(first_json)], first_list)
+        second_list, second_utility, _ = perform_query("2", release, truth)
+        self.assertEqual(second_list, self.python_averages(rows, SECOND_QUERY_COLUMNS))
+        self.assertEqual(second_utility, calculate_utility(second_list, truth[1]))
+
+    def test_should_compute_ground_truth_once_per_sweep(self):
+        with mock.patch.object(wrapper, "ground_truth", wraps=wrapper.ground_truth) as truth:
+            with self.assertRaises(TooShortException):
+                wrapper.generate_statistics()
+        truth.assert_called_once()
+        self.assertGreater(Statistics.objects.count(), 1)
+
+    def test_should_calculate_utility_over_arrays(self):
+        self.assertEqual(calculate_utility([110, 0, 5], [100, 0, 10]), 80.0)
+        self.assertEqual(calculate_utility([[110, 0, 5], [300, 0, 10]], [100, 0, 10]), [80.0, 33.33])
+        self.assertEqual(calculate_utility([400], [100]), 0)
+
+
+class TestAdhocQuery(TestCase):
+    fixtures = ["user/tests.json"]
+
+    def setUp(self):
+        rng = random.Random(7)
+        self.rows = []
+        for _ in range(60):
+            row = {field: str(rng.choice([0, rng.randint(1, 5000)])) for field in database.ANON_FIELDS[4:]}
+            row.update(age=rng.choice(["20 - 30", "31"]), gender=rng.choice(["M", "F"]), postal_code="10****",
+                       citizenship=rng.choice(["Singaporean Citizen", "Singapore PR"]))
+            self.rows.append(row)
+        self.release = database.store_anon_database(self.rows, k_value=3)
+
+    def test_should_compile_to_grouped_aggregates(self):
+        query = adhoc.AdhocQuery({"citizenship": "Singaporean Citizen"}, ["age", "gender"],
+                                 [("sum", "first_sum"), ("avg", "second_balance"), ("count", None)], exclude_zero=True)
+        with self.assertNumQueries(1):
+            results = query.anonymised(self.release)
+
+        expected = {}
+        for row in self.rows:
+            if row["citizenship"] == "Singaporean Citizen":
+                expected.setdefault((row["age"], row["gender"]), []).append(row)
+        self.assertEqual([(row["age"], row["gender"]) for row in results], sorted(expected))
+        for row in results:
+            group = expected[(row["age"], row["gender"])]
+            balances = [float(member["second_balance"]) for member in group if float(member["second_balance"])]
+            self.assertAlmostEqual(row["sum_first_sum"], sum(float(member["first_sum"]) for member in group))
+            self.assertAlmostEqual(row["avg_second_balance"], sum(balances) / len(balances) if balances else 0)
+            self.assertEqual(row["count"], len(group))
+
+    def test_should_run_raw_query(self):
+        retriever = WithdrawalRetriever('Withdrawal', 5)
+        records = retriever.retrieve_records()
+        formatter = AnonymisedDataFormatterBase()
+        citizenships = [formatter.format_citizenship(record[3].replace(" ", "")) for record in records]
+        query = adhoc.AdhocQuery(group_by=["citizenship"], aggregates=[("avg", "first_balance"), ("count", None)])
+        raw = query.raw()
+        self.assertEqual([row["citizenship"] for row in raw], sorted(set(citizenships)))
+        for row in raw:
+            balances = [float(record[9]) for record, citizenship in zip(records, citizenships)
+                        if citizenship == row["citizenship"]]
+            self.assertEqual(row["count"], len(balances))
+            self.assertAlmostEqual(row["avg_first_balance"], sum(balances) / len(balances))
+
+        self.assertEqual(query.utility(raw, raw), 100)
+        # the anonymised result lost a group
+        self.assertLess(query.utility(raw[1:], raw), 100)
+        # an empty source result is not told apart
+        self.assertEqual(query.utility([], []), 100)
+        self.assertEqual(query.utility(raw, []), 100)
+
+    def test_should_label_source_data_like_release(self):
+        release = wrapper.generate_k_anon(3)
+        rows = Anonymisation.objects.filter(release=release)
+        raw = adhoc.AdhocQuery(group_by=["age", "postal_code"]).raw()
+        for row in raw:
+            self.assertRegex(row["age"], r"^\d+ - \d+$")
+            self.assertRegex(row["postal_code"], r"^\d\d\*\*\*\*$")
+
+        ages = sorted(set(rows.values_list("age", flat=True)))
+        query = adhoc.AdhocQuery({"age": ages})
+        query.check_filters(release)
+        self.assertEqual(query.raw(), [{"count": float(rows.count())}])
+        for age in ages:
+            # a label covers the leaves of its range, which other partitions may share
+            self.assertGreaterEqual(adhoc.AdhocQuery({"age": age}).raw()[0]["count"], rows.filter(age=age).count())
+
+    def test_should_only_filter_on_published_values(self):
+        release = wrapper.generate_k_anon(3)
+        customer = Customer.objects.filter(accounts__isnull=False).first()
+        for filters in [{"age": age_convert(customer.birth_date)}, {"postal_code": customer.postal_code},
+                        {"citizenship": "Singaporean PR"}]:
+            with self.assertRaises(ValueError):
+                adhoc.AdhocQuery(filters).check_filters(release)
+            with self.assertRaises(ValueError):
+                adhoc.run_query(release, adhoc.AdhocQuery(filters), with_utility=True)
+
+    def test_should_cache_results_by_release(self):
+        query = adhoc.AdhocQuery(group_by=["gender"])
+        with mock.patch.object(adhoc.AdhocQuery, "raw", wraps=query.raw) as raw, \
+                mock.patch.object(adhoc.AdhocQuery, "anonymised", wraps=query.anonymised) as anonymised:
+            results = adhoc.run_query(self.release, query)
+            self.assertNotIn("utility", results)
+            raw.assert_not_called()
+            self.assertEqual(adhoc.run_query(self.release, adhoc.AdhocQuery(group_by=["gender"])), results)
+            anonymised.assert_called_once()
+
+            utility = adhoc.run_query(self.release, query, with_utility=True)["utility"]
+            self.assertEqual(adhoc.run_query(self.release, query, with_utility=True)["utility"], utility)
+            raw.assert_called_once()
+
+            other_release = database.store_anon_database(self.rows[:30], k_value=4)
+            adhoc.run_query(other_release, query)
+            self.assertEqual(anonymised.call_count, 2)
+
+
+class TestStatsGraph(TestCase):
+    def setUp(self):
+        for k_value in range(3, 8):
+            database.store_stats_database(k_value, 10 + k_value, [0] * 5, [0] * 3, 90 - k_value, 80, {})
+
+    def test_should_render_once_per_version(self):
+        figures = plt.get_fignums()
+        with mock.patch.object(graph, "render", wraps=graph.render) as render:
+            version, png = graph.stats_graph("png")
+            self.assertEqual(graph.stats_graph("png"), (version, png))
+            render.assert_called_once()
+            database.store_stats_database(8, 20, [0] * 5, [0] * 3, 80, 80, {})
+            self.assertNotEqual(graph.stats_graph("png")[0], version)
+            self.assertEqual(render.call_count, 2)
+        self.assertEqual(plt.get_fignums(), figures)
+
+    def test_should_draw_svg_without_matplotlib(self):
+        series = graph.statistics_series()
+        self.assertEqual(series["info_loss"], [13.0, 14.0, 15.0, 16.0, 17.0])
+        with mock.patch.object(graph, "render_png", side_effect=AssertionError):
+            svg = graph.render_svg(series)
+        root = ElementTree.fromstring(svg)
+        polylines = root.findall("{http://www.w3.org/2000/svg}polyline")
+        self.assertEqual([line.get("stroke") for line in polylines], ["red", "blue", "green"])
+        self.assertEqual(len(polylines[0].get("points").split()), 5)
+        Statistics.objects.all().delete()
+        ElementTree.fromstring(graph.render_svg(graph.statistics_series()))
+
+
+class TestStartupImports(SimpleTestCase):
+    def test_should_not_import_heavy_modules_in_workers(self):
+        rss, modules, (total, times) = startup.run_startup()
+        self.assertEqual(modules, [])
+        self.assertIn("main.urls", times)
+        self.assertGreater(rss["worker"], rss["interpreter"])
+
+        _, modules, _ = startup.run_startup(anonymisation=True)
+        self.assertIn("numpy", modules)
+
+
+class TestSyntheticBank(TestCase):
+    def generate(self, **options):
+        call_command("generate_synthetic_bank", customers=60, staff=7, chunk_size=25, truncate=True, stdout=StringIO(),
+                     **options)
+        return list(Customer.objects.order_by("user").values_list("user", "birth_date", "postal_code", "citizenship"))
+
+    def test_should_generate_the_same_bank_for_a_seed(self):
+        customers = self.generate(seed=3)
+        transactions = list(Transactions.objects.order_by("transaction").values_list("transaction", "amount"))
+        self.assertEqual(len(customers), 60)
+        self.assertEqual(self.generate(seed=3), customers)
+        self.assertEqual(list(Transactions.objects.order_by("transaction").values_list("transaction", "amount")),
+                         transactions)
+        self.assertNotEqual(self.generate(seed=4), customers)
+
+    def test_should_generate_records_of_every_customer(self):
+        self.generate(seed=1, transactions_per_year=50)
+        self.assertEqual(Accounts.objects.filter(type__name="Savings").count(), 60)
+        self.assertFalse(Transactions.objects.filter(sender__isnull=True, recipient__isnull=True).exists())
+        self.assertFalse(Transactions.objects.filter(sender=F("recipient")).exists())
+        records = WithdrawalRetriever(TRANSACTION_TYPE1, NUM_YEARS1).retrieve_records()
+        self.assertEqual(len(records), 60)
+        self.assertGreater(sum(1 for record in records if record[4:9] != (0,) * 5), 50)
+        adult = date.today() - timedelta(days=18 * 365)
+        self.assertFalse(Customer.objects.filter(birth_date__gt=adult).exists())
+        with self.assertRaises(CommandError):
+            call_command("generate_synthetic_bank", customers=1, stdout=StringIO())
+
+    def test_should_weight_withdrawals_by_season(self):
+        bank = SyntheticBank(0, now=datetime(2023, 12, 31, 12, tzinfo=dt_timezone.utc))
+        moments = bank.moments(np.random.default_rng(0), 200000, bank.withdrawal_days)
+        months = (moments + np.timedelta64(8, "h")).astype("datetime64[M]").astype(int) % 12
+        counts = np.bincount(months, minlength=12)
+        self.assertGreater(counts[11], counts[8] * 1.4)
+        self.assertLessEqual(moments.max(), np.datetime64("2023-12-31T12:00:00"))
+
+
+class TestPipelineBenchmark(TestCase):
+    def test_should_time_every_stage(self):
+        with tempfile.NamedTemporaryFile("r", suffix=".json") as output:
+            call_command("benchmark_anonymisation", sizes=[40], k=3, interactive=False, output=output.name,
+                         stdout=StringIO())
+            results = json.load(output)
+        size, = results["sizes"]
+        self.assertEqual((size["customers"], size["records"]), (40, 40))
+        self.assertEqual(list(size["stages"]), ["extract", "read_records", "mondrian", "covert_to_raw",
+                                                "prepare_output", "format_anon_data", "store", "utility"])
+        for measured in size["stages"].values():
+            self.assertGreater(measured["rows_per_second"], 0)
+            self.assertGreaterEqual(measured["peak_mb"], 0)
+        self.assertEqual(pipeline.compare(results, results), [])
+        self.assertFalse(AnonymisationRelease.objects.exists())
+        self.assertFalse(Statistics.objects.exists())
+
+        size = pipeline.run_size(3, legacy=True)
+        self.assertEqual(list(size["stages"])[:3], ["orm_extract", "format", "read_data"])
+        self.assertEqual(size["records"], 40)
+
+    def test_should_report_regressions_above_the_noise_floor(self):
+        def results(extract, mondrian):
+            return {"sizes": [{"customers": 1000, "stages": {
+                "extract": {"seconds": extract, "peak_mb": 10.0}, "mondrian": {"seconds": mondrian, "peak_mb": 50.0}}}]}
+
+        baseline = results(1.0, 0.01)
+        self.assertEqual(pipeline.compare(results(1.1, 0.03), baseline), [])
+        self.assertEqual(pipeline.compare(results(1.5, 0.03), baseline), [(1000, "extract", "seconds", 1.0, 1.5)])
+        self.assertEqual(pipeline.compare(results(1.5, 0.03), baseline, time_tolerance=0.6), [])
+        self.assertEqual(pipeline.compare(results(1.5, 0.03), {"sizes": []}), [])
+
+
+class TestStoreAnonDatabase(TestCase):
+    def sample_anon_data(self, size):
+        return [{'age': '20 - 30', 'gender': 'Male', 'postal_code': '12****', 'citizenship': 'Singaporean Citizen',
+                 'first_sum': str(index), 'second_sum': Decimal('1.50'), 'third_sum': 0, 'fourth_sum': '0',
+                 'fifth_sum': Decimal(index).scaleb(-2), 'first_balance': Decimal('10.00'),
+                 'second_balance': '2.25', 'third_balance': 0} for index in range(size)]
+
+    def assert_stored(self, anon_data):
+        stored = list(Anonymisation.objects.published().order_by('id').values_list(*database.ANON_FIELDS))
+        self.assertEqual(len(stored), len(anon_data))
+        for row, data in zip(stored, anon_data):
+            self.assertEqual(row[:4], ('20 - 30', 'Male', '12****', 'Singaporean Citizen'))
+            self.assertEqual(row[4:], tuple(Decimal(data[field]) for field in database.ANON_FIELDS[4:]))
+
+    def test_should_copy_in_batches(self):
+        Anonymisation.objects.create(age='1', gender='x', postal_code='1', citizenship='x')
+        anon_data = self.sample_anon_data(23)
+        database.store_anon_database(anon_data, batch_size=5, method='copy')
+        self.assert_stored(anon_data)
+        self.assertEqual(Anonymisation.objects.count(), 23)
+
+    def test_should_bulk_create_in_batches(self):
+        anon_data = self.sample_anon_data(23)
+        # transaction, release, 5 batches, swap, cleanup of the (missing) previous releases
+        with self.assertNumQueries(2 + 1 + 5 + 4 + 2):
+            database.store_anon_database(iter(anon_data), batch_size=5, method='bulk_create')
+        self.assert_stored(anon_data)
+
+    def test_should_keep_previous_release_until_swap(self):
+        first = self.sample_anon_data(4)
+        first_release = database.store_anon_database(first, method='copy')
+        second_release = AnonymisationRelease.objects.create()
+        Anonymisation.objects.create(release=second_release, age='1', gender='x', postal_code='1', citizenship='x')
+        self.assert_stored(first)
+
+        second_release.publish()
+        self.assertEqual(list(Anonymisation.objects.published().values_list('age', flat=True)), ['1'])
+        first_release.refresh_from_db()
+        self.assertFalse(first_release.active)
+
+    def test_should_not_keep_truncated_release(self):
+        anon_data = self.sample_anon_data(23)
+        anon_data[12]['first_balance'] = 'broken'
+        with self.assertRaises(Exception):
+            database.store_anon_database(anon_data, batch_size=5, method='bulk_create', k_value=3, watermark='w')
+        self.assertIsNone(AnonymisationRelease.cached(3, 'w'))
+        self.assertFalse(Anonymisation.objects.exists())
+
+    def test_should_replace_release(self):
+        database.store_anon_database(self.sample_anon_data(4), method='copy')
+        anon_data = self.sample_anon_data(6)
+        database.store_anon_database(anon_data, method='copy')
+        self.assert_stored(anon_data)
+        self.assertEqual(AnonymisationRelease.objects.count(), 1)
+        self.assertEqual(Anonymisation.objects.count(), 6)
+
+    def test_should_clean_sums(self):
+        self.assertEqual(database.clean_sums(['1.5', Decimal('1e30'), 3]),
+                         [Decimal('1.5'), database.MAX_VALUE, Decimal(3)])
+
+
+class TestReleaseCache(TestCase):
+    fixtures = ["user/tests.json"]
+
+    def test_should_change_watermark_with_source_data(self):
+        watermark = source_watermark()
+        self.assertEqual(source_watermark(), watermark)
+        account = Accounts.objects.first()
+        account.balance += 1
+        account.save()
+        self.assertNotEqual(source_watermark(), watermark)
+
+    def test_should_skip_unchanged_source_data(self):
+        with self.assertRaises(TooShortException):
+            wrapper.generate_statistics()
+        self.assertTrue(Statistics.is_current(source_watermark()))
+        self.assertFalse(wrapper.generate_statistics())
+        statistic = Statistics.objects.first()
+        self.assertEqual(set(statistic.info_loss_detail["attributes"]), {"age", "gender", "postal_code", "citizenship"})
+        self.assertAlmostEqual(float(statistic.info_loss),
+                               sum(statistic.info_loss_detail["attributes"].values()) / 4, delta=0.02)
+
+        account = Accounts.objects.first()
+        account.balance += 1
+        account.save()
+        self.assertFalse(Statistics.is_current(source_watermark()))
+        with self.assertRaises(TooShortException):
+            wrapper.generate_statistics()
+        self.assertTrue(Statistics.is_current(source_watermark()))
+
+    def test_should_publish_cached_release(self):
+        # the fixtures only have enough customers for some k values
+        with self.assertRaises(TooShortException):
+            wrapper.generate_statistics()
+        watermark = source_watermark()
+        self.assertEqual(AnonymisationRelease.objects.filter(watermark=watermark, active=False).count(),
+                         Statistics.objects.count())
+
+        with mock.patch.object(wrapper, "anonymise_wrapper") as anonymise_wrapper:
+            release = wrapper.generate_k_anon(4)
+            wrapper.save_anon(release)
+        anonymise_wrapper.assert_not_called()
+        self.assertEqual(release, AnonymisationRelease.cached(4, watermark))
+        self.assertEqual(Anonymisation.objects.published().count(), Anonymisation.objects.filter(release=release).count())
+
+        # the source data changed, k is anonymised again
+        account = Accounts.objects.first()
+        account.balance += 1
+        account.save()
+        new_release = wrapper.generate_k_anon(4)
+        self.assertNotEqual(new_release, release)
+        self.assertEqual(new_release.watermark, source_watermark())
+        self.assertEqual(list(Anonymisation.objects.published().values_list('release', flat=True).distinct()), [release.pk])
+
+
+class TestAnonymisationJob(TestCase):
+    fixtures = ["user/tests.json"]
+
+    def test_should_queue_one_job(self):
+        job = submit_job()
+        self.assertEqual(submit_job(), job)
+        self.assertEqual(claim_job(), job)
+        self.assertIsNone(claim_job())
+        # still running
+        self.assertEqual(submit_job(), job)
+
+    def test_should_report_progress(self):
+        submit_job()
+        job = claim_job()
+        reports = []
+        progress = job_progress(job)
+
+        def recorded(stage, done, total):
+            progress(stage, done, total)
+            job.refresh_from_db()
+            reports.append((job.stage, job.done, job.total))
+
+        with mock.patch("anonymisation.jobs.job_progress", return_value=recorded):
+            job = run_job(job)
+        self.assertEqual(job.status, AnonymisationJob.Status.SUCCEEDED)
+        self.assertEqual(job.message, "Not enough data for anonymisation.")
+        self.assertEqual(reports[:2], [("watermark", 0, 0), ("extract", 0, 18)])
+        self.assertEqual(reports[2:], [("anonymise", done, 18) for done in range(1, Statistics.objects.count() + 1)])
+        self.assertIsNotNone(job.finished)
+
+    def test_should_cancel_queued_job(self):
+        job = cancel_job(submit_job())
+        self.assertEqual(job.status, AnonymisationJob.Status.CANCELLED)
+        self.assertIsNone(claim_job())
+        self.assertNotEqual(submit_job(), job)
+
+    def test_should_cancel_running_job(self):
+        submit_job()
+        job = claim_job()
+        cancel_job(job)
+        job = run_job(job)
+        self.assertEqual(job.status, AnonymisationJob.Status.CANCELLED)
+        self.assertEqual(job.stage, "watermark")
+        self.assertFalse(Statistics.objects.exists())
+
+        # stops between two k values
+        submit_job()
+        job = claim_job()
+        progress = job_progress(job)
+        progress("anonymise", 1, 18)
+        cancel_job(job)
+        with self.assertRaises(JobCancelled):
+            progress("anonymise", 2, 18)
+
+    def test_should_not_keep_partial_sweep(self):
+        def cancel_after_two(stage, done, total):
+            if stage == "anonymise" and done == 2:
+                raise JobCancelled("Cancelled during anonymise.")
+
+        with self.assertRaises(JobCancelled):
+            wrapper.generate_statistics(progress=cancel_after_two)
+        self.assertFalse(Statistics.objects.exists())
+
+        # rows of a killed sweep have no watermark yet
+        with mock.patch("anonymisation.wrapper.Statistics.objects.update"), self.assertRaises(TooShortException):
+            wrapper.generate_statistics()
+        self.assertTrue(Statistics.objects.exists())
+        self.assertFalse(Statistics.is_current(source_watermark()))
+        with self.assertRaises(TooShortException):
+            wrapper.generate_statistics()
+        self.assertTrue(Statistics.is_current(source_watermark()))
+
+    def test_should_record_failure(self):
+        submit_job()
+        job = claim_job()
+        with mock.patch("anonymisation.jobs.generate_statistics", side_effect=ValueError("broken")):
+            job = run_job(job)
+        self.assertEqual(job.status, AnonymisationJob.Status.FAILED)
+        self.assertEqual(job.message, "broken")
+
+
+@override_settings(ANONYMISATION_INCREMENTAL=True)
+class TestIncrementalRelease(TestCase):
+    fixtures = ["user/tests.json"]
+
+    def test_should_update_tree_of_previous_release(self):
+        release = wrapper.generate_k_anon(3)
+        tree = AnonymisationRelease.latest_tree(3)
+        self.assertEqual(tree.root.size, Anonymisation.objects.filter(release=release).count())
+
+        account = Accounts.objects.first()
+        account.balance += 1
+        account.save()
+        with mock.patch.object(wrapper, "anonymise_incremental_wrapper",
+                               wraps=wrapper.anonymise_incremental_wrapper) as incremental_wrapper:
+            new_release = wrapper.generate_k_anon(3)
+        self.assertNotEqual(new_release, release)
+        self.assertEqual(incremental_wrapper.call_args[0][1].root.size, tree.root.size)
+        self.assertIsNotNone(AnonymisationRelease.latest_tree(3))
@@ -1,7 +1,10 @@
 from rest_framework.serializers import ValidationError
 
+from anonymisation.adhoc import AdhocQuery
 from anonymisation.anonymise.overall import QueryOptions
-from anonymisation.models import Statistics
+from anonymisation.export import EXPORT_FORMATS
+from anonymisation.graph import GRAPH_FORMATS
+from anonymisation.models import AnonymisationRelease, Statistics
 from anonymisation.wrapper import MINIMUM_K_VALUE, MAXIMUM_K_VALUE
 
 
@@ -36,3 +39,41 @@ def validate_k_is_set():
     except Statistics.DoesNotExist:
         raise ValidationError("K-value has not been set by DRCK Banking's Anonymisation Officer.")
     return statistic
+
+
+def validate_adhoc_query(json_dict, release):
+    try:
+        aggregates = json_dict.get("aggregates", [])
+        if not isinstance(aggregates, list) or not all(isinstance(aggregate, dict) for aggregate in aggregates):
+            raise ValidationError("The aggregates must be a list of functions and columns.")
+        query = AdhocQuery.from_json(json_dict)
+        query.check_filters(release)
+        return query
+    except KeyError:
+        raise ValidationError("Please input the function of every aggregate.")
+    except (AttributeError, TypeError):
+        raise ValidationError("The query is not in the expected format.")
+    except ValueError as error:
+        raise ValidationError(str(error))
+
+
+def validate_release_is_published():
+    try:
+        release = AnonymisationRelease.objects.get(active=True)
+    except AnonymisationRelease.DoesNotExist:
+        raise ValidationError("No anonymised data has been published.")
+    return release
+
+
+def validate_export_format(json_dict):
+    file_format = json_dict.get("file_format", "csv").strip().lower()
+    if file_format not in EXPORT_FORMATS:
+        raise ValidationError("The file format must be one of %s." % ", ".join(EXPORT_FORMATS))
+    return file_format
+
+
+def validate_graph_format(json_dict):
+    graph_format = json_dict.get("graph_format", "png").strip().lower()
+    if graph_format not in GRAPH_FORMATS:
+        raise ValidationError("The graph format must be one of %s." % ", ".join(GRAPH_FORMATS))
+    return graph_format
@@ -1,59 +1,100 @@
+"""
+The serializers and jobs import the anonymisation engines and with them NumPy, pyarrow and
+matplotlib. Every worker imports this module through main.urls, so they are only imported
+by the handlers: the heavy imports are paid by the first anonymisation request of a worker
+instead of by every worker that serves customers, see benchmarks/startup.py.
+"""
+
 from django.db import transaction
-from django.http import FileResponse, HttpResponse
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
 from rest_framework import permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from anonymisation.anonymise.overall import TooShortException
+from anonymisation.models import AnonymisationJob
 from anonymisation.permissions import (IsAnonymiser, IsResearcher,
                                        IsResearcherOrAnonymiser)
-from anonymisation.serializers import (GetAnonDataSerializer,
-                                       GetKValueSerializer,
-                                       QueryAnonSerializer,
-                                       SetKValueSerializer,
-                                       ViewAnonStatsSerializer)
-from anonymisation.wrapper import generate_statistics
 from staff.permissions import IsStaff
 from user.authentication import TokenAndTwoFactorAuthentication
 
 
 class CalculateAnonView(APIView):
     """Get request
-    
+
+    Queues the statistics sweep, run by the run_anonymisation_worker command.
+    If a sweep is already queued or running, its job is returned instead.
+
     Returns:
-        success: "Statistics for latest k-anonymised data has been successfully generated."
+        job: see AnonJobView
     """
 
     permission_classes = (permissions.IsAuthenticated, IsStaff, IsAnonymiser)
     authentication_classes = (TokenAndTwoFactorAuthentication,)
     throttle_scope = "sensitive_request"
 
-    @transaction.atomic
     def get(self, request):
-        try:
-            generate_statistics()
-            return Response({"success": "Statistics for latest k-anonymised data has been successfully generated."}, status=status.HTTP_200_OK)
-        except TooShortException as error:
-            return Response(error.__str__(), status=status.HTTP_200_OK)
-        except Exception as error:
-            return Response(error.__str__(), status=status.HTTP_400_BAD_REQUEST)
+        from anonymisation.jobs import submit_job
+
+        job = submit_job()
+        return Response(job.to_json(), status=status.HTTP_202_ACCEPTED)
+
+
+class AnonJobView(APIView):
+    """Get request: status of an anonymisation job
+    Post request: cancels the job, a running sweep stops after its current k value
+
+    Returns:
+        job_id, status (queued, running, succeeded, failed or cancelled),
+        stage, done, total: progress of the sweep, in k values
+        cached: true if the source data did not change since the last run, which is kept
+        message, created, started, finished
+    """
+
+    permission_classes = (permissions.IsAuthenticated, IsStaff, IsAnonymiser)
+    authentication_classes = (TokenAndTwoFactorAuthentication,)
+    throttle_scope = "non_sensitive_request"
+
+    def get(self, request, job_id):
+        job = get_object_or_404(AnonymisationJob, pk=job_id)
+        return Response(job.to_json(), status=status.HTTP_200_OK)
+
+    def post(self, request, job_id):
+        from anonymisation.jobs import cancel_job
+
+        job = cancel_job(get_object_or_404(AnonymisationJob, pk=job_id))
+        return Response(job.to_json(), status=status.HTTP_200_OK)
 
 
 class ViewAnonStatsView(APIView):
     """Get request
 
+    Args:
+        graph_format: query parameter, png (default), svg or json (the plotted values)
+
     Returns:
-        FileReponse
+        Graph of the information loss and utilities against the k-value, with an ETag
+        that changes with the statistics. 304 if If-None-Match has the current ETag.
     """
 
     permission_classes = (permissions.IsAuthenticated, IsStaff, IsAnonymiser)
     authentication_classes = (TokenAndTwoFactorAuthentication,)
     throttle_scope = "non_sensitive_request"
 
-    @transaction.atomic
     def get(self, request):
-        graph = ViewAnonStatsSerializer().get_graph()
-        return FileResponse(graph, content_type="image/png")
+        from anonymisation.serializers import ViewAnonStatsSerializer
+
+        serialiser = ViewAnonStatsSerializer(request.query_params, data=request.data)
+        if not serialiser.is_valid():
+            return Response(serialiser.errors, status=status.HTTP_400_BAD_REQUEST)
+        etag = serialiser.get_etag()
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(serialiser.get_graph(), content_type=serialiser.get_content_type())
+        response.headers["ETag"] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
 
 
 class KValueView(APIView):
@@ -72,6 +113,8 @@ class KValueView(APIView):
 
     @transaction.atomic
     def get(self, request):
+        from anonymisation.serializers import GetKValueSerializer
+
         serialiser = GetKValueSerializer(request.data, data=request.data)
         if serialiser.is_valid():
             k_value = serialiser.get_k()
@@ -80,6 +123,8 @@ class KValueView(APIView):
 
     @transaction.atomic
     def post(self, request):
+        from anonymisation.serializers import SetKValueSerializer
+
         serialiser = SetKValueSerializer(request.data, data=request.data)
         if serialiser.is_valid():
             serialiser.set_k()
@@ -128,6 +173,8 @@ class QueryAnonView(APIView):
 
     @transaction.atomic
     def post(self, request):
+        from anonymisation.serializers import QueryAnonSerializer
+
         serialiser = QueryAnonSerializer(request.data, data=request.data)
         if serialiser.is_valid():
             response = serialiser.get_query_results()
@@ -135,25 +182,66 @@ class QueryAnonView(APIView):
         return Response(serialiser.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class AdhocQueryView(APIView):
+    """Post request, in JSON
+
+    Args:
+        filter: {QI column: value or list of values}, optional, the values must be values of
+        the published data, e.g. "20 - 24"
+        group_by: list of QI columns, optional
+        aggregates: list of {"function": "sum", "avg" or "count", "column": SA column},
+        the column of a count is optional. Defaults to a count of the rows
+        exclude_zero: only aggregate the non-zero SA values, optional
+        utility: also return the utility against the source data, optional
+        QI columns: age, gender, postal_code, citizenship
+        SA columns: first_sum to fifth_sum, first_balance to third_balance
+
+    Returns:
+        results: one row per group, with the group columns and the aggregates named
+        function_column, or count
+        utility: if asked for, see adhoc.AdhocQuery.utility
+        query: the query that was run
+
+    Sample:
+    {
+    "filter": {"citizenship": "Singaporean Citizen"},
+    "group_by": ["gender"],
+    "aggregates": [{"function": "avg", "column": "first_sum"}, {"function": "count"}]
+    }
+    """
+
+    permission_classes = (permissions.IsAuthenticated, IsStaff, IsResearcher)
+    authentication_classes = (TokenAndTwoFactorAuthentication,)
+    throttle_scope = "non_sensitive_request"
+
+    def post(self, request):
+        from anonymisation.serializers import AdhocQuerySerializer
+
+        serialiser = AdhocQuerySerializer(request.data, data=request.data)
+        if serialiser.is_valid():
+            response = serialiser.get_query_results()
+            return Response(response, status=status.HTTP_200_OK)
+        return Response(serialiser.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class GetAnonDataView(APIView):
     """Get request
 
+    Args:
+        file_format: query parameter, csv (default), csv.gz, parquet or arrow (Arrow IPC stream)
+
     Returns:
-        CSV file with anonymous data
+        File with the anonymous data, streamed
     """
 
     permission_classes = (permissions.IsAuthenticated, IsStaff, IsResearcherOrAnonymiser)
     authentication_classes = (TokenAndTwoFactorAuthentication,)
     throttle_scope = "sensitive_request"
 
-    @transaction.atomic
     def get(self, request):
-        serialiser = GetAnonDataSerializer(data=request.data)
+        from anonymisation.serializers import GetAnonDataSerializer
+
+        serialiser = GetAnonDataSerializer(request.query_params, data=request.data)
         if serialiser.is_valid():
-            response = HttpResponse(
-                content_type="text/csv",
-                headers={"Content-Disposition": 'attachment; filename="drck_banking_anon_data.csv"'},
-            )
-            response = serialiser.get_anon_data(response)
-            return response
+            return serialiser.get_anon_data()
         return Response(serialiser.errors, status=status.HTTP_400_BAD_REQUEST)
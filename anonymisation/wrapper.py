@@ -1,39 +1,136 @@
-from anonymisation.anonymise.overall import anonymise_wrapper, perform_query
+from django.conf import settings
+
+from anonymisation.anonymise.overall import (TooShortException, anonymise_incremental_wrapper,
+                                             anonymise_parallel_wrapper, anonymise_sweep_wrapper, anonymise_wrapper,
+                                             ground_truth, perform_query, source_watermark)
 
 from anonymisation.anonymise.utils.database import store_stats_database, store_anon_database
-from anonymisation.models import Statistics
+from anonymisation.models import AnonymisationRelease, Statistics
 
 MINIMUM_K_VALUE = 3
 MAXIMUM_K_VALUE = 20
 
+# "tree": prune a single Mondrian split tree for every k value
+# "parallel": exact Mondrian for every k value over a process pool
+# "serial": exact Mondrian for every k value, one after the other
+SWEEP_MODE = "tree"
+
 
-def generate_statistics():
+def no_progress(stage, done, total):
+    pass
+
+def generate_statistics(mode=SWEEP_MODE, force=False, progress=no_progress):
+    """
+    Generates the statistics of every k value, unless the stored statistics were computed
+    from the current source data (see source_watermark) and force is False.
+    Returns True if they were computed, False if the stored ones were kept.
+    The sweep modes extract the data once, instead of once per k value.
+    The anonymised data of every k value is kept as an unpublished release, see generate_k_anon.
+    progress(stage, done, total) is called when a stage starts and after every k value,
+    it may raise to stop the sweep between two k values (see jobs.JobCancelled).
+    The true averages of the queries are computed once for the whole sweep, see ground_truth.
+    The statistics are stored without a watermark and only get it once the sweep is complete,
+    or only misses the k values the data is too short for, so a cancelled, failed or killed
+    sweep is never taken for current. The rows of a cancelled or failed sweep are deleted.
+    """
+    progress("watermark", 0, 0)
+    watermark = source_watermark()
+    if not force and Statistics.is_current(watermark):
+        return False
+    k_values = range(MINIMUM_K_VALUE, MAXIMUM_K_VALUE+1)
+    progress("extract", 0, len(k_values))
     Statistics.objects.all().delete()
-    anon_data = None
-    for i in range(MINIMUM_K_VALUE, MAXIMUM_K_VALUE+1):
-        info_loss, anon_data = anonymise_wrapper(i)
+    try:
+        sweep_statistics(mode, k_values, watermark, progress)
+    except TooShortException:
+        Statistics.objects.update(watermark=watermark)
+        raise
+    except BaseException:
+        Statistics.objects.all().delete()
+        raise
+    Statistics.objects.update(watermark=watermark)
+    return True
+
+def sweep_statistics(mode, k_values, watermark, progress):
+    """
+    Stores the release and the statistics of every k value, see generate_statistics
+    """
+    if mode in ("tree", "parallel"):
+        if mode == "tree":
+            sweep = anonymise_sweep_wrapper(k_values)
+        else:
+            sweep = anonymise_parallel_wrapper(k_values, settings.ANONYMISATION_SWEEP_WORKERS)
+        truth = ground_truth()
+        for done, (k_value, info_loss, anon_data, detail) in enumerate(sweep, 1):
+            release = cache_release(anon_data, k_value, watermark)
+            save_statistics(release, k_value, info_loss, "", detail, truth)
+            progress("anonymise", done, len(k_values))
+        return
+    truth = ground_truth()
+    for done, i in enumerate(k_values, 1):
+        info_loss, anon_data, detail = anonymise_wrapper(i)
         # Handles case of empty database
         if anon_data is None:
             return
-        save_statistics(anon_data, i, info_loss)
-    return anon_data
+        release = cache_release(anon_data, i, watermark)
+        save_statistics(release, i, info_loss, "", detail, truth)
+        progress("anonymise", done, len(k_values))
 
-def save_statistics(anon_data, k_value, info_loss):
-    first_list, first_utility, _ = perform_query("1", anon_data)
-    second_list, second_utility, _ = perform_query("2", anon_data)
-    store_stats_database(k_value, info_loss, first_list, second_list, first_utility, second_utility)
+def save_statistics(release, k_value, info_loss, watermark="", loss_detail=None, truth=None):
+    """
+    Stores the statistics of release, the query averages are aggregated over its rows.
+    truth is the result of ground_truth, it is computed when not given.
+    """
+    truth = truth or ground_truth()
+    first_list, first_utility, _ = perform_query("1", release, truth)
+    second_list, second_utility, _ = perform_query("2", release, truth)
+    store_stats_database(k_value, info_loss, first_list, second_list, first_utility, second_utility, loss_detail,
+                         watermark=watermark)
+
+def cache_release(anon_data, k_value, watermark):
+    return store_anon_database(anon_data, k_value=k_value, watermark=watermark, publish=False)
 
 def generate_k_anon(k_value):
-    info_loss, anon_data = anonymise_wrapper(k_value)
-    save_statistics(anon_data, k_value, info_loss)
-    return anon_data
+    """
+    Returns the release of k_value for the current source data, it is only computed
+    when no sweep or earlier call already stored it.
+    With ANONYMISATION_INCREMENTAL, the split tree of the previous release of k_value is
+    updated with the changes of the source data and kept with the new release.
+    """
+    watermark = source_watermark()
+    release = AnonymisationRelease.cached(k_value, watermark)
+    if release is not None:
+        return release
+    if settings.ANONYMISATION_INCREMENTAL:
+        info_loss, anon_data, detail, tree = anonymise_incremental_wrapper(
+            k_value, AnonymisationRelease.latest_tree(k_value))
+        # Handles case of empty database
+        if anon_data is None:
+            return None
+        release = cache_release(anon_data, k_value, watermark)
+        release.store_tree(tree)
+        save_statistics(release, k_value, info_loss, watermark, detail)
+        return release
+    info_loss, anon_data, detail = anonymise_wrapper(k_value)
+    # Handles case of empty database
+    if anon_data is None:
+        return None
+    release = cache_release(anon_data, k_value, watermark)
+    save_statistics(release, k_value, info_loss, watermark, detail)
+    return release
 
-def get_utility(query_number, anon_data):
-    _, utility, result_json = perform_query(query_number, anon_data)
+def get_utility(query_number, release):
+    _, utility, result_json = perform_query(query_number, release)
     return {"results": result_json, "utility": utility}
 
-def save_anon(anon_data):
-    store_anon_database(anon_data)
+def save_anon(release):
+    """
+    Publishes a release of generate_k_anon, a pointer flip
+    """
+    if release is None:
+        store_anon_database(None)
+    else:
+        release.publish()
 
 def set_k(k_value):
     Statistics().set_k_value_to_true(k_value)
\ No newline at end of file
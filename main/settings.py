@@ -261,6 +261,22 @@ CACHES = {
     }
 }
 
+# Anonymisation
+# Number of worker processes of the parallel k-sweep, see anonymisation.wrapper.SWEEP_MODE
+ANONYMISATION_SWEEP_WORKERS = int(os.environ.get("ANONYMISATION_SWEEP_WORKERS", os.cpu_count() or 1))
+# Rows per batch, and "copy" (PostgreSQL COPY) or "bulk_create", when storing the anonymised data
+ANONYMISATION_BULK_BATCH_SIZE = int(os.environ.get("ANONYMISATION_BULK_BATCH_SIZE", 5000))
+ANONYMISATION_BULK_METHOD = os.environ.get("ANONYMISATION_BULK_METHOD", "copy")
+# Update the Mondrian split tree of the previous release of a k value instead of
+# anonymising from scratch, see anonymisation/anonymise/utils/incremental.py
+ANONYMISATION_INCREMENTAL = os.environ.get("ANONYMISATION_INCREMENTAL", "False") == "True"
+# QI domains of Mondrian: age bands of this many years (0 for raw ages) and postal codes
+# generalised to "sector", "district" or "none", see anonymisation/anonymise/utils/hierarchy.py
+ANONYMISATION_AGE_BAND_WIDTH = int(os.environ.get("ANONYMISATION_AGE_BAND_WIDTH", 5))
+ANONYMISATION_POSTAL_HIERARCHY = os.environ.get("ANONYMISATION_POSTAL_HIERARCHY", "sector")
+# Seconds the results of an ad-hoc query over a release are cached, see anonymisation/adhoc.py
+ANONYMISATION_QUERY_CACHE_TIMEOUT = int(os.environ.get("ANONYMISATION_QUERY_CACHE_TIMEOUT", 24 * 60 * 60))
+
 # Knox Authentication Module
 REST_KNOX = {
     'SECURE_HASH_ALGORITHM':'cryptography.hazmat.primitives.hashes.SHA512',
@@ -15,7 +15,7 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.urls import path
-from anonymisation.views import (CalculateAnonView, GetAnonDataView, QueryAnonView, KValueView, ViewAnonStatsView)
+from anonymisation.views import (AdhocQueryView, AnonJobView, CalculateAnonView, GetAnonDataView, QueryAnonView, KValueView, ViewAnonStatsView)
 from customer.views import (AccountsView, AccountTypesView, CustomerLoginView,
                             CustomerRegistrationView, CustomerTicketsView,
                             CustomerWelcomeView, DepositView, TransactionsView,
@@ -60,9 +60,11 @@ urlpatterns = [
 
     # Anonymisation
     path("staff/calculate_anon", CalculateAnonView.as_view(), name="calculate_anon"),
+    path("staff/anon_job/<int:job_id>", AnonJobView.as_view(), name="anon_job"),
     path("staff/view_anon_stats", ViewAnonStatsView.as_view(), name="view_anon_stats"),
     path("staff/set_k", KValueView.as_view(), name="set_k"),
     path("staff/query_results", QueryAnonView.as_view(), name="query_results"),
+    path("staff/adhoc_query", AdhocQueryView.as_view(), name="adhoc_query"),
     path("staff/get_anon_data", GetAnonDataView.as_view(), name="get_anon_data"),
 
     # Logging